@@ -0,0 +1,189 @@
+import hashlib
+import io
+import os
+import shutil
+import stat
+import tarfile
+
+from . import common
+from . import compress
+
+# Size of the payload sample used to choose the compression automatically,
+# read in chunks from files spread over the payload
+SAMPLE_SIZE = 8 * 1024 * 1024
+SAMPLE_CHUNK_SIZE = 256 * 1024
+
+#===============================================================================
+#===============================================================================
+def get_source_date_epoch():
+    """
+    Timestamp used for all archive entries so that the output only depends on
+    the content (see https://reproducible-builds.org/specs/source-date-epoch/).
+    """
+    try:
+        return int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+    except ValueError:
+        return 0
+
+def _normalize(tarinfo):
+    tarinfo.mtime = get_source_date_epoch()
+    tarinfo.uid = 0
+    tarinfo.gid = 0
+    tarinfo.uname = "root"
+    tarinfo.gname = "root"
+    return tarinfo
+
+class _HashingFile:
+    """
+    Write-only file object updating a digest with what is written through it.
+    """
+    def __init__(self, fileobj, digest):
+        self._fileobj = fileobj
+        self.digest = digest
+
+    def write(self, data):
+        self.digest.update(data)
+        return self._fileobj.write(data)
+
+    def flush(self):
+        self._fileobj.flush()
+
+#===============================================================================
+#===============================================================================
+def payload_name(options):
+    """
+    Name of the payload member of the mission archive ('payload.tar.gz' for
+    gzip).
+    """
+    return "payload.tar" + compress.EXTENSIONS[options.format]
+
+def sample_payload(payload_dir, budget=SAMPLE_SIZE, chunk_size=SAMPLE_CHUNK_SIZE):
+    """
+    Read a sample of about budget bytes of the files of a payload: chunks of
+    files evenly picked in the sorted list of files.
+    Return the sample and the total size of the files.
+    """
+    paths = []
+    total_size = 0
+    for dirpath, dirnames, filenames in os.walk(payload_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                paths.append(path)
+                total_size += st.st_size
+
+    sample = bytearray()
+    count = min(len(paths), max(1, budget // chunk_size))
+    for i in range(count):
+        with open(paths[i * len(paths) // count], "rb") as fin:
+            sample += fin.read(chunk_size)
+    return (bytes(sample), total_size)
+
+def write_payload(payload_dir, fileobj, options):
+    """
+    Write the compressed tar of a payload directory into fileobj.
+    Entries are named './...' like 'tar -C <payload_dir> -czf <out> .' does,
+    sorted, with normalized owner and mtime.
+    Return the sizes before and after compression.
+    """
+    with compress.Writer(fileobj, options) as writer:
+        with tarfile.open(fileobj=writer, mode="w|",
+                format=tarfile.GNU_FORMAT, bufsize=common.BUFSIZE) as tar:
+            tar.add(payload_dir, arcname=".", filter=_normalize)
+    return (writer.bytes_in, writer.bytes_out)
+
+#===============================================================================
+#===============================================================================
+def _add_streamed_member(tar, name, writer):
+    """
+    Add a regular file member whose content is produced by writer(fileobj)
+    directly in the archive. The header is written once the size is known, so
+    the content never goes through a temporary file.
+    """
+    fileobj = tar.fileobj
+    start = tar.offset
+    fileobj.seek(start + tarfile.BLOCKSIZE)
+    writer(fileobj)
+    end = fileobj.tell()
+
+    tarinfo = _normalize(tarfile.TarInfo(name))
+    tarinfo.size = end - start - tarfile.BLOCKSIZE
+    tarinfo.mode = 0o644
+    tarinfo.offset = start
+    tarinfo.offset_data = start + tarfile.BLOCKSIZE
+
+    buf = tarinfo.tobuf(tar.format, tar.encoding, tar.errors)
+    if len(buf) != tarfile.BLOCKSIZE:
+        raise ValueError("Unexpected header size for member '%s'" % name)
+    fileobj.seek(start)
+    fileobj.write(buf)
+    fileobj.seek(end)
+
+    remainder = tarinfo.size % tarfile.BLOCKSIZE
+    if remainder > 0:
+        fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+    tar.offset = fileobj.tell()
+    tar.members.append(tarinfo)
+
+#===============================================================================
+#===============================================================================
+def write_mission_tar(tar_path, mission_dir, options, digests=None,
+        algorithm="sha512"):
+    """
+    Create the (uncompressed) mission archive with 'mission.json' and
+    the payload ('payload.tar.gz' for gzip), the latter being generated on
+    the fly from the 'payload' directory of the mission.
+    digests: dict filled with the hex digest of each member, computed while
+    it is written so the archive does not need to be read again to sign it
+    (None: no digest computed).
+    Return the sizes of the payload before and after compression.
+    """
+    payload_dir = os.path.join(mission_dir, "payload")
+    json_path = os.path.join(mission_dir, "mission.json")
+    stats = []
+    payload_digest = hashlib.new(algorithm) if digests is not None else None
+
+    with open(json_path, "rb") as fin:
+        json_data = fin.read()
+    tarinfo = _normalize(tarfile.TarInfo("mission.json"))
+    tarinfo.size = len(json_data)
+    tarinfo.mode = os.stat(json_path).st_mode & 0o7777
+
+    with open(tar_path, "wb") as fout:
+        with tarfile.open(fileobj=fout, mode="w",
+                format=tarfile.GNU_FORMAT) as tar:
+            tar.addfile(tarinfo, io.BytesIO(json_data))
+            _add_streamed_member(tar, payload_name(options),
+                    lambda fileobj: stats.extend(write_payload(payload_dir,
+                        _HashingFile(fileobj, payload_digest)
+                            if payload_digest else fileobj, options)))
+
+    if digests is not None:
+        digests["mission.json"] = hashlib.new(algorithm, json_data).hexdigest()
+        digests[payload_name(options)] = payload_digest.hexdigest()
+    return tuple(stats)
+
+#===============================================================================
+#===============================================================================
+def gzip_file(src_path, dst_path, options):
+    """
+    Compress src_path into dst_path like 'gzip' would (original name kept in
+    the header). The destination is replaced atomically.
+    Return the sizes before and after compression.
+    """
+    tmp_path = dst_path + ".tmp"
+    mtime = get_source_date_epoch()
+    try:
+        with open(src_path, "rb") as fin, open(tmp_path, "wb") as fout:
+            with compress.GzipWriter(fout, options,
+                    filename=os.path.basename(src_path),
+                    mtime=mtime) as gzfile:
+                shutil.copyfileobj(fin, gzfile, common.BUFSIZE)
+        os.replace(tmp_path, dst_path)
+        return (gzfile.bytes_in, gzfile.bytes_out)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_DESCRIPTION = """
+    Benchmark the mission packaging path (gen_final, set_versions,
+    gen_archive and the whole images post hook) on synthetic missions.
+"""
+
+_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+_PACKAGE_DIR = os.path.dirname(_BENCH_DIR)
+
+# Synthetic mission shapes: list of (directory in final dir, file count,
+# file size, nesting depth, extension)
+_SHAPES = {
+    "python": [
+        ("usr/lib/python3.11/site-packages", 4000, 4 * 1024, 3, ".py"),
+    ],
+    "native": [
+        ("usr/lib", 4, 32 * 1024 * 1024, 0, ".so"),
+        ("lib", 8, 2 * 1024 * 1024, 0, ".so"),
+    ],
+    "gstreamer": [
+        ("usr/lib/gstreamer-1.0", 300, 256 * 1024, 6, ".so"),
+    ],
+}
+_SHAPES["mixed"] = _SHAPES["python"] + _SHAPES["native"] + _SHAPES["gstreamer"]
+
+_PHASES = ("gen_final", "set_versions", "gen_archive")
+
+#===============================================================================
+#===============================================================================
+def gen_content(rng, size, text):
+    """
+    Generate content roughly as compressible as source code (text) or
+    binaries (half random, half repetitive).
+    """
+    if text:
+        words = [b"import", b"self", b"def", b"return", b"value", b"None",
+                b"    ", b"\n", b"(", b")", b":", b"logging", b"os.path"]
+        data = b" ".join(rng.choice(words) for _ in range(size // 4))
+        return data[:size]
+    half = size // 2
+    return rng.randbytes(half) + bytes(range(256)) * ((size - half) // 256 + 1)
+
+def gen_tree(final_dir, shape, scale, seed):
+    """
+    Populate the final dir with the given shape.
+    Return the number of files and bytes generated.
+    """
+    rng = random.Random(seed)
+    files = 0
+    size = 0
+    for dirname, count, filesize, depth, ext in _SHAPES[shape]:
+        count = max(1, int(count * scale))
+        for i in range(count):
+            subdirs = ["d%d" % rng.randrange(4) for _ in range(depth)]
+            dirpath = os.path.join(final_dir, dirname, *subdirs)
+            os.makedirs(dirpath, exist_ok=True)
+            path = os.path.join(dirpath, "f%05d%s" % (i, ext))
+            with open(path, "wb") as fout:
+                fout.write(gen_content(rng, filesize, ext == ".py"))
+            files += 1
+            size += filesize
+    # Same layout as the product: usr/lib/python -> python3.11
+    if os.path.isdir(os.path.join(final_dir, "usr/lib/python3.11")):
+        os.symlink("python3.11", os.path.join(final_dir, "usr/lib/python"))
+    return (files, size)
+
+def setup_workspace(dragon, workspace_dir, shape, scale, missions, seed):
+    dragon.WORKSPACE_DIR = workspace_dir
+    dragon.PRODUCT_DIR = workspace_dir
+    dragon.OUT_DIR = os.path.join(workspace_dir, "out")
+    dragon.FINAL_DIR = os.path.join(dragon.OUT_DIR, "final")
+    dragon.IMAGES_DIR = os.path.join(dragon.OUT_DIR, "images")
+    for path in (dragon.FINAL_DIR, dragon.IMAGES_DIR):
+        os.makedirs(path)
+
+    sdk_dir = os.path.join(workspace_dir, "sdk", dragon.VARIANT)
+    os.makedirs(sdk_dir)
+    with open(os.path.join(sdk_dir, "build.prop"), "w") as fd:
+        fd.write("ro.parrot.build.version=0.0.0\n")
+        fd.write("ro.missions.sdk_target_arch=aarch64\n")
+
+    files, size = gen_tree(dragon.FINAL_DIR, shape, scale, seed)
+    for i in range(missions):
+        mission_dir = os.path.join(dragon.FINAL_DIR, "missions",
+                "com.parrot.missions.bench%d" % i)
+        os.makedirs(os.path.join(mission_dir, "payload", "services"))
+        with open(os.path.join(mission_dir, "mission.json"), "w") as fd:
+            json.dump({"uid": "com.parrot.missions.bench%d" % i,
+                    "name": "bench%d" % i, "version": "0.0.0"}, fd)
+    return (files * missions, size * missions)
+
+#===============================================================================
+#===============================================================================
+def _reset_peak_rss():
+    # Writing 5 in clear_refs resets the peak RSS (VmHWM) of the process
+    try:
+        with open("/proc/self/clear_refs", "w") as fd:
+            fd.write("5")
+    except OSError:
+        pass
+
+def _peak_rss():
+    try:
+        with open("/proc/self/status", "r") as fd:
+            for line in fd:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure(name, func, files, size):
+    _reset_peak_rss()
+    start = time.monotonic()
+    func()
+    duration = time.monotonic() - start
+    result = {
+        "duration": duration,
+        "files": files,
+        "bytes": size,
+        "files_per_s": files / duration if duration > 0 else 0.0,
+        "mb_per_s": size / 1e6 / duration if duration > 0 else 0.0,
+        "peak_rss_mb": _peak_rss() / 1e6,
+    }
+    logging.info("%-16s %8.2fs %10.0f files/s %8.1f MB/s %8.1f MB RSS",
+            name, duration, result["files_per_s"], result["mb_per_s"],
+            result["peak_rss_mb"])
+    return result
+
+def run(options):
+    sys.path.insert(0, os.path.join(_BENCH_DIR, "stub"))
+    sys.path.insert(0, os.path.dirname(_PACKAGE_DIR))
+    import dragon
+
+    workspace_dir = tempfile.mkdtemp(prefix="bench-missions-",
+            dir=options.workdir)
+    try:
+        files, size = setup_workspace(dragon, workspace_dir, options.shape,
+                options.scale, options.missions, options.seed)
+        logging.info("Generated %d missions with %d files, %.1f MB",
+                options.missions, files, size / 1e6)
+
+        dragon.set_json_config({
+            "compression": {"backend": options.compression},
+            "cache": {"enabled": False},
+            "missions": {"jobs": options.jobs},
+        })
+        buildext = importlib.import_module(
+                os.path.basename(_PACKAGE_DIR) + ".buildext")
+
+        missions_dir = os.path.join(dragon.FINAL_DIR, "missions")
+        mission_dirs = [os.path.join(missions_dir, entry)
+                for entry in sorted(os.listdir(missions_dir))]
+
+        phases = {}
+        for phase in _PHASES:
+            func = getattr(buildext, phase)
+            phases[phase] = measure(phase,
+                    lambda: [func(mission_dir) for mission_dir in mission_dirs],
+                    files, size)
+
+        # Whole hook, with the cache: first build then unchanged rebuild
+        dragon.set_json_config(dict(dragon.get_json_config(), cache={}))
+        task = dragon.Task()
+        phases["images"] = measure("images",
+                lambda: buildext.hook_post_images(task, []), files, size)
+        phases["images_rebuild"] = measure("images_rebuild",
+                lambda: buildext.hook_post_images(task, []), files, size)
+
+        return {
+            "commit": _get_commit(),
+            "time": time.time(),
+            "config": {
+                "shape": options.shape,
+                "scale": options.scale,
+                "missions": options.missions,
+                "jobs": options.jobs,
+                "compression": options.compression,
+                "cpus": os.cpu_count(),
+            },
+            "phases": phases,
+        }
+    finally:
+        if not options.keep:
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+
+def _get_commit():
+    try:
+        return subprocess.check_output(["git", "-C", _PACKAGE_DIR,
+                "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r") as fd:
+        baseline = json.load(fd)
+    logging.info("Compared to %s (%s):", baseline_path, baseline.get("commit"))
+    for name, result in results["phases"].items():
+        old = baseline.get("phases", {}).get(name)
+        if not old or not old["duration"]:
+            continue
+        logging.info("%-16s %8.2fs -> %8.2fs (%+.1f%%)", name,
+                old["duration"], result["duration"],
+                100.0 * (result["duration"] - old["duration"]) / old["duration"])
+
+#===============================================================================
+#===============================================================================
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    parser = argparse.ArgumentParser(description=_DESCRIPTION)
+
+    parser.add_argument("--shape",
+        choices=sorted(_SHAPES),
+        default="mixed",
+        help="Shape of the synthetic missions (default: mixed).")
+
+    parser.add_argument("--scale",
+        type=float,
+        default=1.0,
+        help="Multiply the number of files of the shape (default: 1.0).")
+
+    parser.add_argument("--missions",
+        type=int,
+        default=2,
+        help="Number of missions (default: 2).")
+
+    parser.add_argument("--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of missions processed in parallel by the images hook.")
+
+    parser.add_argument("--compression",
+        default="gzip",
+        help="Compression backend (default: gzip).")
+
+    parser.add_argument("--seed",
+        type=int,
+        default=0,
+        help="Seed of the generated content.")
+
+    parser.add_argument("--workdir",
+        metavar="DIR",
+        help="Directory in which the workspace is created.")
+
+    parser.add_argument("--keep",
+        action="store_true",
+        help="Keep the generated workspace.")
+
+    parser.add_argument("--output",
+        metavar="FILE",
+        help="Write the results in JSON format in the given file.")
+
+    parser.add_argument("--compare",
+        metavar="FILE",
+        help="Compare the results with a previous JSON output.")
+
+    options = parser.parse_args()
+    results = run(options)
+
+    if options.output:
+        with open(options.output, "w") as fd:
+            json.dump(results, fd, indent=4, sort_keys=True)
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == "__main__":
+    main()
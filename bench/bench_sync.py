@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import urllib.request
+
+_DESCRIPTION = """
+    Benchmark the sync task end to end (archive hashing, upload, install
+    check and reboot) against local drone stand-ins (see fake_drone.py)
+    with a configurable bandwidth, latency and injected failures.
+"""
+
+_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+_PACKAGE_DIR = os.path.dirname(_BENCH_DIR)
+
+# Sync runs: name and sync task arguments. The second one finds all the
+# missions already installed.
+_RUNS = [
+    ("upload", []),
+    ("unchanged", []),
+    ("force", ["--force"]),
+]
+
+#===============================================================================
+#===============================================================================
+def gen_mission_archives(dragon, package, count, size, seed):
+    """
+    Generate count missions with an archive of about size bytes (random
+    payload content, so not compressible) in the images dir.
+    """
+    archive = importlib.import_module(package + ".archive")
+    compress = importlib.import_module(package + ".compress")
+    rng = random.Random(seed)
+    options = compress.Options(level=1)
+    for i in range(count):
+        name = "com.parrot.missions.bench%d" % i
+        mission_dir = os.path.join(dragon.FINAL_DIR, "missions", name)
+        payload_dir = os.path.join(mission_dir, "payload", "lib")
+        os.makedirs(payload_dir)
+        with open(os.path.join(mission_dir, "mission.json"), "w") as fd:
+            json.dump({"uid": name, "name": "bench%d" % i, "version": "0.0.0",
+                    "build_sdk_version": "0.0.0"}, fd)
+        remaining = size
+        index = 0
+        while remaining > 0:
+            chunk = min(remaining, 8 * 1024 * 1024)
+            with open(os.path.join(payload_dir, "f%03d.so" % index), "wb") as fout:
+                fout.write(rng.randbytes(chunk))
+            remaining -= chunk
+            index += 1
+
+        with tempfile.TemporaryDirectory(dir=dragon.OUT_DIR) as tmpdir:
+            tar_path = os.path.join(tmpdir, name + ".tar")
+            archive.write_mission_tar(tar_path, mission_dir, options)
+            archive.gzip_file(tar_path,
+                    os.path.join(dragon.IMAGES_DIR, name + ".tar.gz"), options)
+
+def import_mission_archives(dragon, paths):
+    """
+    Use existing mission archives, their mission.json being extracted in the
+    final dir like after a build.
+    """
+    for path in paths:
+        name = os.path.basename(path)
+        if name.endswith(".tar.gz"):
+            name = name[:-len(".tar.gz")]
+        mission_dir = os.path.join(dragon.FINAL_DIR, "missions", name)
+        os.makedirs(mission_dir)
+        with tarfile.open(path, "r|gz") as tar:
+            for tarinfo in tar:
+                if tarinfo.name == "mission.json":
+                    with open(os.path.join(mission_dir, "mission.json"),
+                            "wb") as fout:
+                        fout.write(tar.extractfile(tarinfo).read())
+                    break
+        shutil.copyfile(path, os.path.join(dragon.IMAGES_DIR, name + ".tar.gz"))
+
+def setup_workspace(dragon, workspace_dir):
+    dragon.WORKSPACE_DIR = workspace_dir
+    dragon.PRODUCT_DIR = workspace_dir
+    dragon.OUT_DIR = os.path.join(workspace_dir, "out")
+    dragon.FINAL_DIR = os.path.join(dragon.OUT_DIR, "final")
+    dragon.IMAGES_DIR = os.path.join(dragon.OUT_DIR, "images")
+    for path in (dragon.FINAL_DIR, dragon.IMAGES_DIR):
+        os.makedirs(path)
+
+#===============================================================================
+#===============================================================================
+def start_drones(options):
+    """
+    Start the drone stand-ins, each in its own process so that it does not
+    compete with the sync for the GIL.
+    Return the processes and their addresses.
+    """
+    drones = []
+    for i in range(options.drones):
+        process = subprocess.Popen([sys.executable,
+                os.path.join(_BENCH_DIR, "fake_drone.py"),
+                "--port", "0",
+                "--serial", "PI%012d" % i,
+                "--bandwidth", str(options.bandwidth),
+                "--latency", str(options.latency),
+                "--fail-first", str(options.fail_first),
+                "--error-rate", str(options.error_rate),
+                "--drop-rate", str(options.drop_rate),
+                "--seed", str(options.seed + i),
+            ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True)
+        line = process.stdout.readline()
+        if not line.startswith("Listening on "):
+            process.kill()
+            raise RuntimeError("Failed to start drone stand-in")
+        drones.append((process, line.split()[-1]))
+    return drones
+
+def stop_drones(drones):
+    for process, _ in drones:
+        process.terminate()
+    for process, _ in drones:
+        process.wait()
+
+def get_drone_stats(address):
+    with urllib.request.urlopen("http://%s/fake/stats" % address) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+#===============================================================================
+#===============================================================================
+def measure(name, buildext, sync_options, args, drones):
+    parser = argparse.ArgumentParser()
+    buildext.add_sync_arguments(parser, sync_options)
+    sync_args = parser.parse_args(args)
+
+    stats_before = [get_drone_stats(address) for _, address in drones]
+    start = time.monotonic()
+    error = None
+    results = []
+    try:
+        results = buildext.sync_missions(buildext.get_mission_dirs(),
+                sync_args, sync_options)
+    except buildext.TaskError as ex:
+        error = str(ex)
+    duration = time.monotonic() - start
+    stats = {}
+    for (_, address), before in zip(drones, stats_before):
+        for key, value in get_drone_stats(address).items():
+            stats[key] = stats.get(key, 0) + value - before.get(key, 0)
+
+    uploaded = [entry for result in results for entry in result["missions"]
+            if not entry.get("skipped") and "error" not in entry]
+    upload_bytes = sum(entry["bytes"] for entry in uploaded)
+    upload_time = sum(entry["duration"] for entry in uploaded)
+    result = {
+        "duration": duration,
+        "uploads": len(uploaded),
+        "skipped": sum(result["skipped"] for result in results),
+        "failures": sum(result["failures"] for result in results),
+        "retries": sum(max(entry["attempts"] - 1, 0)
+                for result in results for entry in result["missions"]),
+        "bytes": upload_bytes,
+        "upload_time": upload_time,
+        # Per upload, drones being synchronized in parallel
+        "mb_per_s": upload_bytes / 1e6 / upload_time if upload_time > 0 else 0.0,
+        "server": stats,
+        "error": error,
+    }
+    logging.info("%-10s %8.2fs %3d uploads %3d skipped %8.1f MB %8.2f MB/s"
+            " %3d retries %3d failures %3d connections", name, duration,
+            result["uploads"], result["skipped"], upload_bytes / 1e6,
+            result["mb_per_s"], result["retries"], result["failures"],
+            stats.get("connections", 0))
+    if error:
+        logging.warning("%s: %s", name, error)
+    return result
+
+def run(options):
+    sys.path.insert(0, os.path.join(_BENCH_DIR, "stub"))
+    sys.path.insert(0, os.path.dirname(_PACKAGE_DIR))
+    import dragon
+
+    package = os.path.basename(_PACKAGE_DIR)
+    workspace_dir = tempfile.mkdtemp(prefix="bench-sync-", dir=options.workdir)
+    drones = []
+    try:
+        setup_workspace(dragon, workspace_dir)
+        if options.archive:
+            import_mission_archives(dragon, options.archive)
+        else:
+            gen_mission_archives(dragon, package, options.missions,
+                    int(options.size * 1e6), options.seed)
+        sizes = [os.path.getsize(os.path.join(dragon.IMAGES_DIR, name))
+                for name in sorted(os.listdir(dragon.IMAGES_DIR))]
+        logging.info("%d mission archives, %.1f MB", len(sizes),
+                sum(sizes) / 1e6)
+
+        dragon.set_json_config({
+            "sync": {"retries": options.retries, "timeout": options.timeout},
+        })
+        buildext = importlib.import_module(package + ".buildext")
+        sync_options = buildext.get_sync_options()
+
+        drones = start_drones(options)
+        common_args = ["--unsigned", "--jobs", str(options.jobs)]
+        for _, address in drones:
+            common_args += ["--drone", address]
+        if options.reboot:
+            common_args.append("--reboot")
+
+        runs = {}
+        for name, args in _RUNS:
+            runs[name] = measure(name, buildext, sync_options,
+                    common_args + args, drones)
+
+        return {
+            "commit": _get_commit(),
+            "time": time.time(),
+            "config": {
+                "archives": sizes,
+                "drones": options.drones,
+                "jobs": options.jobs,
+                "bandwidth": options.bandwidth,
+                "latency": options.latency,
+                "fail_first": options.fail_first,
+                "error_rate": options.error_rate,
+                "drop_rate": options.drop_rate,
+                "retries": options.retries,
+            },
+            "runs": runs,
+        }
+    finally:
+        stop_drones(drones)
+        if not options.keep:
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+
+def _get_commit():
+    try:
+        return subprocess.check_output(["git", "-C", _PACKAGE_DIR,
+                "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r") as fd:
+        baseline = json.load(fd)
+    logging.info("Compared to %s (%s):", baseline_path, baseline.get("commit"))
+    for name, result in results["runs"].items():
+        old = baseline.get("runs", {}).get(name)
+        if not old or not old["duration"]:
+            continue
+        logging.info("%-10s %8.2fs -> %8.2fs (%+.1f%%)", name,
+                old["duration"], result["duration"],
+                100.0 * (result["duration"] - old["duration"]) / old["duration"])
+
+#===============================================================================
+#===============================================================================
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    parser = argparse.ArgumentParser(description=_DESCRIPTION)
+
+    parser.add_argument("--archive",
+        action="append",
+        metavar="FILE",
+        help="Mission archive to synchronize, can be repeated"
+                " (default: generated archives).")
+
+    parser.add_argument("--missions",
+        type=int,
+        default=2,
+        help="Number of generated missions (default: 2).")
+
+    parser.add_argument("--size",
+        type=float,
+        default=20.0,
+        help="Size of the generated archives in MB (default: 20).")
+
+    parser.add_argument("--drones",
+        type=int,
+        default=1,
+        help="Number of drone stand-ins (default: 1).")
+
+    parser.add_argument("--jobs",
+        type=int,
+        default=0,
+        help="Number of drones synchronized in parallel (default: all).")
+
+    parser.add_argument("--bandwidth",
+        type=float,
+        default=0.0,
+        help="Upload bandwidth of each drone in MB/s (default: unlimited).")
+
+    parser.add_argument("--latency",
+        type=float,
+        default=0.0,
+        help="Latency of each request in ms (default: 0).")
+
+    parser.add_argument("--fail-first",
+        type=int,
+        default=0,
+        help="Number of first uploads failing on each drone.")
+
+    parser.add_argument("--error-rate",
+        type=float,
+        default=0.0,
+        help="Probability of an upload failing with a server error.")
+
+    parser.add_argument("--drop-rate",
+        type=float,
+        default=0.0,
+        help="Probability of the connection being closed during an upload.")
+
+    parser.add_argument("--retries",
+        type=int,
+        default=3,
+        help="Number of retries of the sync (default: 3).")
+
+    parser.add_argument("--timeout",
+        type=float,
+        default=60.0,
+        help="Timeout of the sync requests in seconds (default: 60).")
+
+    parser.add_argument("--reboot",
+        action="store_true",
+        help="Reboot the drones after each sync.")
+
+    parser.add_argument("--seed",
+        type=int,
+        default=0,
+        help="Seed of the generated content and injected failures.")
+
+    parser.add_argument("--workdir",
+        metavar="DIR",
+        help="Directory in which the workspace is created.")
+
+    parser.add_argument("--keep",
+        action="store_true",
+        help="Keep the generated workspace.")
+
+    parser.add_argument("--output",
+        metavar="FILE",
+        help="Write the results in JSON format in the given file.")
+
+    parser.add_argument("--compare",
+        metavar="FILE",
+        help="Compare the results with a previous JSON output.")
+
+    options = parser.parse_args()
+    results = run(options)
+
+    if options.output:
+        with open(options.output, "w") as fd:
+            json.dump(results, fd, indent=4, sort_keys=True)
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import http.server
+import json
+import logging
+import os
+import random
+import socket
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+
+_DESCRIPTION = """
+    Stand-in of the http api of a drone used by the sync task and
+    manage_keys.py (mission upload and list, reboot, properties and
+    challenge signature), with a configurable bandwidth, latency and
+    injected failures. It also serves the APC and academy requests of
+    manage_keys.py (set PARROT_APC_URL and PARROT_ACADEMY_URL to its url).
+"""
+
+API_PATH = "/api/v1"
+
+# APC and academy requests of manage_keys.py
+APC_TMP_ACCOUNT_PATH = "/V4/account/tmp/create"
+ACADEMY_CHALLENGE_PATH = "/apiv1/4g/secrets/challenge"
+ACADEMY_SECRETS_PATH = "/apiv1/4g/secrets"
+
+# Statistics of the stand-in itself, not part of the drone api
+STATS_PATH = "/fake/stats"
+
+_CHUNK_SIZE = 64 * 1024
+
+#===============================================================================
+#===============================================================================
+def _parse_version(version):
+    parts = []
+    for field in str(version or "").split("-", 1)[0].split("."):
+        digits = "".join(c for c in field if c.isdigit())
+        parts.append(int(digits) if digits else 0)
+    return parts
+
+def read_mission(path):
+    """
+    Read mission.json and the member names of a mission archive, like the
+    drone does when installing it.
+    """
+    mission = None
+    names = []
+    with tarfile.open(path, mode="r|gz") as tar:
+        for tarinfo in tar:
+            names.append(tarinfo.name)
+            if tarinfo.name == "mission.json":
+                mission = json.loads(tar.extractfile(tarinfo).read())
+    if mission is None:
+        raise ValueError("missing mission.json")
+    return (mission, names)
+
+#===============================================================================
+#===============================================================================
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("%s: %s", self.address_string(), format % args)
+
+    def reply(self, status, content=None):
+        body = json.dumps(content if content is not None else {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_text(self, status, text):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        drone = self.server.drone
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        route = (self.command, url.path.rstrip("/"))
+        if route == ("GET", STATS_PATH):
+            return self.reply(200, drone.get_stats())
+
+        # One handler per connection, those only used for statistics are
+        # not counted
+        if not getattr(self, "_counted", False):
+            self._counted = True
+            drone.count("connections")
+        drone.count("requests")
+        if drone.latency:
+            time.sleep(drone.latency)
+        if route == ("POST", APC_TMP_ACCOUNT_PATH):
+            self.read_body(throttle=False)
+            drone.count("apc_tokens")
+            return self.reply(200, {"apcToken": "fake-%s" % os.urandom(8).hex()})
+        if route == ("GET", ACADEMY_CHALLENGE_PATH):
+            drone.count("challenges")
+            return self.reply_text(200, "%s:%s\n" % (query.get("operation"),
+                    os.urandom(8).hex()))
+        if route == ("GET", ACADEMY_SECRETS_PATH):
+            # Secrets derived from the signed challenge
+            digest = hashlib.sha256(str(query.get("message")).encode())
+            return self.reply(200, {"SENC": digest.hexdigest()[:32],
+                    "SMAC": digest.hexdigest()[32:]})
+        if route == ("PUT", API_PATH + "/mission/missions"):
+            return self.upload_mission(query)
+        if route == ("GET", API_PATH + "/mission/missions"):
+            return self.reply(200, drone.list_missions())
+        if route == ("PUT", API_PATH + "/system/reboot"):
+            drone.count("reboots")
+            return self.reply(200)
+        if route == ("GET", API_PATH + "/info/properties"):
+            return self.reply(200, [{"key": key, "value": value}
+                    for key, value in sorted(drone.properties.items())])
+        if route == ("GET", API_PATH + "/secure-element/sign_challenge"):
+            message = hashlib.sha256(("%s:%s:%s" % (drone.serial,
+                    query.get("operation"), query.get("challenge"))).encode())
+            return self.reply(200, {"message": message.hexdigest()})
+        self.read_body(throttle=False)
+        return self.reply(404, {"error": "unknown endpoint %s %s" % route})
+
+    do_GET = handle_request
+    do_POST = handle_request
+    do_PUT = handle_request
+
+    def read_body(self, fileobj=None, throttle=True, limit=None):
+        """
+        Read the request body at the configured bandwidth, writing it into
+        fileobj. Stop after limit bytes (dropped connection).
+        Return the number of bytes read.
+        """
+        drone = self.server.drone
+        length = int(self.headers.get("Content-Length") or 0)
+        if limit is not None:
+            length = min(length, limit)
+        start = time.monotonic()
+        count = 0
+        while count < length:
+            data = self.rfile.read(min(_CHUNK_SIZE, length - count))
+            if not data:
+                break
+            count += len(data)
+            if fileobj:
+                fileobj.write(data)
+            if throttle and drone.bandwidth:
+                delay = start + count / drone.bandwidth - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        drone.count("bytes_received", count)
+        return count
+
+    def upload_mission(self, query):
+        drone = self.server.drone
+        drone.count("uploads")
+        failure = drone.next_failure()
+        if failure == "drop":
+            # Close the connection in the middle of the upload
+            drone.count("dropped")
+            self.read_body(limit=int(self.headers.get("Content-Length") or 0) // 2)
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return None
+
+        with tempfile.NamedTemporaryFile(prefix="fake-drone-") as fout:
+            self.read_body(fout)
+            fout.flush()
+            if failure == "error":
+                drone.count("errors")
+                return self.reply(503, {"error": "injected failure"})
+            try:
+                mission, names = read_mission(fout.name)
+            except (OSError, EOFError, ValueError, tarfile.TarError) as ex:
+                return self.reply(400, {"error": "invalid archive: %s" % ex})
+
+        if not any(name.startswith("signature") for name in names) and \
+                query.get("allow_unsigned") != "yes":
+            return self.reply(403, {"error": "unsigned mission"})
+        uid = mission.get("uid")
+        installed = drone.installed.get(uid)
+        if installed and query.get("allow_downgrade") != "yes" and \
+                _parse_version(installed.get("version")) > \
+                _parse_version(mission.get("version")):
+            return self.reply(409, {"error": "downgrade refused"})
+
+        drone.install(mission, query.get("is_default") == "yes")
+        return self.reply(200, drone.installed[uid])
+
+#===============================================================================
+#===============================================================================
+class FakeDrone:
+    """
+    Stand-in drone serving the api on a local port (0: any free port).
+    bandwidth: upload speed in bytes/s (0: unlimited).
+    latency: delay before handling each request, in seconds.
+    fail_first: number of first uploads failing.
+    error_rate, drop_rate: probability of an upload failing with a server
+    error or of the connection being closed during the upload.
+    """
+    def __init__(self, host="127.0.0.1", port=0, serial="PI000000000000",
+            bandwidth=0, latency=0.0, fail_first=0, error_rate=0.0,
+            drop_rate=0.0, seed=0):
+        self.serial = serial
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.fail_first = fail_first
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.properties = {
+            "ro.factory.serial": serial,
+            "ro.parrot.build.version": "0.0.0",
+        }
+        self.installed = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._thread = None
+        self.server = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.drone = self
+
+    @property
+    def address(self):
+        return "%s:%d" % self.server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._stats[name] = self._stats.get(name, 0) + value
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def next_failure(self):
+        """
+        Failure to inject in the next upload: 'error', 'drop' or None.
+        """
+        with self._lock:
+            if self.fail_first > 0:
+                self.fail_first -= 1
+                return "error"
+            value = self._rng.random()
+        if value < self.drop_rate:
+            return "drop"
+        if value < self.drop_rate + self.error_rate:
+            return "error"
+        return None
+
+    def install(self, mission, is_default):
+        with self._lock:
+            self.installed[mission.get("uid")] = {
+                "uid": mission.get("uid"),
+                "name": mission.get("name"),
+                "version": mission.get("version"),
+                "build_sdk_version": mission.get("build_sdk_version"),
+                "is_default": is_default,
+            }
+            self._stats["installs"] = self._stats.get("installs", 0) + 1
+
+    def list_missions(self):
+        with self._lock:
+            return list(self.installed.values())
+
+#===============================================================================
+#===============================================================================
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    parser = argparse.ArgumentParser(description=_DESCRIPTION)
+
+    parser.add_argument("--host",
+        default="127.0.0.1",
+        help="Address to listen on (default: 127.0.0.1).")
+
+    parser.add_argument("--port",
+        type=int,
+        default=8080,
+        help="Port to listen on, 0 for any free port (default: 8080).")
+
+    parser.add_argument("--serial",
+        default="PI000000000000",
+        help="Serial number reported in the properties.")
+
+    parser.add_argument("--bandwidth",
+        type=float,
+        default=0.0,
+        help="Upload bandwidth in MB/s (default: unlimited).")
+
+    parser.add_argument("--latency",
+        type=float,
+        default=0.0,
+        help="Delay before handling each request, in ms.")
+
+    parser.add_argument("--fail-first",
+        type=int,
+        default=0,
+        help="Number of first uploads failing with a server error.")
+
+    parser.add_argument("--error-rate",
+        type=float,
+        default=0.0,
+        help="Probability of an upload failing with a server error.")
+
+    parser.add_argument("--drop-rate",
+        type=float,
+        default=0.0,
+        help="Probability of the connection being closed during an upload.")
+
+    parser.add_argument("--seed",
+        type=int,
+        default=0,
+        help="Seed of the injected failures.")
+
+    options = parser.parse_args()
+    drone = FakeDrone(host=options.host, port=options.port,
+            serial=options.serial, bandwidth=options.bandwidth * 1e6,
+            latency=options.latency / 1e3, fail_first=options.fail_first,
+            error_rate=options.error_rate, drop_rate=options.drop_rate,
+            seed=options.seed)
+    # First line of output, read by the benchmarks to get the port
+    print("Listening on %s" % drone.address, flush=True)
+    try:
+        drone.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        drone.server.server_close()
+        logging.info("%s", json.dumps(drone.get_stats(), sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Minimal stand-in of the dragon module, providing what the mission build
+extension uses so that its hooks can run outside of a product tree.
+Directories are relative to BENCH_WORKSPACE_DIR and can be changed before
+importing the build extension.
+"""
+
+import logging
+import os
+import subprocess
+
+from task import TaskError as TaskError
+
+WORKSPACE_DIR = os.environ.get("BENCH_WORKSPACE_DIR", "/tmp/bench-workspace")
+PRODUCT_DIR = WORKSPACE_DIR
+OUT_DIR = os.path.join(WORKSPACE_DIR, "out")
+FINAL_DIR = os.path.join(OUT_DIR, "final")
+IMAGES_DIR = os.path.join(OUT_DIR, "images")
+
+VARIANT = "bench"
+PARROT_BUILD_PROP_VERSION = "0.0.0"
+PARROT_BUILD_PROP_PROJECT = "bench"
+
+_json_config = {}
+
+def set_json_config(cfg):
+    global _json_config
+    _json_config = cfg
+
+def get_json_config():
+    return _json_config
+
+def exec_cmd(cmd, **kwargs):
+    logging.debug("exec: %s", cmd)
+    subprocess.check_call(cmd, shell=True, **kwargs)
+
+def makedirs(path):
+    os.makedirs(path, exist_ok=True)
+
+class Task:
+    """
+    Task object given to hooks.
+    """
+    def call_base_post_hook(self, args):
+        pass
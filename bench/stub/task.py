@@ -0,0 +1,6 @@
+"""
+Minimal stand-in of the dragon 'task' module for benchmarks.
+"""
+
+class TaskError(Exception):
+    pass
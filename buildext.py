@@ -1,24 +1,55 @@
 import os
 import dragon
+import glob
+import hashlib
+import inspect
 import json
 import logging
 import shutil
 import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 from task import TaskError as TaskError
 
+from . import archive
+from . import cache
+from . import compress
+from . import elfdeps
+from . import elfstrip
+from . import pycompile
+from . import sdk
+from . import sizes
+from . import staging
+from . import sync
+from . import timing
+from . import verify
+from . import watch
+
 try:
     from dragon_buildext_sign.buildext import sign_archive
     CAN_SIGN = True
+    # Signers accepting precomputed digests (a 'digests' argument, list of
+    # the hex digests of the members in filelist order) do not read the
+    # members again. The current dragon_buildext_sign does not: the digests
+    # are then not computed at all and the signer reads the members.
+    SIGN_WITH_DIGESTS = "digests" in inspect.signature(sign_archive).parameters
 except ImportError:
     CAN_SIGN = False
+    SIGN_WITH_DIGESTS = False
+
+SIGNATURE_HASH = "sha512"
 
 DRONE_SERVER_URL = "http://anafi-ai.local/api/v1"
 VERSION_SERVER_INTERNAL_URL = "https://noserver"
-VERSION_SERVER_URL = "https://firmware.parrot.com"
+VERSION_SERVER_URL = os.environ.get("MISSION_VERSION_SERVER_URL",
+        "https://firmware.parrot.com")
 VERSION_SERVER_INTERNAL = False
 
 WORKSPACE_DIR = Path(dragon.WORKSPACE_DIR).absolute()
@@ -36,13 +67,6 @@ DEFAULT_BASE_SDK_VARIANT = "%s_airsdk"
 if "PARROT_BUILD_PROP_PROJECT" not in os.environ:
     dragon.PARROT_BUILD_PROP_PROJECT = "airsdk-missions"
 
-#===============================================================================
-#===============================================================================
-def download_file(url, outdirpath):
-    logging.info(f"Downloading file: {url}")
-    file_name = outdirpath / os.path.basename(url)
-    dragon.exec_cmd(f"curl --progress-bar {url} --output {file_name}")
-
 #===============================================================================
 #===============================================================================
 def get_root_url(base_sdk_product, base_sdk_variant, base_sdk_version):
@@ -64,87 +88,308 @@ def get_root_url(base_sdk_product, base_sdk_variant, base_sdk_version):
 
 #===============================================================================
 #===============================================================================
-def sign(tar, filelist):
-    cfg = dragon.get_json_config()
+_signature_config = {}
 
-    key = os.environ.get("MISSION_SIGNATURE_KEY")
-    if not key:
-        key = cfg.get("signature", {}).get("key") if cfg else None
+def get_signature_name():
+    cfg = dragon.get_json_config()
+    cfg_sig = cfg.get("signature", {}) if cfg else {}
 
     name = os.environ.get("MISSION_SIGNATURE_NAME")
     if not name:
-        name = cfg.get("signature", {}).get("name") if cfg else None
+        name = cfg_sig.get("name")
     if not name:
-        name = "signature.ecdsa"
+        name = verify.DEFAULT_SIGNATURE_NAME
+    return name
+
+def get_signature_config():
+    cfg = dragon.get_json_config()
+    cfg_sig = cfg.get("signature", {}) if cfg else {}
 
+    key = os.environ.get("MISSION_SIGNATURE_KEY")
+    if not key:
+        key = cfg_sig.get("key")
+
+    name = get_signature_name()
+
+    # Key path resolved once per build, not for each mission (the key itself
+    # is loaded by the signer for each archive)
+    if (key, name) in _signature_config:
+        return _signature_config[(key, name)]
+    config = (key, name)
+
+    # If key is local, make sure we have an absolute path
+    if key and "local" in key:
+        parts = key.split(":", 2)
+        keypath = parts[2]
+        if os.path.isabs(keypath):
+            logging.warning("Local key path should be relative to product dir: '%s'", keypath)
+        else:
+            keypath = os.path.join(dragon.PRODUCT_DIR, keypath)
+        if not os.path.exists(keypath):
+            raise dragon.TaskError("Invalid key path: '%s'" % keypath)
+        config = (":".join([parts[0], parts[1], keypath]), name)
+
+    _signature_config[(key, name)] = config
+    return config
+
+_key_hashes = {}
+
+def get_signature_key_id():
+    if not CAN_SIGN:
+        return None
+    key, name = get_signature_config()
+    if key and "local" in key:
+        # Local key files may change without their path changing
+        keypath = key.split(":", 2)[2]
+        st = os.stat(keypath)
+        stat_key = (keypath, st.st_size, st.st_mtime_ns, st.st_ino)
+        if stat_key not in _key_hashes:
+            _key_hashes[stat_key] = cache.hash_file(keypath)
+        return "%s:%s:%s" % (key, name, _key_hashes[stat_key])
+    return "%s:%s" % (key, name)
+
+def sign(tar, filelist, digests=None):
+    key, name = get_signature_config()
     if not key:
         logging.warning("No signature key configured")
     else:
-        # If key is local, make sure we have an absolute path
-        if "local" in key:
-            parts = key.split(":", 2)
-            keypath = parts[2]
-            if os.path.isabs(keypath):
-                logging.warning("Local key path should be relative to product dir: '%s'", keypath)
-            else:
-                keypath = os.path.join(dragon.PRODUCT_DIR, keypath)
-            if not os.path.exists(keypath):
-                raise dragon.TaskError("Invalid key path: '%s'" % keypath)
-            key = ":".join([parts[0], parts[1], keypath])
-
         logging.info("Signing archive with key: %s", key)
-        sign_archive(tar, filelist, key, name, "sha512")
+        if digests is not None:
+            sign_archive(tar, filelist, key, name, SIGNATURE_HASH,
+                    digests=[digests[filename] for filename in filelist])
+        else:
+            sign_archive(tar, filelist, key, name, SIGNATURE_HASH)
+
+#===============================================================================
+#===============================================================================
+# Default bandwidth of the link to the target used to choose the compression
+# of payloads automatically, in MB/s
+DEFAULT_COMPRESSION_BANDWIDTH = 4
+
+def get_compression_options(default_threads=None):
+    cfg = dragon.get_json_config()
+    cfg_compression = cfg.get("compression", {}) if cfg else {}
+
+    backend = os.environ.get("MISSION_COMPRESSION_BACKEND")
+    if not backend:
+        backend = cfg_compression.get("backend", compress.BACKEND_GZIP)
+
+    # gzip level of the archive, and of the payload when it is gzip
+    level = os.environ.get("MISSION_COMPRESSION_LEVEL")
+    if not level:
+        level = cfg_compression.get("level")
+
+    # Level of the payload format (zstd, xz...), default of the format
+    payload_level = os.environ.get("MISSION_COMPRESSION_PAYLOAD_LEVEL")
+    if not payload_level:
+        payload_level = cfg_compression.get("payload_level")
+
+    threads = os.environ.get("MISSION_COMPRESSION_THREADS")
+    if not threads:
+        threads = cfg_compression.get("threads", default_threads)
+
+    payload_format = os.environ.get("MISSION_COMPRESSION_FORMAT")
+    if not payload_format:
+        payload_format = cfg_compression.get("format", compress.FORMAT_GZIP)
+
+    try:
+        return compress.Options(backend=backend, level=payload_level,
+                threads=threads, format=payload_format, gzip_level=level)
+    except ValueError as ex:
+        raise TaskError("Invalid compression configuration: %s" % str(ex))
+
+def resolve_compression(mission_dir, options):
+    """
+    Check that the payload format is supported by the firmwares the mission
+    targets (target_min_version), or choose it for 'auto' by sampling the
+    payload. The choice is kept while the sample does not change.
+    """
+    cfg = dragon.get_json_config()
+    cfg_compression = cfg.get("compression", {}) if cfg else {}
+    # First firmware version supporting each format
+    min_firmware = cfg_compression.get("min_firmware", {})
+
+    name = os.path.split(mission_dir)[1]
+    with open(os.path.join(mission_dir, "mission.json"), "r") as fd:
+        target_min_version = json.load(fd).get("target_min_version")
+    formats = compress.get_allowed_formats(target_min_version, min_firmware)
+
+    if options.format != compress.FORMAT_AUTO:
+        if options.format not in formats:
+            raise TaskError("Compression format '%s' not supported by target"
+                    " firmware %s of '%s'" % (options.format,
+                    target_min_version, name))
+        return options
+
+    bandwidth = _get_number_option("MISSION_COMPRESSION_BANDWIDTH",
+            cfg_compression, "bandwidth", DEFAULT_COMPRESSION_BANDWIDTH,
+            float) * 1e6
+
+    sample, total_size = archive.sample_payload(
+            os.path.join(mission_dir, "payload"))
+    key = "%s:%d:%s:%d:%s" % (hashlib.sha256(sample).hexdigest(),
+            total_size, ",".join(formats), bandwidth, options.backend)
+    choice_path = os.path.join(dragon.OUT_DIR,
+            name.replace('.', '_') + "-compression.json")
+    try:
+        with open(choice_path, "r") as fd:
+            choice = json.load(fd)
+        if choice["key"] == key:
+            return options.with_format(choice["format"], choice["level"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    chosen, estimations = compress.choose_options(options, sample, total_size,
+            bandwidth, formats)
+    for estimation in estimations:
+        logging.info("%s: %s:%d ratio %.1f%%, estimated %.1fs"
+                " (compression %.1fs, transfer %.1fs)", name,
+                estimation["format"], estimation["level"],
+                100.0 * estimation["ratio"], estimation["total_time"],
+                estimation["compress_time"], estimation["transfer_time"])
+    with open(choice_path, "w") as fd:
+        json.dump({"key": key, "format": chosen.format, "level": chosen.level,
+                "estimations": estimations}, fd, indent=4, sort_keys=True)
+    return chosen
+
+def log_compression_stats(name, stats, elapsed):
+    size_in, size_out = stats
+    logging.info("%s: %.1f MB -> %.1f MB (%.1f%%) in %.2fs (%.1f MB/s)",
+            name, size_in / 1e6, size_out / 1e6,
+            100.0 * size_out / size_in if size_in else 0.0,
+            elapsed, size_in / 1e6 / elapsed if elapsed > 0 else 0.0)
 
 #===============================================================================
 #===============================================================================
-def gen_archive(mission_dir):
+def _get_bool_option(env, cfg_section, cfg_key, default):
+    """
+    Get a boolean option from the environment ('0', 'no' and 'false' being
+    false) or else from a section of the json config.
+    """
+    value = os.environ.get(env)
+    if value:
+        return value.lower() not in ("0", "no", "false")
+    return cfg_section.get(cfg_key, default)
+
+def _get_number_option(env, cfg_section, cfg_key, default, convert=int):
+    """
+    Get a number option (converted with convert) from the environment or else
+    from a section of the json config, None if not set.
+    """
+    value = os.environ.get(env)
+    if not value:
+        value = cfg_section.get(cfg_key, default)
+    if value is None:
+        return None
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise TaskError("Invalid '%s' option (%s): '%s'" % (cfg_key, env, value))
+
+def get_archive_cache():
+    cfg = dragon.get_json_config()
+    cfg_cache = cfg.get("cache", {}) if cfg else {}
+
+    enabled = _get_bool_option("MISSION_CACHE", cfg_cache, "enabled", True)
+    if not enabled:
+        return None
+
+    max_size = _get_number_option("MISSION_CACHE_MAX_SIZE", cfg_cache,
+            "max_size", cache.DEFAULT_MAX_SIZE_MB)
+
+    return cache.ArchiveCache(os.path.join(dragon.OUT_DIR, "missions-cache"),
+            max_size * 1024 * 1024)
+
+#===============================================================================
+#===============================================================================
+def build_archive(mission_dir, image_path, options):
     name = os.path.split(mission_dir)[1]
-    logging.info("Generating mission archive for '%s'", name)
 
     # Files to put in archive and sign
     filelist = [
         "mission.json",
-        "payload.tar.gz",
+        archive.payload_name(options),
     ]
 
     with tempfile.TemporaryDirectory(prefix="missions-") as tmpdir:
         mission_tar = os.path.join(tmpdir, name + ".tar")
-        mission_tar_gz = os.path.join(tmpdir, name + ".tar.gz")
-
-        # Create payload.tar.gz
-        cmd = "tar -C %s -czvf %s ." % (
-                os.path.join(mission_dir, "payload"),
-                os.path.join(tmpdir, "payload.tar.gz"))
-        dragon.exec_cmd(cmd)
-
-        # Copy mission.json
-        cmd = "cp -pf %s %s" % (
-                os.path.join(mission_dir, "mission.json"),
-                os.path.join(tmpdir, "mission.json"))
-        dragon.exec_cmd(cmd)
-
-        # Expose mission.json file in out dir with product-variant in filename
-        cmd = "cp -pf %s %s" % (
-                os.path.join(mission_dir, "mission.json"),
-                os.path.join(dragon.OUT_DIR, name.replace('.', '_') + ".json"),
-        )
-        dragon.exec_cmd(cmd)
 
-        # Create the mission archive (not compressed yet)
-        cmd = "tar -C %s -cvf %s %s" % (
-                tmpdir,
-                mission_tar,
-                " ".join(filelist))
-        dragon.exec_cmd(cmd)
+        # Create the mission archive (not compressed yet) with the payload
+        # generated directly inside it, and the digests of its members only
+        # if the signer can use them
+        digests = {} if CAN_SIGN and SIGN_WITH_DIGESTS else None
+        with timing.phase("payload", name) as counters:
+            start = time.monotonic()
+            stats = archive.write_mission_tar(mission_tar, mission_dir, options,
+                    digests, SIGNATURE_HASH)
+            log_compression_stats("%s/%s" % (name, filelist[1]), stats,
+                    time.monotonic() - start)
+            counters["bytes_in"], counters["bytes_out"] = stats
 
         if CAN_SIGN:
-            sign(mission_tar, filelist)
+            with timing.phase("sign", name) as counters:
+                if not SIGN_WITH_DIGESTS:
+                    counters["bytes_in"] = os.path.getsize(mission_tar)
+                sign(mission_tar, filelist, digests)
         else:
             logging.warning("No signing tools available")
 
-        # Compress and copy to image directory
-        dragon.exec_cmd("gzip %s" % mission_tar)
-        dragon.exec_cmd("cp -pf %s %s/" % (mission_tar_gz, dragon.IMAGES_DIR))
+        # Compress directly in image directory
+        with timing.phase("compress", name) as counters:
+            start = time.monotonic()
+            stats = archive.gzip_file(mission_tar, image_path, options)
+            log_compression_stats("%s.tar.gz" % name, stats,
+                    time.monotonic() - start)
+            counters["bytes_in"], counters["bytes_out"] = stats
+
+def gen_archive(mission_dir, threads=None):
+    name = os.path.split(mission_dir)[1]
+    logging.info("Generating mission archive for '%s'", name)
+    with timing.phase("compression_choice", name):
+        options = resolve_compression(mission_dir,
+                get_compression_options(threads))
+    logging.info("Compression: %r", options)
+
+    json_path = os.path.join(mission_dir, "mission.json")
+    image_path = os.path.join(dragon.IMAGES_DIR, name + ".tar.gz")
+
+    # Expose mission.json file in out dir with product-variant in filename
+    shutil.copy2(json_path,
+            os.path.join(dragon.OUT_DIR, name.replace('.', '_') + ".json"))
+
+    manifest_path = os.path.join(dragon.OUT_DIR,
+            name.replace('.', '_') + "-manifest.json")
+    archive_cache = get_archive_cache()
+    if not archive_cache:
+        # The archive no longer matches the manifest of a previous build
+        cache.remove_manifest(manifest_path)
+        build_archive(mission_dir, image_path, options)
+        return
+
+    with timing.phase("manifest", name) as counters:
+        previous = cache.load_manifest(manifest_path)
+        manifest = cache.make_manifest(os.path.join(mission_dir, "payload"),
+                json_path, get_signature_key_id(), options.id, previous)
+        digest = cache.manifest_digest(manifest)
+        counters["files"] = len(manifest["files"])
+
+    # The archive must also be the one built with the previous manifest (not
+    # rebuilt or replaced since). The cache lookup touches the cached archive,
+    # which may be a hardlink of it, so it is only done afterwards.
+    if previous and previous.get("digest") == digest and \
+            previous.get("image") is not None and \
+            previous.get("image") == cache.image_stat(image_path):
+        logging.info("Mission '%s' unchanged, keeping '%s'", name, image_path)
+    else:
+        cached_path = archive_cache.lookup(digest)
+        if cached_path:
+            logging.info("Mission '%s' unchanged, reusing cached archive", name)
+            cache.install_file(cached_path, image_path)
+        else:
+            build_archive(mission_dir, image_path, options)
+            archive_cache.store(digest, image_path)
+
+    cache.save_manifest(manifest_path, manifest, digest, image_path)
 
 #===============================================================================
 #===============================================================================
@@ -195,110 +440,576 @@ def set_versions(mission_dir):
                     (json_path, str(ex)))
 
 def get_sdk_build_prop():
-    sdk_build_prop = os.path.join(SDK_DIR_PATH, dragon.VARIANT, 'build.prop')
-    props = {}
-    with open(sdk_build_prop, errors="ignore") as f:
-        for line in f.readlines():
-            line = line.strip("\n")
-            # Format is <key>=<value>
-            fields = line.split("=", 1)
-            if len(fields) == 2:
-                props[fields[0]] = fields[1]
-        return props
+    return sdk.load_index(SDK_DIR_PATH / dragon.VARIANT)["build_prop"]
 
 #===============================================================================
 #===============================================================================
+def get_staging_hardlink():
+    # Copies by default: hardlinked payload files share their inode with the
+    # final dir (see staging.stage)
+    cfg = dragon.get_json_config()
+    cfg_staging = cfg.get("staging", {}) if cfg else {}
+    return _get_bool_option("MISSION_STAGING_HARDLINK", cfg_staging,
+            "hardlink", False)
+
+# Directories of the final dir staged in the payload of all missions
+PAYLOAD_DIRSLIST = {
+    "etc": "etc",
+    "lib": "lib",
+    "usr/lib/python/site-packages": "python",
+    "usr/lib": "lib",
+    "usr/share": "share",
+}
+
+# Directories that would be copied twice (already staged as 'python')
+PAYLOAD_CLEANDIRSLIST = [
+    "lib/python",
+    "lib/python3.*",
+]
+
 def gen_final(mission_dir):
     name = os.path.split(mission_dir)[1]
     logging.info("Generating mission final for '%s'", name)
 
-    dirslist = {
-        "etc": "etc",
-        "lib": "lib",
-        "usr/lib/python/site-packages": "python",
-        "usr/lib": "lib",
-        "usr/share": "share",
+    dirslist = PAYLOAD_DIRSLIST
+    cleandirslist = PAYLOAD_CLEANDIRSLIST
+
+    payload_dir = os.path.join(mission_dir, "payload")
+    state_path = os.path.join(dragon.OUT_DIR,
+            name.replace('.', '_') + "-staging.json")
+
+    # Leftovers of a staging that did not exclude them
+    for key in cleandirslist:
+        for dir_path in glob.glob(os.path.join(payload_dir, key)):
+            staging.remove_path(dir_path)
+
+    with timing.phase("stage", name) as counters:
+        mapping = staging.build_mapping(dragon.FINAL_DIR, dirslist, cleandirslist)
+        stats = staging.stage(mapping, payload_dir,
+                previous=staging.load_state(state_path),
+                hardlink=get_staging_hardlink())
+        staging.save_state(state_path, mapping)
+        counters["files"] = stats["linked"] + stats["copied"]
+    logging.info("%s: %d files linked, %d copied, %d unchanged, %d removed",
+            name, stats["linked"], stats["copied"], stats["unchanged"],
+            stats["removed"])
+
+#===============================================================================
+#===============================================================================
+def get_deps_options():
+    cfg = dragon.get_json_config()
+    cfg_deps = cfg.get("deps", {}) if cfg else {}
+
+    # Opt-in like strip and pyc (libraries only loaded with dlopen or ctypes
+    # are reported as unreachable), enabled when pruning is requested
+    do_prune = _get_bool_option("MISSION_DEPS_PRUNE", cfg_deps, "prune", False)
+    enabled = _get_bool_option("MISSION_DEPS", cfg_deps, "enabled", do_prune)
+    if not enabled:
+        return None
+
+    return {"prune": do_prune}
+
+def analyze_deps(mission_dir, deps_options):
+    name = os.path.split(mission_dir)[1]
+    payload_dir = os.path.join(mission_dir, "payload")
+    out_prefix = os.path.join(dragon.OUT_DIR, name.replace('.', '_'))
+
+    sysroot_dir = os.path.join(SDK_DIR_PATH, dragon.VARIANT)
+    has_sysroot = os.path.isdir(sysroot_dir)
+    sysroot_libs = {}
+    if has_sysroot:
+        sdk_index = sdk.load_index(sysroot_dir)
+        for lib_name, relpath in list(sdk_index["sonames"].items()) + \
+                list(sdk_index["libs"].items()):
+            sysroot_libs.setdefault(lib_name,
+                    os.path.join(sysroot_dir, relpath))
+
+    info_cache = elfdeps.InfoCache(out_prefix + "-elfdeps-cache.json")
+    result = elfdeps.analyze(payload_dir, sysroot_libs, info_cache,
+            sysroot_dir if has_sysroot else None)
+    info_cache.save()
+    if not has_sysroot:
+        # Everything provided by the target would be reported
+        logging.warning("No base sdk in '%s', unresolved libraries not checked",
+                sysroot_dir)
+        result["unresolved"] = {}
+
+    for relpath, names in sorted(result["unresolved"].items()):
+        logging.warning("%s: %s: unresolved %s", name, relpath, ", ".join(names))
+    for relpath in result["unreachable"]:
+        logging.warning("%s: %s: not used by any executable, service or plugin",
+                name, relpath)
+
+    if deps_options["prune"] and result["unreachable"]:
+        size = elfdeps.prune(payload_dir, result["unreachable"])
+        result["pruned"] = result["unreachable"]
+        logging.info("%s: %d unreachable libraries removed (%.1f MB)",
+                name, len(result["unreachable"]), size / 1e6)
+
+    with open(out_prefix + "-deps.json", "w") as fd:
+        json.dump(result, fd, indent=4, sort_keys=True)
+    return result
+
+#===============================================================================
+#===============================================================================
+def get_pyc_options():
+    cfg = dragon.get_json_config()
+    cfg_pyc = cfg.get("pyc", {}) if cfg else {}
+
+    enabled = _get_bool_option("MISSION_PYC", cfg_pyc, "enabled", False)
+    if not enabled:
+        return None
+
+    pyc_only = _get_bool_option("MISSION_PYC_ONLY", cfg_pyc, "only", False)
+
+    version = pycompile.get_target_python_version()
+    python = pycompile.find_python(version,
+            os.environ.get("MISSION_PYC_PYTHON") or cfg_pyc.get("python"))
+    if not python:
+        raise TaskError("No host python %s found to compile mission python" %
+                version)
+
+    return {"python": python, "only": pyc_only}
+
+def compile_python(mission_dir, pyc_options, threads=None):
+    name = os.path.split(mission_dir)[1]
+    payload_dir = os.path.join(mission_dir, "payload")
+    python_dir = os.path.join(payload_dir, "python")
+    if not os.path.isdir(python_dir):
+        return
+
+    logging.info("Compiling python of '%s'%s", name,
+            " (pyc only)" if pyc_options["only"] else "")
+    size_before = pycompile.dir_size(python_dir)
+    try:
+        pycompile.compile_dir(python_dir, pyc_options["python"], payload_dir,
+                pyc_only=pyc_options["only"], jobs=threads or 0)
+    except subprocess.CalledProcessError as ex:
+        raise TaskError("Failed to compile python of '%s': %s" % (name, str(ex)))
+    size_after = pycompile.dir_size(python_dir)
+    logging.info("%s: python size %.1f MB -> %.1f MB (%+.1f MB)", name,
+            size_before / 1e6, size_after / 1e6,
+            (size_after - size_before) / 1e6)
+
+#===============================================================================
+#===============================================================================
+def get_strip_options():
+    cfg = dragon.get_json_config()
+    cfg_strip = cfg.get("strip", {}) if cfg else {}
+
+    enabled = _get_bool_option("MISSION_STRIP", cfg_strip, "enabled", False)
+    if not enabled:
+        return None
+
+    # Must handle the target architecture (ex: aarch64-linux-gnu-objcopy)
+    objcopy = os.environ.get("MISSION_OBJCOPY")
+    if not objcopy:
+        objcopy = cfg_strip.get("objcopy", "objcopy")
+    if not shutil.which(objcopy):
+        raise TaskError("Tool to strip missions not found: '%s'" % objcopy)
+
+    return {"objcopy": objcopy}
+
+def strip_elf(mission_dir, strip_options, threads=None):
+    name = os.path.split(mission_dir)[1]
+    payload_dir = os.path.join(mission_dir, "payload")
+    symbols_path = os.path.join(dragon.OUT_DIR,
+            name.replace('.', '_') + "-symbols.tar.gz")
+
+    logging.info("Stripping ELF files of '%s'", name)
+    with tempfile.TemporaryDirectory(prefix="symbols-") as tmpdir:
+        try:
+            count, saved = elfstrip.strip_dir(payload_dir, tmpdir,
+                    strip_options["objcopy"], threads)
+        except subprocess.CalledProcessError as ex:
+            raise TaskError("Failed to strip '%s': %s" % (name,
+                    ex.stderr.decode(errors="replace").strip()))
+
+        if count == 0:
+            # Nothing to symbolicate, do not leave the one of a previous build
+            if os.path.exists(symbols_path):
+                os.unlink(symbols_path)
+            logging.info("%s: no ELF files stripped", name)
+            return (count, saved)
+
+        # Debug info for later symbolication, same layout as the payload
+        with tarfile.open(symbols_path, "w:gz") as tar:
+            tar.add(tmpdir, arcname=".")
+
+    logging.info("%s: %d ELF files stripped, %.1f MB saved, symbols in '%s'",
+            name, count, saved / 1e6, symbols_path)
+    return (count, saved)
+
+#===============================================================================
+#===============================================================================
+def get_build_jobs(argv=None):
+    """
+    Get the parallelism level of the build: the '-j' option given to dragon
+    ('-jN', '-j N', or '-j' alone for one job per cpu), read from its command
+    line as it is not exposed to build extensions. One job per cpu if the
+    option is not given.
+    """
+    args = sys.argv[1:] if argv is None else argv
+    for i, arg in enumerate(args):
+        if arg == "--":
+            break
+        if arg.startswith("-j"):
+            count = arg[2:]
+            if not count and i + 1 < len(args) and args[i + 1].isdigit():
+                count = args[i + 1]
+            if count.isdigit() and int(count) > 0:
+                return int(count)
+            if not count:
+                break
+    return os.cpu_count() or 1
+
+def get_mission_jobs():
+    jobs = os.environ.get("MISSION_JOBS")
+    if not jobs:
+        cfg = dragon.get_json_config()
+        jobs = cfg.get("missions", {}).get("jobs") if cfg else None
+    if not jobs:
+        jobs = get_build_jobs()
+    try:
+        return max(1, int(jobs))
+    except ValueError:
+        raise TaskError("Invalid mission jobs count: '%s'" % jobs)
+
+class _GroupedLogHandler(logging.Handler):
+    """
+    Root log handler buffering the records of the threads that called start()
+    until they call finish(), then forwarding them at once to the original
+    handlers so the logs of a mission are not interleaved with others.
+    """
+    def __init__(self, handlers):
+        super().__init__()
+        self._handlers = handlers
+        self._buffers = {}
+
+    def start(self):
+        self._buffers[threading.get_ident()] = []
+
+    def finish(self):
+        records = self._buffers.pop(threading.get_ident(), [])
+        self.acquire()
+        try:
+            self._forward(records)
+        finally:
+            self.release()
+
+    def emit(self, record):
+        records = self._buffers.get(record.thread)
+        if records is not None:
+            records.append(record)
+        else:
+            self._forward([record])
+
+    def _forward(self, records):
+        for record in records:
+            for handler in self._handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+def get_packaging_options():
+    return {
+        "deps": get_deps_options(),
+        "pyc": get_pyc_options(),
+        "strip": get_strip_options(),
     }
 
-    # Clean directories that may have been copied twice
-    cleandirslist = [
-        "lib/python",
-        "lib/python3.*",
-    ]
+def process_mission(mission_dir, options, threads=None):
+    """
+    Process a mission, its parallel steps (python compilation, strip and
+    compression) using at most threads threads (default: one per cpu).
+    """
+    name = os.path.split(mission_dir)[1]
+    with timing.phase("gen_final", name):
+        gen_final(mission_dir)
+    if options["deps"]:
+        with timing.phase("deps", name) as counters:
+            result = analyze_deps(mission_dir, options["deps"])
+            counters["files"] = len(result["reachable"]) + \
+                    len(result["unreachable"])
+    if options["pyc"]:
+        with timing.phase("compile_python", name):
+            compile_python(mission_dir, options["pyc"], threads)
+    if options["strip"]:
+        with timing.phase("strip", name) as counters:
+            counters["files"], counters["bytes_saved"] = \
+                    strip_elf(mission_dir, options["strip"], threads)
+    with timing.phase("set_versions", name):
+        set_versions(mission_dir)
+    with timing.phase("gen_archive", name):
+        gen_archive(mission_dir, threads)
 
-    for key in dirslist:
-        # src dir
-        src_path = os.path.join(dragon.FINAL_DIR, key)
-        if not os.path.exists(src_path):
-            continue
-        src_entries = os.listdir(src_path)
-        if len(src_entries) == 0:
-            continue
-        for entry in src_entries:
-            if os.path.isdir(entry) and len(os.listdir(entry)) == 0:
-                os.rmdir(entry)
-        # dst dir
-        dst_path = os.path.join(dragon.FINAL_DIR, mission_dir, "payload", dirslist[key])
-        dragon.makedirs(dst_path)
-        # move src to dst dir
-        dragon.exec_cmd("cp -av %s/* %s" % (src_path, dst_path))
+def process_missions(mission_dirs, jobs, options):
+    # The build parallelism level is split between the missions processed
+    # at the same time, not given to each of them
+    running = max(1, min(jobs, len(mission_dirs)))
+    threads = max(1, get_build_jobs() // running)
+    if jobs <= 1 or len(mission_dirs) <= 1:
+        for mission_dir in mission_dirs:
+            process_mission(mission_dir, options, threads)
+        return
 
-    for key in cleandirslist:
-        dir_path = os.path.join(dragon.FINAL_DIR, mission_dir, "payload", key)
-        dragon.exec_cmd("rm -rfv %s" % dir_path)
+    logging.info("Processing %d missions with %d jobs (%d threads each)",
+            len(mission_dirs), jobs, threads)
+    root_logger = logging.getLogger()
+    saved_handlers = root_logger.handlers[:]
+    log_handler = _GroupedLogHandler(saved_handlers)
+    root_logger.handlers = [log_handler]
+
+    def worker(mission_dir):
+        log_handler.start()
+        try:
+            process_mission(mission_dir, options, threads)
+        finally:
+            log_handler.finish()
+
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        futures = [executor.submit(worker, mission_dir)
+                for mission_dir in mission_dirs]
+        for future in as_completed(futures):
+            # First error aborts missions not started yet
+            future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        root_logger.handlers = saved_handlers
 
 #===============================================================================
 # Hooks.
 #===============================================================================
+def get_sdk_cache():
+    cfg = dragon.get_json_config()
+    cfg_cache = cfg.get("sdk_cache", {}) if cfg else {}
+
+    enabled = _get_bool_option("MISSION_SDK_CACHE", cfg_cache, "enabled", True)
+    if not enabled:
+        return None
+
+    cache_dir = os.environ.get("MISSION_SDK_CACHE_DIR")
+    if not cache_dir:
+        cache_dir = cfg_cache.get("dir", sdk.get_default_cache_dir())
+
+    max_size = _get_number_option("MISSION_SDK_CACHE_MAX_SIZE", cfg_cache,
+            "max_size", sdk.DEFAULT_MAX_SIZE_MB)
+
+    return sdk.SdkCache(cache_dir, max_size * 1024 * 1024)
+
 def hook_pre_download_base_sdk(task, args):
     if os.path.exists(SDK_TAR_PATH):
         os.unlink(SDK_TAR_PATH)
 
-    sdk_variant_dir_path = os.path.join(SDK_DIR_PATH, dragon.VARIANT)
-    if os.path.exists(sdk_variant_dir_path):
-        if os.path.isdir(sdk_variant_dir_path):
-            shutil.rmtree(sdk_variant_dir_path)
-        else:
-            os.unlink(sdk_variant_dir_path)
 
-    os.makedirs(sdk_variant_dir_path)
+def get_sdk_store_dir():
+    cfg = dragon.get_json_config()
+    cfg_dedup = cfg.get("sdk_dedup", {}) if cfg else {}
 
+    enabled = _get_bool_option("MISSION_SDK_DEDUP", cfg_dedup, "enabled", False)
+    if not enabled:
+        return None
 
-def hook_download_base_sdk(task, args):
+    # Must be on the same file system as the sdk trees (hardlinks)
+    store_dir = os.environ.get("MISSION_SDK_STORE_DIR")
+    if not store_dir:
+        store_dir = cfg_dedup.get("dir", os.path.join(SDK_DIR_PATH, ".objects"))
+    return store_dir
+
+def download_base_sdk(variant, sdk_cache, store_dir):
     base_sdk_product = os.getenv("PARROT_BUILD_BASE_SDK_PRODUCT", DEFAULT_BASE_SDK_PRODUCT)
-    base_sdk_variant = os.getenv("PARROT_BUILD_BASE_SDK_VARIANT",
-                                 DEFAULT_BASE_SDK_VARIANT % dragon.VARIANT)
     base_sdk_version = os.getenv("PARROT_BUILD_BASE_SDK_VERSION", None)
+    if variant == dragon.VARIANT:
+        base_sdk_variant = os.getenv("PARROT_BUILD_BASE_SDK_VARIANT",
+                                     DEFAULT_BASE_SDK_VARIANT % variant)
+        base_sdk_sha256 = os.getenv("PARROT_BUILD_BASE_SDK_SHA256", None)
+        sdk_tar_path = SDK_TAR_PATH
+    else:
+        base_sdk_variant = DEFAULT_BASE_SDK_VARIANT % variant
+        base_sdk_sha256 = None
+        sdk_tar_path = WORKSPACE_DIR / ("sdk-%s.tar.gz" % variant)
 
     # get urls
     root_url = get_root_url(base_sdk_product, base_sdk_variant, base_sdk_version)
     sdk_url = f"{root_url}/{SDK_TAR_NAME}"
+    sdk_variant_dir_path = SDK_DIR_PATH / variant
 
-    # download sdk
-    download_file(sdk_url, outdirpath=WORKSPACE_DIR)
+    # download and extract sdk at the same time, the extracted tree replaces
+    # the previous one only once complete
+    try:
+        if sdk_cache:
+            sdk_cache.update(sdk_url, base_sdk_product, base_sdk_variant,
+                    base_sdk_version, sdk_variant_dir_path, base_sdk_sha256,
+                    evict=False)
+        else:
+            logging.info(f"Downloading file: {sdk_url}")
+            sdk.download_and_extract(sdk_url, sdk_tar_path,
+                    sdk_variant_dir_path, sha256=base_sdk_sha256)
+        if store_dir:
+            with timing.phase("sdk_dedup", variant) as counters:
+                linked, saved = sdk.dedup_tree(sdk_variant_dir_path, store_dir)
+                counters["files"], counters["bytes_saved"] = linked, saved
+            if linked:
+                logging.info("%s: %d files shared with other variants (%.1f MB)",
+                        variant, linked, saved / 1e6)
+        # Reused by the next hooks (set_versions, analyze_deps)
+        with timing.phase("sdk_index", variant):
+            sdk.load_index(sdk_variant_dir_path)
+    except (OSError, ValueError, tarfile.TarError) as ex:
+        raise TaskError(f"Failed to get base sdk from {sdk_url}: {ex}")
 
-    # extract sdk
-    sdk_variant_dir_path = SDK_DIR_PATH / dragon.VARIANT
-    logging.info(f"Extracting {SDK_TAR_NAME} into {sdk_variant_dir_path}")
-    dragon.exec_cmd(f"tar -xf {SDK_TAR_PATH} -C {sdk_variant_dir_path} --strip 1")
+def hook_download_base_sdk(task, args):
+    parser = dragon.TaskArgumentParser(task)
+    parser.add_argument("--variant",
+            dest="variants",
+            action="append",
+            metavar="VARIANT",
+            help="Also get the base sdk of another variant, can be repeated.")
+    options = parser.parse_args(args)
 
+    variants = [dragon.VARIANT]
+    for variant in options.variants or []:
+        if variant not in variants:
+            variants.append(variant)
 
-def hook_post_images(task, args):
-    task.call_base_post_hook(args)
+    sdk_cache = get_sdk_cache()
+    store_dir = get_sdk_store_dir()
+    with timing.recording("download-base-sdk", dragon.OUT_DIR):
+        with ThreadPoolExecutor(max_workers=len(variants)) as executor:
+            futures = [executor.submit(download_base_sdk, variant, sdk_cache,
+                    store_dir) for variant in variants]
+            for future in futures:
+                future.result()
+        try:
+            if sdk_cache:
+                sdk_cache.evict()
+            if store_dir:
+                freed = sdk.gc_store(store_dir)
+                if freed:
+                    logging.info("Removed %.1f MB of unused sdk files",
+                            freed / 1e6)
+        except OSError as ex:
+            logging.warning("Failed to clean sdk caches: %s", ex)
 
+
+def get_mission_dirs():
     missions_dir = os.path.join(dragon.FINAL_DIR, "missions")
     if not os.path.exists(missions_dir):
-        return
+        return []
 
-    for entry in os.listdir(missions_dir):
+    mission_dirs = []
+    for entry in sorted(os.listdir(missions_dir)):
         mission_dir = os.path.join(missions_dir, entry)
         if os.path.isdir(mission_dir):
-            gen_final(mission_dir)
-            set_versions(mission_dir)
-            gen_archive(mission_dir)
+            mission_dirs.append(mission_dir)
+    return mission_dirs
 
-def hook_sync(task, args):
-    parser = dragon.TaskArgumentParser(task)
+def get_size_options():
+    cfg = dragon.get_json_config()
+    cfg_size = cfg.get("size", {}) if cfg else {}
+
+    baseline = os.environ.get("MISSION_SIZE_BASELINE")
+    if not baseline:
+        baseline = cfg_size.get("baseline")
+
+    return {
+        "baseline": baseline,
+        "max_growth": _get_number_option("MISSION_SIZE_MAX_GROWTH", cfg_size,
+                "max_growth", None, float),
+        "top": _get_number_option("MISSION_SIZE_TOP", cfg_size, "top",
+                sizes.DEFAULT_TOP),
+    }
+
+def check_sizes(mission_dirs, size_options):
+    """
+    Write the size manifest of each mission in OUT_DIR and compare it with
+    the one in the baseline directory (a previous OUT_DIR), if any.
+    Raise TaskError if a compressed size grew more than allowed.
+    """
+    failures = []
+    for mission_dir in mission_dirs:
+        name = os.path.split(mission_dir)[1]
+        manifest_name = name.replace('.', '_') + "-size.json"
+        with timing.phase("size", name):
+            manifest = sizes.make_manifest(os.path.join(mission_dir, "payload"),
+                    os.path.join(dragon.IMAGES_DIR, name + ".tar.gz"),
+                    size_options["top"])
+            sizes.save_manifest(os.path.join(dragon.OUT_DIR, manifest_name),
+                    manifest)
+        logging.info("%s: payload %.1f MB, archive %.1f MB", name,
+                manifest["total_size"] / 1e6, manifest["compressed_size"] / 1e6)
+
+        if not size_options["baseline"]:
+            continue
+        baseline_path = os.path.join(size_options["baseline"], manifest_name)
+        if not os.path.exists(baseline_path):
+            logging.warning("%s: no size baseline '%s'", name, baseline_path)
+            continue
+        diff = sizes.diff_manifests(sizes.load_manifest(baseline_path),
+                manifest, size_options["top"])
+        sizes.save_manifest(os.path.join(dragon.OUT_DIR,
+                name.replace('.', '_') + "-size-diff.json"), diff)
+
+        growth = diff["compressed_size"]["growth"]
+        logging.info("%s: archive %+.1f%% since baseline (%.1f MB -> %.1f MB)",
+                name, growth, diff["compressed_size"]["baseline"] / 1e6,
+                diff["compressed_size"]["current"] / 1e6)
+        for relpath, delta in diff["files"]:
+            logging.info("  %+10.1f kB %s", delta / 1e3, relpath)
+        max_growth = size_options["max_growth"]
+        if max_growth is not None and growth > max_growth:
+            failures.append("%s (%+.1f%%)" % (name, growth))
+
+    if failures:
+        raise TaskError("Mission size grew more than %.1f%%: %s"
+                % (size_options["max_growth"], ", ".join(failures)))
+
+def hook_post_images(task, args):
+    task.call_base_post_hook(args)
+
+    mission_dirs = get_mission_dirs()
+    if not mission_dirs:
+        return
+
+    with timing.recording("images", dragon.OUT_DIR):
+        process_missions(mission_dirs, get_mission_jobs(),
+                get_packaging_options())
+        check_sizes(mission_dirs, get_size_options())
+
+def get_sync_options():
+    cfg = dragon.get_json_config()
+    cfg_sync = cfg.get("sync", {}) if cfg else {}
+
+    drones = os.environ.get("MISSION_SYNC_DRONES")
+    if drones:
+        drones = [drone for drone in drones.split(",") if drone]
+    else:
+        drones = cfg_sync.get("drones", [])
+
+    return {
+        "drones": drones,
+        "jobs": _get_number_option("MISSION_SYNC_JOBS", cfg_sync, "jobs", 0),
+        "retries": _get_number_option("MISSION_SYNC_RETRIES", cfg_sync,
+                "retries", sync.DEFAULT_RETRIES),
+        "timeout": _get_number_option("MISSION_SYNC_TIMEOUT", cfg_sync,
+                "timeout", sync.DEFAULT_TIMEOUT, float),
+        "upload_timeout": _get_number_option("MISSION_SYNC_UPLOAD_TIMEOUT",
+                cfg_sync, "upload_timeout", sync.DEFAULT_UPLOAD_TIMEOUT, float),
+    }
+
+def read_drones_file(path):
+    """
+    Read drone addresses, one per line, '#' starting a comment.
+    """
+    drones = []
+    with open(path, "r") as fd:
+        for line in fd:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                drones.append(line)
+    return drones
+
+def add_sync_arguments(parser, sync_options):
     parser.add_argument("--is-default",
             action="store_true",
             help="Set mission as default.")
@@ -308,26 +1019,272 @@ def hook_sync(task, args):
     parser.add_argument("--reboot",
             action="store_true",
             help="Reboot target after sync.")
+    parser.add_argument("--drone",
+            dest="drones",
+            action="append",
+            metavar="ADDRESS",
+            help="Address of a target (host[:port] or url), can be repeated.")
+    parser.add_argument("--drones-file",
+            metavar="FILE",
+            help="File with the addresses of the targets, one per line.")
+    parser.add_argument("--jobs",
+            type=int,
+            default=sync_options["jobs"],
+            help="Number of targets synchronized in parallel (default: all).")
+    parser.add_argument("--force",
+            action="store_true",
+            help="Upload missions even if already installed on the target.")
+
+def sync_missions(mission_dirs, options, sync_options):
+    """
+    Upload the archives of missions to the targets of the options.
+    Return the summaries of the targets (see sync.sync_drone).
+    Raise TaskError if a target failed.
+    """
+    missions = []
+    for mission_dir in mission_dirs:
+        entry = os.path.split(mission_dir)[1]
+        image_path = os.path.join(dragon.IMAGES_DIR, entry + ".tar.gz")
+        if not os.path.exists(image_path):
+            raise TaskError("Missing mission archive '%s'" % image_path)
+        with open(os.path.join(mission_dir, "mission.json"), "r") as fd:
+            json_cfg = json.load(fd)
+        missions.append({
+            "name": entry,
+            "path": image_path,
+            "uid": json_cfg.get("uid", entry),
+            "version": json_cfg.get("version"),
+            "build_sdk_version": json_cfg.get("build_sdk_version"),
+            "sha256": cache.hash_file(image_path),
+        })
+
+    drones = list(options.drones or [])
+    if options.drones_file:
+        drones += read_drones_file(options.drones_file)
+    if not drones:
+        drones = sync_options["drones"] or [DRONE_SERVER_URL]
+
+    state_path = os.path.join(dragon.OUT_DIR, "sync-state.json")
+    state = sync.load_state(state_path)
+    try:
+        results = sync.sync_fleet(drones, missions, state,
+                jobs=options.jobs,
+                is_default=options.is_default,
+                unsigned=options.unsigned,
+                reboot=options.reboot,
+                force=options.force,
+                timeout=sync_options["timeout"],
+                upload_timeout=sync_options["upload_timeout"],
+                retries=sync_options["retries"])
+    except (OSError, ValueError) as ex:
+        raise TaskError("Sync failed: %s" % ex)
+    finally:
+        sync.save_state(state_path, state)
+
+    sync.log_summary(results)
+    failed = [result["drone"] for result in results if result["failures"]]
+    if failed:
+        raise TaskError("Sync failed on %d target(s): %s"
+                % (len(failed), ", ".join(failed)))
+    return results
+
+def hook_sync(task, args):
+    sync_options = get_sync_options()
+
+    parser = dragon.TaskArgumentParser(task)
+    add_sync_arguments(parser, sync_options)
     options = parser.parse_args(args)
 
+    mission_dirs = get_mission_dirs()
+    if mission_dirs:
+        sync_missions(mission_dirs, options, sync_options)
+
+#===============================================================================
+#===============================================================================
+def get_archive_paths(paths):
+    """
+    Get the mission archives given as files or directories (all their
+    *.tar.gz), the archives of the built missions by default.
+    """
+    if not paths:
+        return [os.path.join(dragon.IMAGES_DIR,
+                os.path.split(mission_dir)[1] + ".tar.gz")
+                for mission_dir in get_mission_dirs()]
+    archive_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            archive_paths.extend(sorted(glob.glob(os.path.join(path, "*.tar.gz"))))
+        else:
+            archive_paths.append(path)
+    return archive_paths
+
+def log_verify_result(result, list_entries):
+    name = os.path.basename(result["path"])
+    mission = result["mission"] or {}
+    payload = result["payload"] or {}
+    signature = result["signature"] or {}
+    logging.info("%s: version %s, sdk %s (%s), target %s - %s, %s",
+            name, mission.get("version"), mission.get("build_sdk_version"),
+            mission.get("build_sdk_target_arch"),
+            mission.get("target_min_version"), mission.get("target_max_version"),
+            "signed (digests %s)" % signature["digests"] if signature
+                    else "not signed")
+    logging.info("%s: %.1f MB, %s %.1f MB -> %.1f MB, %d files, %.2fs", name,
+            result["size"] / 1e6, payload.get("format"),
+            payload.get("size", 0) / 1e6,
+            payload.get("compressed_size", 0) / 1e6,
+            payload.get("files", 0), result["duration"])
+    if list_entries:
+        for entry in payload.get("entries", []):
+            logging.info("  %12d %-8s %s", entry["size"], entry["type"],
+                    entry["name"])
+    for warning in result["warnings"]:
+        logging.warning("%s: %s", name, warning)
+    for error in result["errors"]:
+        logging.error("%s: %s", name, error)
+
+def hook_verify(task, args):
+    parser = dragon.TaskArgumentParser(task)
+    parser.add_argument("archives",
+            nargs="*",
+            metavar="ARCHIVE",
+            help="Mission archive or directory of archives"
+                    " (default: archives of the built missions).")
+    parser.add_argument("--jobs",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Number of archives verified in parallel.")
+    parser.add_argument("--json",
+            metavar="FILE",
+            help="Write the results in JSON format ('-' for stdout).")
+    parser.add_argument("--list",
+            action="store_true",
+            help="List the content of the payloads.")
+    parser.add_argument("--arch",
+            help="Expected build_sdk_target_arch.")
+    parser.add_argument("--sdk-version",
+            help="Expected build_sdk_version.")
+    parser.add_argument("--firmware",
+            metavar="VERSION",
+            help="Firmware version the missions must accept.")
+    parser.add_argument("--allow-unsigned",
+            action="store_true",
+            help="Do not require a signature.")
+    parser.add_argument("--allow-unchecked-signature",
+            action="store_true",
+            help="Only warn that the content of the signatures cannot be"
+                    " checked against the signed members (their digests are"
+                    " reported), instead of failing.")
+    options = parser.parse_args(args)
+
+    paths = get_archive_paths(options.archives)
+    results = verify.verify_archives(paths, jobs=options.jobs,
+            expected={
+                "build_sdk_target_arch": options.arch,
+                "build_sdk_version": options.sdk_version,
+            },
+            firmware=options.firmware,
+            signature_name=get_signature_name(),
+            require_signature=not options.allow_unsigned,
+            allow_unchecked_signature=options.allow_unchecked_signature,
+            algorithm=SIGNATURE_HASH)
+
+    for result in results:
+        log_verify_result(result, options.list)
+    if options.json == "-":
+        print(json.dumps(results, indent=4, sort_keys=True))
+    elif options.json:
+        with open(options.json, "w") as fd:
+            json.dump(results, fd, indent=4, sort_keys=True)
+
+    failed = [os.path.basename(result["path"]) for result in results
+            if result["errors"]]
+    if failed:
+        raise TaskError("Verification failed for %d archive(s): %s"
+                % (len(failed), ", ".join(failed)))
+    warned = sum(1 for result in results if result["warnings"])
+    logging.info("Verified %d archive(s)%s", len(results),
+            ", %d with warnings" % warned if warned else "")
+
+#===============================================================================
+#===============================================================================
+def _is_under(path, dir_path):
+    return path == dir_path or path.startswith(dir_path + os.sep)
+
+def get_watched_missions(changed, mission_dirs):
+    """
+    Get the missions affected by changed paths: a mission for changes in its
+    directory, all of them for changes in the staged directories.
+    """
     missions_dir = os.path.join(dragon.FINAL_DIR, "missions")
-    if not os.path.exists(missions_dir):
-        return
+    affected = set()
+    for path in changed:
+        for mission_dir in mission_dirs:
+            if _is_under(path, mission_dir):
+                affected.add(mission_dir)
+                break
+        else:
+            if not _is_under(path, missions_dir):
+                return mission_dirs
+    return [mission_dir for mission_dir in mission_dirs
+            if mission_dir in affected]
 
-    for entry in os.listdir(missions_dir):
-        mission_dir = os.path.join(missions_dir, entry)
-        if os.path.isdir(mission_dir):
-            url = "%s/mission/missions/?allow_downgrade=yes" % DRONE_SERVER_URL
-            if options.is_default:
-                url += "&is_default=yes"
-            if options.unsigned:
-                url += "&allow_unsigned=yes"
-            dragon.exec_cmd("curl -i -X PUT '%s' --data-binary @%s/%s.tar.gz"
-                % (url, dragon.IMAGES_DIR, entry))
+def hook_watch(task, args):
+    sync_options = get_sync_options()
+
+    parser = dragon.TaskArgumentParser(task)
+    parser.add_argument("--sync",
+            action="store_true",
+            help="Synchronize rebuilt missions with target.")
+    parser.add_argument("--interval",
+            type=float,
+            default=watch.DEFAULT_INTERVAL,
+            help="Seconds between two checks of the final dir.")
+    parser.add_argument("--debounce",
+            type=float,
+            default=watch.DEFAULT_DEBOUNCE,
+            help="Seconds without changes before rebuilding.")
+    add_sync_arguments(parser, sync_options)
+    options = parser.parse_args(args)
+
+    watched_dirs = [os.path.join(dragon.FINAL_DIR, "missions")] + \
+            [os.path.join(dragon.FINAL_DIR, src) for src in PAYLOAD_DIRSLIST]
+    watcher = watch.Watcher(watched_dirs, options.interval, options.debounce)
+    packaging_options = get_packaging_options()
+    logging.info("Watching %s", ", ".join(watched_dirs))
 
-    if options.reboot:
-        url = "%s/system/reboot" % DRONE_SERVER_URL
-        dragon.exec_cmd("curl -i -X PUT '%s'" % url)
+    pending = set()
+    try:
+        while True:
+            changed = pending | watcher.wait()
+            mission_dirs = get_watched_missions(changed, get_mission_dirs())
+            if not mission_dirs:
+                pending = set()
+                continue
+
+            start = time.monotonic()
+            try:
+                with timing.recording("watch", dragon.OUT_DIR):
+                    process_missions(mission_dirs, get_mission_jobs(),
+                            packaging_options)
+                if options.sync:
+                    sync_missions(mission_dirs, options, sync_options)
+                logging.info("Updated %s in %.1fs",
+                        ", ".join(os.path.split(mission_dir)[1]
+                                for mission_dir in mission_dirs),
+                        time.monotonic() - start)
+            except (TaskError, OSError, ValueError,
+                    subprocess.CalledProcessError) as ex:
+                # Keep watching, the next change may fix it
+                logging.error("Update failed: %s", ex)
+
+            # Ignore what was written in the missions, keep the changes made
+            # elsewhere during the update for the next one
+            pending = set(path for path in watcher.poll()
+                    if not any(_is_under(path, mission_dir)
+                            for mission_dir in mission_dirs))
+    except KeyboardInterrupt:
+        logging.info("Watch stopped")
 
 #===============================================================================
 #===============================================================================
@@ -354,3 +1311,17 @@ def setup_deftasks():
         exechook=hook_sync,
         weak=True
     )
+
+    dragon.add_meta_task(
+        name="verify",
+        desc="Check mission archives without extracting them",
+        exechook=hook_verify,
+        weak=True
+    )
+
+    dragon.add_meta_task(
+        name="watch",
+        desc="Rebuild and optionally synchronize missions when they change",
+        exechook=hook_watch,
+        weak=True
+    )
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import threading
+
+from . import common
+
+# Bump when the archive layout changes to invalidate all cached archives
+MANIFEST_VERSION = 1
+
+DEFAULT_MAX_SIZE_MB = 2048
+
+# Fields of a file entry that are only used to avoid hashing unchanged files
+_STAT_FIELDS = ("mtime_ns", "ino")
+
+#===============================================================================
+#===============================================================================
+def hash_file(path, algorithm="sha256"):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as fin:
+        while True:
+            data = fin.read(common.BUFSIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+#===============================================================================
+#===============================================================================
+def scan_payload(payload_dir, previous=None):
+    """
+    List all entries of a payload directory with their path, type, size, mode
+    and content hash (or link target for symlinks).
+    previous: file entries of a previous scan, the hash of regular files with
+    the same size, mtime and inode is reused instead of being computed again.
+    """
+    known = {entry["path"]: entry for entry in previous or []}
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(payload_dir):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, payload_dir)
+            st = os.lstat(path)
+            entry = {
+                "path": relpath,
+                "mode": stat.S_IMODE(st.st_mode),
+            }
+            if stat.S_ISLNK(st.st_mode):
+                entry["type"] = "link"
+                entry["target"] = os.readlink(path)
+            elif stat.S_ISDIR(st.st_mode):
+                entry["type"] = "dir"
+            else:
+                entry["type"] = "file"
+                entry["size"] = st.st_size
+                entry["mtime_ns"] = st.st_mtime_ns
+                entry["ino"] = st.st_ino
+                old = known.get(relpath)
+                if old and old.get("type") == "file" and \
+                        all(old.get(k) == entry.get(k)
+                            for k in ("size",) + _STAT_FIELDS):
+                    entry["sha256"] = old["sha256"]
+                else:
+                    entry["sha256"] = hash_file(path)
+            entries.append(entry)
+    return entries
+
+#===============================================================================
+#===============================================================================
+def make_manifest(payload_dir, mission_json_path, key_id, compression,
+        previous=None):
+    """
+    Build the manifest of everything that influences a mission archive.
+    previous: manifest of the previous build, to avoid hashing unchanged files.
+    """
+    with open(mission_json_path, "r") as fd:
+        mission_json = fd.read()
+    return {
+        "version": MANIFEST_VERSION,
+        "mission_json": mission_json,
+        "key_id": key_id,
+        "compression": compression,
+        "files": scan_payload(payload_dir,
+                previous.get("files") if previous else None),
+    }
+
+def manifest_digest(manifest):
+    content = dict(manifest)
+    content["files"] = [
+        {k: v for k, v in entry.items() if k not in _STAT_FIELDS}
+        for entry in manifest["files"]
+    ]
+    data = json.dumps(content, sort_keys=True).encode("UTF-8")
+    return hashlib.sha256(data).hexdigest()
+
+def load_manifest(path):
+    try:
+        with open(path, "r") as fd:
+            manifest = json.load(fd)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def save_manifest(path, manifest, digest, image_path):
+    """
+    Save the manifest with its digest and the stat of the archive built from
+    it, to check that the archive was not replaced or modified since.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fd:
+        json.dump(dict(manifest, digest=digest, image=image_stat(image_path)),
+                fd, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def image_stat(path):
+    """
+    Get the size and mtime of an archive, None if it does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def remove_manifest(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+#===============================================================================
+#===============================================================================
+def install_file(src_path, dst_path):
+    """
+    Atomically make dst_path a hardlink (or a copy) of src_path.
+    """
+    tmp_path = dst_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+#===============================================================================
+#===============================================================================
+class ArchiveCache:
+    """
+    Directory of mission archives indexed by manifest digest, with least
+    recently used archives evicted when its size exceeds max_size bytes.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def _path(self, digest):
+        return os.path.join(self.cache_dir, digest + ".tar.gz")
+
+    def lookup(self, digest):
+        path = self._path(digest)
+        try:
+            # Mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def store(self, digest, archive_path):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        install_file(archive_path, self._path(digest))
+        self.evict()
+
+    def evict(self):
+        with ArchiveCache._lock:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if not entry.name.endswith(".tar.gz"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                logging.info("Evicting cached archive '%s'", path)
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
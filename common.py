@@ -0,0 +1,2 @@
+# Size of the buffers used to read, write and copy files and streams
+BUFSIZE = 1024 * 1024
@@ -0,0 +1,580 @@
+import collections
+import gzip
+import lzma
+import os
+import shutil
+import struct
+import subprocess
+import threading
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_GZIP = "gzip"
+BACKEND_PARALLEL = "parallel"
+BACKENDS = (BACKEND_GZIP, BACKEND_PARALLEL)
+
+FORMAT_GZIP = "gzip"
+FORMAT_ZSTD = "zstd"
+FORMAT_XZ = "xz"
+FORMAT_NONE = "none"
+FORMATS = (FORMAT_GZIP, FORMAT_ZSTD, FORMAT_XZ, FORMAT_NONE)
+
+# Chosen per mission by sampling its payload (see choose_options)
+FORMAT_AUTO = "auto"
+
+# File name extension of each format
+EXTENSIONS = {
+    FORMAT_GZIP: ".gz",
+    FORMAT_ZSTD: ".zst",
+    FORMAT_XZ: ".xz",
+    FORMAT_NONE: "",
+}
+
+# Same level as the gzip(1) and 'tar -z' defaults
+DEFAULT_LEVEL = 6
+
+# Default level and range of levels of each format
+_LEVELS = {
+    FORMAT_GZIP: (DEFAULT_LEVEL, 1, 9),
+    FORMAT_ZSTD: (3, 1, 19),
+    FORMAT_XZ: (6, 0, 9),
+    FORMAT_NONE: (0, 0, 0),
+    FORMAT_AUTO: (0, 0, 0),
+}
+
+# Candidates of the automatic selection
+AUTO_CANDIDATES = [
+    (FORMAT_NONE, 0),
+    (FORMAT_GZIP, 1),
+    (FORMAT_GZIP, 6),
+    (FORMAT_GZIP, 9),
+    (FORMAT_ZSTD, 3),
+    (FORMAT_ZSTD, 9),
+    (FORMAT_ZSTD, 19),
+    (FORMAT_XZ, 1),
+    (FORMAT_XZ, 6),
+]
+
+# Size of the blocks compressed independently by the parallel backend
+PARALLEL_BLOCK_SIZE = 1024 * 1024
+
+# Deflate window, the tail of the previous block is used as dictionary
+_WINDOW_SIZE = 32 * 1024
+
+#===============================================================================
+#===============================================================================
+class Options:
+    """
+    Compression settings.
+    backend: 'gzip' (single thread) or 'parallel' (block-parallel gzip).
+    level: compression level of the payload format (1-9 for gzip, 1-19 for
+    zstd, 0-9 for xz), default of the format if None, ignored for 'none'
+    and 'auto' (chosen with the format).
+    threads: number of threads used by the 'parallel' backend and zstd.
+    format: format of the payload, 'gzip', 'zstd', 'xz', 'none' or 'auto'.
+    gzip_level: level of the gzip compression of the mission archive (and
+    of the payload when its format is gzip and level is None), level for
+    gzip or DEFAULT_LEVEL if None.
+    """
+    def __init__(self, backend=BACKEND_GZIP, level=None, threads=None,
+            format=FORMAT_GZIP, gzip_level=None):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown compression backend: '%s'" % backend)
+        if format not in FORMATS + (FORMAT_AUTO,):
+            raise ValueError("Unknown compression format: '%s'" % format)
+        if format == FORMAT_GZIP:
+            if gzip_level is None:
+                gzip_level = level
+            elif level is None:
+                level = gzip_level
+        if format in (FORMAT_NONE, FORMAT_AUTO):
+            level = None
+        self.backend = backend
+        self.level = _check_level(format, level)
+        self.threads = int(threads) if threads else (os.cpu_count() or 1)
+        self.format = format
+        self.gzip_level = _check_level(FORMAT_GZIP, gzip_level)
+
+    def with_format(self, format, level=None):
+        return Options(self.backend, level, self.threads, format,
+                self.gzip_level)
+
+    @property
+    def id(self):
+        """
+        Identify the settings that change the compressed output.
+        """
+        if self.format == FORMAT_GZIP:
+            payload_id = "%s:%d" % (self.backend, self.level)
+            if self.level == self.gzip_level:
+                return payload_id
+        else:
+            payload_id = "%s:%d" % (self.format, self.level)
+        return "%s+%s:%d" % (payload_id, self.backend, self.gzip_level)
+
+    def __repr__(self):
+        if self.format == FORMAT_GZIP and self.level == self.gzip_level:
+            return "%s(level=%d, threads=%d)" % (self.backend, self.level,
+                    self.threads)
+        return "%s(level=%d, threads=%d, %s level=%d)" % (self.format,
+                self.level, self.threads, self.backend, self.gzip_level)
+
+def _check_level(format, level):
+    default_level, min_level, max_level = _LEVELS[format]
+    level = default_level if level is None else int(level)
+    if level < min_level or level > max_level:
+        raise ValueError("Invalid %s compression level: %d" % (format, level))
+    return level
+
+#===============================================================================
+#===============================================================================
+class _CountingFile:
+    """
+    Minimal write-only file wrapper counting the bytes written.
+    """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self._fileobj.write(data)
+
+    def flush(self):
+        self._fileobj.flush()
+
+#===============================================================================
+#===============================================================================
+def _compress_block(block, zdict, level, last):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(
+            zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+#===============================================================================
+#===============================================================================
+class ParallelGzipFile:
+    """
+    Write-only gzip file compressing fixed size blocks in a pool of threads
+    (zlib releases the GIL). Each block is deflated with the tail of the
+    previous one as dictionary and ends with a sync flush, so the result is a
+    single standard gzip member that any gzip decoder can read.
+    """
+    def __init__(self, fileobj, level=DEFAULT_LEVEL, threads=1,
+            filename="", mtime=0, blocksize=PARALLEL_BLOCK_SIZE):
+        self._fileobj = fileobj
+        self._level = level
+        self._blocksize = blocksize
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._pending = collections.deque()
+        self._max_pending = 2 * threads
+        self._buf = bytearray()
+        self._zdict = None
+        self._crc = 0
+        self._size = 0
+        self._closed = False
+        self._write_header(filename, mtime)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    def _write_header(self, filename, mtime):
+        fname = os.path.basename(filename).encode("latin-1") if filename else b""
+        flags = gzip.FNAME if fname else 0
+        xfl = 2 if self._level == 9 else 4 if self._level == 1 else 0
+        self._fileobj.write(b"\x1f\x8b\x08" + struct.pack("<BIBB",
+                flags, int(mtime), xfl, 255))
+        if fname:
+            self._fileobj.write(fname + b"\x00")
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(_compress_block,
+                block, self._zdict, self._level, False))
+        self._zdict = block[-_WINDOW_SIZE:]
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def write(self, data):
+        if self._closed:
+            raise ValueError("write() on closed ParallelGzipFile")
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buf += data
+        while len(self._buf) >= self._blocksize:
+            self._submit(bytes(self._buf[:self._blocksize]))
+            del self._buf[:self._blocksize]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            if self._buf:
+                self._submit(bytes(self._buf))
+                self._buf = bytearray()
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+            # Empty final block to terminate the deflate stream
+            self._fileobj.write(_compress_block(b"", None, self._level, True))
+            self._fileobj.write(struct.pack("<II",
+                    self._crc, self._size & 0xffffffff))
+        finally:
+            self._closed = True
+            self._executor.shutdown()
+
+    def _abort(self):
+        self._closed = True
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown()
+
+#===============================================================================
+#===============================================================================
+class _XzFile:
+    """
+    Write-only xz stream.
+    """
+    def __init__(self, fileobj, level):
+        self._fileobj = fileobj
+        self._compressor = lzma.LZMACompressor(format=lzma.FORMAT_XZ,
+                check=lzma.CHECK_CRC64, preset=level)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write(self, data):
+        self._fileobj.write(self._compressor.compress(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._compressor is not None:
+            self._fileobj.write(self._compressor.flush())
+            self._compressor = None
+
+class _ZstdFile:
+    """
+    Write-only zstd stream compressed by a zstd(1) process. Its output is the
+    same whatever the number of threads.
+    """
+    def __init__(self, fileobj, level, threads):
+        zstd = shutil.which("zstd")
+        if not zstd:
+            raise OSError("zstd not found")
+        self._fileobj = fileobj
+        self._process = subprocess.Popen(
+                [zstd, "-q", "-c", "-%d" % level, "-T%d" % threads],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._error = None
+        self._reader = threading.Thread(target=self._read)
+        self._reader.start()
+
+    def _read(self):
+        try:
+            while True:
+                data = self._process.stdout.read(PARALLEL_BLOCK_SIZE)
+                if not data:
+                    break
+                self._fileobj.write(data)
+        except BaseException as ex:
+            self._error = ex
+            # Unblock the writer
+            self._process.kill()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._process.kill()
+            self._process.stdin.close()
+            self._reader.join()
+            self._process.wait()
+
+    def write(self, data):
+        self._process.stdin.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._process.stdin.closed:
+            return
+        self._process.stdin.close()
+        self._reader.join()
+        if self._error:
+            raise self._error
+        if self._process.wait() != 0:
+            raise OSError("zstd failed with status %d" % self._process.returncode)
+
+class _RawFile:
+    """
+    Write-only stream without compression.
+    """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def write(self, data):
+        return self._fileobj.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def is_available(format):
+    if format == FORMAT_ZSTD:
+        return shutil.which("zstd") is not None
+    return format in FORMATS
+
+#===============================================================================
+#===============================================================================
+class Writer:
+    """
+    Write-only compressed stream in the format and with the backend selected
+    by options, keeping track of the number of bytes before (bytes_in) and
+    after (bytes_out) compression.
+    """
+    def __init__(self, fileobj, options, filename="", mtime=0):
+        self._out = _CountingFile(fileobj)
+        self._file = self._open(options, filename, mtime)
+        self.bytes_in = 0
+
+    def _open(self, options, filename, mtime):
+        if options.format == FORMAT_ZSTD:
+            return _ZstdFile(self._out, options.level, options.threads)
+        if options.format == FORMAT_XZ:
+            return _XzFile(self._out, options.level)
+        if options.format == FORMAT_NONE:
+            return _RawFile(self._out)
+        if options.format != FORMAT_GZIP:
+            raise ValueError("Unresolved compression format: '%s'"
+                    % options.format)
+        return self._open_gzip(options, filename, mtime)
+
+    def _open_gzip(self, options, filename, mtime):
+        if options.backend == BACKEND_PARALLEL:
+            return ParallelGzipFile(self._out, level=options.level,
+                    threads=options.threads, filename=filename, mtime=mtime)
+        return gzip.GzipFile(filename=filename, mode="wb",
+                fileobj=self._out, compresslevel=options.level, mtime=mtime)
+
+    @property
+    def bytes_out(self):
+        return self._out.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.__exit__(exc_type, exc_value, traceback)
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class GzipWriter(Writer):
+    """
+    Writer always using gzip at the gzip_level of options, whatever the
+    format of the payload.
+    """
+    def _open(self, options, filename, mtime):
+        return self._open_gzip(options.with_format(FORMAT_GZIP,
+                options.gzip_level), filename, mtime)
+
+#===============================================================================
+#===============================================================================
+class _ZstdReader:
+    """
+    Read-only zstd stream decompressed by a zstd(1) process, fed from
+    fileobj by a thread.
+    """
+    def __init__(self, fileobj):
+        zstd = shutil.which("zstd")
+        if not zstd:
+            raise OSError("zstd not found")
+        self._fileobj = fileobj
+        self._process = subprocess.Popen([zstd, "-q", "-d", "-c"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._error = None
+        self._feeder = threading.Thread(target=self._feed)
+        self._feeder.start()
+
+    def _feed(self):
+        try:
+            while True:
+                data = self._fileobj.read(PARALLEL_BLOCK_SIZE)
+                if not data:
+                    break
+                self._process.stdin.write(data)
+        except BrokenPipeError:
+            # Invalid stream, reported by the exit status
+            pass
+        except BaseException as ex:
+            self._error = ex
+            self._process.kill()
+        finally:
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._process.kill()
+            self._process.stdout.close()
+            self._feeder.join()
+            self._process.wait()
+
+    def read(self, size=-1):
+        return self._process.stdout.read(size)
+
+    def close(self):
+        if self._process.stdout.closed:
+            return
+        # Let the process write the end of its output to be able to exit
+        while self._process.stdout.read(PARALLEL_BLOCK_SIZE):
+            pass
+        self._process.stdout.close()
+        self._feeder.join()
+        if self._error:
+            raise self._error
+        if self._process.wait() != 0:
+            raise OSError("zstd failed with status %d" % self._process.returncode)
+
+class _RawReader:
+    """
+    Read-only stream without compression.
+    """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def read(self, size=-1):
+        return self._fileobj.read(size)
+
+    def close(self):
+        pass
+
+def open_reader(fileobj, format):
+    """
+    Read-only decompressed stream of fileobj in the given format, read
+    sequentially.
+    """
+    if format == FORMAT_GZIP:
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    if format == FORMAT_XZ:
+        return lzma.LZMAFile(fileobj, mode="rb")
+    if format == FORMAT_ZSTD:
+        return _ZstdReader(fileobj)
+    if format == FORMAT_NONE:
+        return _RawReader(fileobj)
+    raise ValueError("Unknown compression format: '%s'" % format)
+
+#===============================================================================
+#===============================================================================
+class _NullFile:
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+def compare_versions(version, other):
+    def parse(value):
+        parts = []
+        for field in str(value).split("-", 1)[0].split("."):
+            digits = "".join(c for c in field if c.isdigit())
+            parts.append(int(digits) if digits else 0)
+        return parts
+    left, right = parse(version), parse(other)
+    return (left > right) - (left < right)
+
+def get_allowed_formats(target_min_version, min_firmware):
+    """
+    Get the formats supported by all the firmwares a mission can be installed
+    on. gzip is always supported, others only when they are in min_firmware
+    (format -> first firmware version supporting it) and target_min_version
+    is known and not older.
+    """
+    allowed = [FORMAT_GZIP]
+    for format in FORMATS:
+        if format == FORMAT_GZIP or not is_available(format):
+            continue
+        version = min_firmware.get(format)
+        if version is None or not target_min_version:
+            continue
+        if compare_versions(target_min_version, version) >= 0:
+            allowed.append(format)
+    return allowed
+
+def choose_options(options, sample, total_size, bandwidth, formats):
+    """
+    Choose the format and level minimizing the estimated time to compress a
+    payload of total_size bytes and to transfer it over a link of bandwidth
+    bytes/s, from the compression of a sample of the payload with each
+    candidate (AUTO_CANDIDATES) of the allowed formats.
+    Return the options and the estimations (list of dicts).
+    """
+    estimations = []
+    for format, level in AUTO_CANDIDATES:
+        if format not in formats:
+            continue
+        candidate = options.with_format(format, level)
+        start = time.monotonic()
+        with Writer(_NullFile(), candidate) as writer:
+            writer.write(sample)
+        duration = max(time.monotonic() - start, 1e-6)
+        ratio = writer.bytes_out / len(sample) if sample else 1.0
+        # The sample is too small for the parallel backend to use its threads
+        if format == FORMAT_GZIP and options.backend == BACKEND_PARALLEL:
+            duration /= options.threads
+        compress_time = duration * total_size / len(sample) if sample else 0.0
+        transfer_time = total_size * ratio / bandwidth
+        estimations.append({
+            "format": format,
+            "level": level,
+            "ratio": ratio,
+            "compress_time": compress_time,
+            "transfer_time": transfer_time,
+            "total_time": compress_time + transfer_time,
+        })
+    best = min(estimations, key=lambda estimation: estimation["total_time"])
+    return (options.with_format(best["format"], best["level"]), estimations)
@@ -0,0 +1,307 @@
+import json
+import os
+import stat
+import struct
+
+from . import cache
+
+_ELF_MAGIC = b"\x7fELF"
+
+_ET_EXEC = 2
+
+_PT_LOAD = 1
+_PT_DYNAMIC = 2
+_PT_INTERP = 3
+
+_DT_NULL = 0
+_DT_NEEDED = 1
+_DT_STRTAB = 5
+_DT_SONAME = 14
+_DT_RPATH = 15
+_DT_RUNPATH = 29
+
+# Layout of the ELF structures for 32/64 bits
+_EHDR_FMT = {1: "HHIIIIIHHHHHH", 2: "HHIQQQIHHHHHH"}
+_PHDR_FMT = {1: "IIIIIIII", 2: "IIQQQQQQ"}
+_DYN_FMT = {1: "iI", 2: "qQ"}
+
+# Subdirectories of the payload whose ELF files are loaded with dlopen
+# (GStreamer plugins, python extensions) or executed, so always reachable
+_ROOT_DIRS = ("lib/gstreamer-1.0", "python", "services")
+
+# Bump when the content of a cache entry changes
+_CACHE_VERSION = 1
+
+#===============================================================================
+#===============================================================================
+def is_elf(path):
+    with open(path, "rb") as fin:
+        return fin.read(4) == _ELF_MAGIC
+
+def read_dynamic(path):
+    """
+    Read the dynamic section of an ELF file.
+    Return a dict with 'executable' (has a program interpreter or is not
+    relocatable), 'needed', 'soname', 'rpath' and 'runpath', or None if the
+    file is not an ELF file.
+    """
+    with open(path, "rb") as fin:
+        ident = fin.read(16)
+        if len(ident) < 16 or ident[:4] != _ELF_MAGIC or \
+                ident[4] not in (1, 2) or ident[5] not in (1, 2):
+            return None
+        elf_class = ident[4]
+        endian = "<" if ident[5] == 1 else ">"
+
+        ehdr_fmt = endian + _EHDR_FMT[elf_class]
+        ehdr = struct.unpack(ehdr_fmt, fin.read(struct.calcsize(ehdr_fmt)))
+        e_type, e_phoff, e_phentsize, e_phnum = ehdr[0], ehdr[4], ehdr[8], ehdr[9]
+
+        phdr_fmt = endian + _PHDR_FMT[elf_class]
+        loads = []
+        dynamic = None
+        interp = False
+        fin.seek(e_phoff)
+        phdrs = fin.read(e_phentsize * e_phnum)
+        for i in range(e_phnum):
+            fields = struct.unpack_from(phdr_fmt, phdrs, i * e_phentsize)
+            if elf_class == 1:
+                p_type, p_offset, p_vaddr, _, p_filesz = fields[:5]
+            else:
+                p_type, _, p_offset, p_vaddr, _, p_filesz = fields[:6]
+            if p_type == _PT_LOAD:
+                loads.append((p_vaddr, p_filesz, p_offset))
+            elif p_type == _PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+            elif p_type == _PT_INTERP:
+                interp = True
+
+        info = {
+            "executable": interp or e_type == _ET_EXEC,
+            "needed": [],
+            "soname": None,
+            "rpath": [],
+            "runpath": [],
+        }
+        if dynamic is None:
+            return info
+
+        dyn_fmt = endian + _DYN_FMT[elf_class]
+        dyn_size = struct.calcsize(dyn_fmt)
+        fin.seek(dynamic[0])
+        data = fin.read(dynamic[1])
+        entries = []
+        strtab = None
+        for offset in range(0, len(data) - dyn_size + 1, dyn_size):
+            tag, value = struct.unpack_from(dyn_fmt, data, offset)
+            if tag == _DT_NULL:
+                break
+            if tag == _DT_STRTAB:
+                strtab = value
+            entries.append((tag, value))
+        if strtab is None:
+            return info
+
+        # Address of the string table to file offset
+        for vaddr, filesz, file_offset in loads:
+            if vaddr <= strtab < vaddr + filesz:
+                strtab = strtab - vaddr + file_offset
+                break
+        else:
+            return info
+
+        def read_string(offset):
+            fin.seek(strtab + offset)
+            chunk = b""
+            while b"\0" not in chunk:
+                data = fin.read(256)
+                if not data:
+                    break
+                chunk += data
+            return chunk.split(b"\0", 1)[0].decode(errors="replace")
+
+        for tag, value in entries:
+            if tag == _DT_NEEDED:
+                info["needed"].append(read_string(value))
+            elif tag == _DT_SONAME:
+                info["soname"] = read_string(value)
+            elif tag == _DT_RPATH:
+                info["rpath"] = read_string(value).split(":")
+            elif tag == _DT_RUNPATH:
+                info["runpath"] = read_string(value).split(":")
+        return info
+
+#===============================================================================
+#===============================================================================
+class InfoCache:
+    """
+    Dynamic section info of files indexed by content hash, the hash of a
+    path being reused while its size, mtime and inode do not change.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._hashes = {}
+        self._infos = {}
+        try:
+            with open(path, "r") as fd:
+                content = json.load(fd)
+            if content.get("version") == _CACHE_VERSION:
+                self._hashes = content["hashes"]
+                self._infos = content["infos"]
+        except (OSError, ValueError, KeyError):
+            pass
+        self._used = set()
+
+    def get(self, path, st):
+        """
+        Get the dynamic section info of a file, None if it is not an ELF
+        file (only ELF files are hashed, the others being most of a payload).
+        """
+        key = "%d:%d:%d" % (st.st_size, st.st_mtime_ns, st.st_ino)
+        known = self._hashes.get(path)
+        if known and known[0] == key:
+            digest = known[1]
+        else:
+            digest = cache.hash_file(path) if is_elf(path) else None
+            self._hashes[path] = (key, digest)
+        self._used.add(path)
+        if digest is None:
+            return None
+        if digest not in self._infos:
+            self._infos[digest] = read_dynamic(path)
+        return self._infos[digest]
+
+    def save(self):
+        # Only keep the entries of the files seen during this run
+        hashes = {path: self._hashes[path] for path in self._used}
+        digests = set(value[1] for value in hashes.values())
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump({
+                "version": _CACHE_VERSION,
+                "hashes": hashes,
+                "infos": {k: v for k, v in self._infos.items() if k in digests},
+            }, fd)
+        os.replace(tmp_path, self.path)
+
+#===============================================================================
+#===============================================================================
+def _is_under(path, dir_path):
+    return path == dir_path or path.startswith(dir_path + os.sep)
+
+def _search_dirs(paths, origin, sysroot_dir):
+    """
+    Map rpath/runpath entries to host directories: $ORIGIN relative to the
+    location of the object in the payload, absolute paths (of the target)
+    into the sysroot. Other entries (relative to the working directory of
+    the process on the target) cannot be resolved and are ignored.
+    """
+    dirs = []
+    for path in paths:
+        if "$ORIGIN" in path or "${ORIGIN}" in path:
+            dirs.append(path.replace("${ORIGIN}", origin)
+                    .replace("$ORIGIN", origin))
+        elif os.path.isabs(path) and sysroot_dir:
+            dirs.append(os.path.join(sysroot_dir, path.lstrip("/")))
+    return dirs
+
+def analyze(payload_dir, sysroot_libs, info_cache, sysroot_dir=None):
+    """
+    Build the dependency graph of the ELF files of a payload, starting from
+    executables and from dlopened modules (see _ROOT_DIRS), and resolving
+    DT_NEEDED entries with the rpath/runpath of each object (relative to
+    its location in the payload, or absolute paths in sysroot_dir), then in
+    payload/lib and then in the sysroot libraries (file name or soname ->
+    path). Libraries of the host are never used.
+    Return a dict with the 'roots', 'reachable' and 'unreachable' payload
+    files (relative paths) and the 'unresolved' dependencies of each object.
+    """
+    payload_dir = os.path.realpath(payload_dir)
+    if sysroot_dir:
+        sysroot_dir = os.path.realpath(sysroot_dir)
+    objects = {}
+    for dirpath, _, filenames in os.walk(payload_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            try:
+                info = info_cache.get(path, st)
+            except (OSError, struct.error):
+                continue
+            if info is not None:
+                objects[path] = info
+
+    def is_root(path, info):
+        relpath = os.path.relpath(path, payload_dir)
+        return info["executable"] or any(
+                relpath.startswith(root_dir + "/") for root_dir in _ROOT_DIRS)
+
+    def resolve(path, name, inherited_rpath):
+        info = objects[path]
+        origin = os.path.dirname(path)
+        dirs = _search_dirs(info["runpath"], origin, sysroot_dir)
+        if not info["runpath"]:
+            dirs = _search_dirs(info["rpath"], origin, sysroot_dir) + \
+                    inherited_rpath
+        dirs.append(os.path.join(payload_dir, "lib"))
+        for dirpath in dirs:
+            candidate = os.path.realpath(os.path.join(dirpath, name))
+            # $ORIGIN/.. or symlinks may lead out of the payload and sysroot
+            if (_is_under(candidate, payload_dir) or (sysroot_dir and
+                    _is_under(candidate, sysroot_dir))) and \
+                    os.path.exists(candidate):
+                return candidate
+        return sysroot_libs.get(name)
+
+    roots = sorted(path for path, info in objects.items() if is_root(path, info))
+    reachable = set()
+    unresolved = {}
+    pending = [(path, []) for path in roots]
+    while pending:
+        path, inherited_rpath = pending.pop()
+        if path in reachable:
+            continue
+        reachable.add(path)
+        info = objects[path]
+        # DT_RPATH (unlike DT_RUNPATH) also applies to dependencies
+        if not info["runpath"]:
+            inherited_rpath = inherited_rpath + _search_dirs(
+                    info["rpath"], os.path.dirname(path), sysroot_dir)
+        for name in info["needed"]:
+            dep_path = resolve(path, name, inherited_rpath)
+            if dep_path is None:
+                relpath = os.path.relpath(path, payload_dir)
+                unresolved.setdefault(relpath, []).append(name)
+            elif dep_path in objects:
+                pending.append((dep_path, inherited_rpath))
+
+    def relpaths(paths):
+        return sorted(os.path.relpath(path, payload_dir) for path in paths)
+
+    return {
+        "roots": relpaths(roots),
+        "reachable": relpaths(reachable),
+        "unreachable": relpaths(set(objects) - reachable),
+        "unresolved": unresolved,
+    }
+
+def prune(payload_dir, unreachable):
+    """
+    Remove unreachable files from a payload, with the symlinks to them.
+    Return the number of bytes removed.
+    """
+    removed = set()
+    size = 0
+    for relpath in unreachable:
+        path = os.path.join(payload_dir, relpath)
+        size += os.lstat(path).st_size
+        os.unlink(path)
+        removed.add(os.path.realpath(path))
+    for dirpath, _, filenames in os.walk(payload_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path) and os.path.realpath(path) in removed:
+                os.unlink(path)
+    return size
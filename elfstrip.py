@@ -0,0 +1,75 @@
+import os
+import shutil
+import stat
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+_ELF_MAGIC = b"\x7fELF"
+
+#===============================================================================
+#===============================================================================
+def is_elf(path):
+    try:
+        with open(path, "rb") as fin:
+            return fin.read(4) == _ELF_MAGIC
+    except OSError:
+        return False
+
+def find_elf_files(root_dir):
+    """
+    List the regular ELF files under root_dir (symlinks are ignored).
+    """
+    paths = []
+    for dirpath, _, filenames in os.walk(root_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and is_elf(path):
+                paths.append(path)
+    return sorted(paths)
+
+#===============================================================================
+#===============================================================================
+def strip_file(objcopy, path, debug_path):
+    """
+    Save the debug info of an ELF file in debug_path then strip it. The file
+    is replaced (not modified in place, it may be a hardlink to the staging).
+    Return the number of bytes saved, 0 if the file was left untouched.
+    """
+    os.makedirs(os.path.dirname(debug_path), exist_ok=True)
+    stripped_path = path + ".stripped"
+    try:
+        subprocess.run([objcopy, "--only-keep-debug", path, debug_path],
+                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        subprocess.run([objcopy, "--strip-unneeded",
+                "--add-gnu-debuglink=%s" % debug_path, path, stripped_path],
+                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        saved = os.path.getsize(path) - os.path.getsize(stripped_path)
+        if saved <= 0:
+            # Already stripped
+            os.unlink(debug_path)
+            return 0
+        shutil.copystat(path, stripped_path)
+        os.replace(stripped_path, path)
+        return saved
+    finally:
+        if os.path.exists(stripped_path):
+            os.unlink(stripped_path)
+
+def strip_dir(root_dir, debug_dir, objcopy="objcopy", jobs=None):
+    """
+    Strip all ELF files under root_dir in parallel, their debug info being
+    saved in debug_dir as '<relative path>.debug'.
+    Return the number of files stripped and of bytes saved.
+    """
+    paths = find_elf_files(root_dir)
+
+    def worker(path):
+        relpath = os.path.relpath(path, root_dir)
+        return strip_file(objcopy, path,
+                os.path.join(debug_dir, relpath + ".debug"))
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        saved = list(executor.map(worker, paths))
+    return (sum(1 for size in saved if size > 0), sum(saved))
@@ -3,26 +3,34 @@
 import argparse
 import binascii
 import hashlib
+import json
 import logging
 import os
 import requests
+import requests.adapters
 import socket
 import subprocess
 import tempfile
+import threading
 import time
 import urllib
 
+from concurrent.futures import ThreadPoolExecutor
+
+from urllib3.util.retry import Retry
+
 _DESCRIPTION = """
     Manage user specific mission keys.
 """
 
-_APC_BASE_URL = "https://accounts.parrot.com"
+# Servers can be replaced by local stand-ins (see bench/fake_drone.py)
+_APC_BASE_URL = os.environ.get("PARROT_APC_URL", "https://accounts.parrot.com")
 _APC_TMP_ACCOUNT = "/V4/account/tmp/create"
 
 _APC_CALLER_ID = "OpenFlight"
 _APC_CALLER_KEY = "g%2SW+m,cc9|eDQBgK:qTS2l=;[O~f@W"
 
-_ACADEMY_BASE_URL = "https://academy.parrot.com"
+_ACADEMY_BASE_URL = os.environ.get("PARROT_ACADEMY_URL", "https://academy.parrot.com")
 _ACADEMY_GENERATE_CHALLENGE = "/apiv1/4g/secrets/challenge"
 _ACADEMY_COMPLETE_CHALLENGE = "/apiv1/4g/secrets"
 _ACADEMY_API_KEY = "cd7oG8K9h86oCya0u5C0H7mphOuu8LU91o1hBLiG"
@@ -34,11 +42,76 @@ _DRONE_PROPERTIES = "/api/v1/info/properties"
 
 _DRONE_SECRET_DIR = os.path.expanduser("~/.parrot/anafi-ai")
 
+_CACHE_DIR = os.path.expanduser("~/.parrot")
+_APC_TOKEN_CACHE = os.path.join(_CACHE_DIR, "apc_token.json")
+_DRONE_PROPERTIES_CACHE = os.path.join(_CACHE_DIR, "drone_properties.json")
+
+# Seconds during which a cached temporary APC token / drone properties are used.
+# Properties are cached by address, which is the same for all the drones
+# connected in turn (anafi-ai.local), so not cached by default.
+_APC_TOKEN_TTL = 3600
+_DRONE_PROPERTIES_TTL = 0
+
+# Number of drones processed in parallel in fleet mode
+_FLEET_JOBS = 8
+
+# Connect and read timeouts of http requests (seconds)
+_HTTP_TIMEOUT = (5, 30)
+_HTTP_RETRIES = 3
+_HTTP_BACKOFF = 0.5
+
 _DRONE_USER_ID = 4
 _DRONE_SMAC_FILENAME = f"user{_DRONE_USER_ID}_smac.aes"
 _DRONE_SENC_FILENAME = f"user{_DRONE_USER_ID}_senc.aes"
 
 
+_session = None
+_cache_lock = threading.Lock()
+
+def get_session():
+    """
+    Get the http session shared by all requests, keeping connections to each
+    server alive and retrying failed requests with an exponential backoff
+    (only connection errors for non idempotent requests).
+    """
+    global _session
+    if _session is None:
+        retry_kwargs = {
+            "total": _HTTP_RETRIES,
+            "backoff_factor": _HTTP_BACKOFF,
+            "status_forcelist": (429, 500, 502, 503, 504),
+        }
+        try:
+            retry = Retry(allowed_methods=frozenset(["GET"]), **retry_kwargs)
+        except TypeError:
+            # urllib3 < 1.26
+            retry = Retry(method_whitelist=frozenset(["GET"]), **retry_kwargs)
+        adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+        _session = requests.Session()
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+
+def load_cache(path):
+    try:
+        with open(path, "r") as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path, content):
+    """
+    Save a cache file, only readable by the user (it may contain tokens).
+    """
+    os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(os.open(tmp_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600), "w") as fout:
+        json.dump(content, fout)
+    os.replace(tmp_path, path)
+
+
 def apc_get_signature(data, apc_key):
     """
     Generate a signature token to be used during the query to APC.
@@ -58,13 +131,14 @@ def apc_do_post_query(url, data):
     data: dict with data that will be sent in the request.
     """
     apc_signature = apc_get_signature(data, _APC_CALLER_KEY)
-    response = requests.post(
+    response = get_session().post(
          url,
          data=data,
          headers={
              'X-CallerId': _APC_CALLER_ID,
         },
-        params=apc_signature
+        params=apc_signature,
+        timeout=_HTTP_TIMEOUT
     )
     response.raise_for_status()
     return response
@@ -80,6 +154,57 @@ def apc_create_tmp_user():
     return response.json().get("apcToken")
 
 
+def apc_get_tmp_token(ttl=_APC_TOKEN_TTL, refresh=False):
+    """
+    Get the authentication token of a temporary APC user, reusing the one
+    cached in '~/.parrot' while younger than ttl seconds.
+    refresh: create a new one even if a cached one is available.
+    """
+    with _cache_lock:
+        cache = load_cache(_APC_TOKEN_CACHE)
+        # Only reuse tokens of the same server (not those of a stand-in)
+        if not refresh and cache.get("token") and \
+                cache.get("url") == _APC_BASE_URL and \
+                time.time() - cache.get("time", 0) < ttl:
+            return cache["token"]
+
+        logging.info("Creating temporary APC user and authentication token")
+        token = apc_create_tmp_user()
+        save_cache(_APC_TOKEN_CACHE, {"token": token, "time": time.time(),
+                "url": _APC_BASE_URL})
+        return token
+
+
+class ApcToken:
+    """
+    APC authentication token shared by the drones processed in parallel:
+    the given one or a temporary one, obtained on first use.
+    """
+    def __init__(self, auth_token=None, ttl=_APC_TOKEN_TTL):
+        self._auth_token = auth_token
+        self._ttl = ttl
+        self._token = auth_token
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._token is None:
+                self._token = apc_get_tmp_token(self._ttl)
+            return self._token
+
+    def refresh(self, rejected_token):
+        """
+        Replace a rejected temporary token (once for all drones).
+        Return the new token, None if it cannot be replaced.
+        """
+        with self._lock:
+            if self._auth_token:
+                return None
+            if self._token == rejected_token:
+                self._token = apc_get_tmp_token(self._ttl, refresh=True)
+            return self._token
+
+
 def academy_generate_challenge(apc_token, operation):
     """
     Generate a challenge to be completed by the drone.
@@ -88,7 +213,7 @@ def academy_generate_challenge(apc_token, operation):
     Return a challenge to be sent to the drone for completion.
     """
     url = _ACADEMY_BASE_URL + _ACADEMY_GENERATE_CHALLENGE
-    response = requests.get(
+    response = get_session().get(
         url,
         headers={
             "Authorization": f"Bearer {apc_token}",
@@ -96,7 +221,8 @@ def academy_generate_challenge(apc_token, operation):
         },
         params={
             "operation": operation,
-        }
+        },
+        timeout=_HTTP_TIMEOUT
     )
     response.raise_for_status()
     return response.text.strip()
@@ -110,7 +236,7 @@ def academy_complete_challenge(apc_token, message):
     Return final response of the request.
     """
     url = _ACADEMY_BASE_URL + _ACADEMY_COMPLETE_CHALLENGE
-    response = requests.get(
+    response = get_session().get(
         url,
         headers={
             "Authorization": f"Bearer {apc_token}",
@@ -118,28 +244,47 @@ def academy_complete_challenge(apc_token, message):
         },
         params={
             "message": message,
-        }
+        },
+        timeout=_HTTP_TIMEOUT
     )
     response.raise_for_status()
     return response.json()
 
 
-def drone_get_properties(base_url):
+def drone_get_properties(base_url, ttl=_DRONE_PROPERTIES_TTL):
     """
-    Get the drone properties.
+    Get the drone properties, reusing the ones cached for the same address
+    while younger than ttl seconds (0 to disable the cache).
     """
+    with _cache_lock:
+        cache = load_cache(_DRONE_PROPERTIES_CACHE) if ttl else {}
+    cached = cache.get(base_url)
+    if cached and time.time() - cached["time"] < ttl:
+        return cached["properties"]
+
     url = base_url + _DRONE_PROPERTIES
-    response = requests.get(url)
+    response = get_session().get(url, timeout=_HTTP_TIMEOUT)
     response.raise_for_status()
     properties = response.json()
-    return { prop["key"]: prop["value"] for prop in properties }
+    properties = { prop["key"]: prop["value"] for prop in properties }
+
+    if ttl:
+        with _cache_lock:
+            # Drop expired entries of other addresses
+            now = time.time()
+            cache = { key: value for key, value in
+                    load_cache(_DRONE_PROPERTIES_CACHE).items()
+                    if now - value["time"] < ttl }
+            cache[base_url] = {"time": now, "properties": properties}
+            save_cache(_DRONE_PROPERTIES_CACHE, cache)
+    return properties
 
 
-def drone_get_serial(base_url):
+def drone_get_serial(base_url, ttl=_DRONE_PROPERTIES_TTL):
     """
     Get the drone serial number (PI....).
     """
-    properties = drone_get_properties(base_url)
+    properties = drone_get_properties(base_url, ttl)
     return properties["ro.factory.serial"]
 
 
@@ -151,12 +296,13 @@ def drone_sign_challenge(base_url, operation, challenge):
     Return the message wit th challenge response to be sent back to the server.
     """
     url = base_url + _DRONE_SIGN_CHALENGE
-    response = requests.get(
+    response = get_session().get(
         url,
         params={
             "operation": operation,
             "challenge": challenge,
-        }
+        },
+        timeout=_HTTP_TIMEOUT
     )
     response.raise_for_status()
     return response.json().get("message")
@@ -170,42 +316,69 @@ def extract_drone_address(base_url):
     return (address, port)
 
 
-def drone_add_key(base_url, secret_dirpath, key_filepath):
-    address, port = extract_drone_address(base_url)
+def run_passe_muraille(address, port, secret_dirpath, commands,
+        single_session=False):
+    """
+    Run passe-muraille commands (list of argument lists) on the drone at a
+    resolved address, each command setting up its own secure session.
+    single_session: run all the commands in one session, sent one per line
+    on the standard input of passe-muraille (needs a passe-muraille reading
+    its commands from there when none is given on its command line).
+    Return the output of the commands, kept as is.
+    """
     cmd = [
         "passe-muraille",
         "-H", address,
         "-p", str(port),
         "-k", secret_dirpath,
-        "fm", "add", "file", key_filepath,
     ]
-    subprocess.check_call(cmd)
-
+    if single_session and len(commands) > 1:
+        return subprocess.run(cmd, check=True, stdout=subprocess.PIPE,
+                input="".join(" ".join(args) + "\n" for args in commands),
+                universal_newlines=True).stdout
+    return "".join(subprocess.run(cmd + args, check=True,
+            stdout=subprocess.PIPE, universal_newlines=True).stdout
+            for args in commands)
 
 
-def drone_remove_key(base_url, secret_dirpath, key_slot):
+def drone_key_operations(base_url, secret_dirpath, add_keys=(),
+        remove_slots=(), list_keys=False, single_session=False, prefix=""):
+    """
+    Run a batch of key operations on a drone, resolving its address once:
+    removals first (to free slots when rotating keys), then additions and
+    finally the list of keys.
+    single_session: run the batch in one passe-muraille session.
+    prefix: prefix of the log messages.
+    Return the output of the list of keys (lines, in the format of
+    passe-muraille) if requested, else None.
+    """
     address, port = extract_drone_address(base_url)
-    cmd = [
-        "passe-muraille",
-        "-H", address,
-        "-p", str(port),
-        "-k", secret_dirpath,
-        "fm", "remove", "slot", key_slot,
-    ]
-    subprocess.check_call(cmd)
-
-
-
-def drone_list_keys(base_url, secret_dirpath):
-    address, port = extract_drone_address(base_url)
-    cmd = [
-        "passe-muraille",
-        "-H", address,
-        "-p", str(port),
-        "-k", secret_dirpath,
-        "fm", "scan",
-    ]
-    subprocess.check_call(cmd)
+    commands = []
+    for key_slot in remove_slots:
+        logging.info(f"{prefix}Removing key from slot '{key_slot}'")
+        commands.append(["fm", "remove", "slot", str(key_slot)])
+    for key_filepath in add_keys:
+        logging.info(f"{prefix}Adding key '{key_filepath}' to the drone")
+        commands.append(["fm", "add", "file", key_filepath])
+    if not list_keys:
+        if commands:
+            output = run_passe_muraille(address, port, secret_dirpath,
+                    commands, single_session)
+            for line in output.splitlines():
+                logging.info(f"{prefix}{line}")
+        return None
+    logging.info(f"{prefix}Listing keys")
+    if single_session:
+        output = run_passe_muraille(address, port, secret_dirpath,
+                commands + [["fm", "scan"]], single_session)
+    else:
+        # Only the output of the list is returned
+        output = run_passe_muraille(address, port, secret_dirpath, commands)
+        for line in output.splitlines():
+            logging.info(f"{prefix}{line}")
+        output = run_passe_muraille(address, port, secret_dirpath,
+                [["fm", "scan"]])
+    return output.splitlines()
 
 
 def has_drone_secret_files(secret_dirpath):
@@ -236,40 +409,50 @@ def save_drone_secret_files(secret_dirpath, smac, senc):
         fout.write(smac)
 
 
-def do_work(options):
-    drone_base_url = f"http://{options.drone_address}:{options.drone_port}"
-
-    # Only generate APC authentication token if requested
-    if options.gen_auth_token:
-        logging.info("Creating temporary APC user and authentication token")
-        apc_token = apc_create_tmp_user()
-        print(apc_token)
-        return
-
-    logging.info("Retrieving drone serial number")
-    drone_serial = drone_get_serial(drone_base_url)
-    logging.info(f"-> {drone_serial}")
+def process_drone(options, drone_base_url, apc_token, prefix=""):
+    """
+    Get the secret of a drone if not already known then add/remove/list its
+    keys as requested by options.
+    apc_token: ApcToken used to get the secret.
+    prefix: prefix of the log messages.
+    Return a dict describing what was done.
+    """
+    result = {"drone": drone_base_url}
+
+    logging.info(f"{prefix}Retrieving drone serial number")
+    # Never write the secrets of a drone under the cached serial of another
+    # one that had the same address
+    properties_ttl = 0 if options.get_secret else options.properties_ttl
+    drone_serial = drone_get_serial(drone_base_url, properties_ttl)
+    logging.info(f"{prefix}-> {drone_serial}")
+    result["serial"] = drone_serial
+    result["secret"] = "cached"
     tmpdir = None
     secret_dirpath = os.path.join(_DRONE_SECRET_DIR, drone_serial)
 
     if options.get_secret or not has_drone_secret_files(secret_dirpath):
-        # Use given token or create a temporary one
-        if options.auth_token:
-            apc_token = options.auth_token
-        else:
-            logging.info("Creating temporary APC user and authentication token")
-            apc_token =apc_create_tmp_user()
-
-        logging.info("Generating challenge")
-        challenge = academy_generate_challenge(apc_token, "get_secret")
-
-        logging.info("Sending challenge to drone")
+        token = apc_token.get()
+
+        logging.info(f"{prefix}Generating challenge")
+        try:
+            challenge = academy_generate_challenge(token, "get_secret")
+        except requests.HTTPError as ex:
+            # The cached temporary token may have expired before its ttl
+            if ex.response is None or ex.response.status_code not in (401, 403):
+                raise
+            token = apc_token.refresh(token)
+            if token is None:
+                raise
+            challenge = academy_generate_challenge(token, "get_secret")
+
+        logging.info(f"{prefix}Sending challenge to drone")
         message = drone_sign_challenge(drone_base_url, "get_secret", challenge)
 
-        logging.info("Completing operation with drone response")
-        secrets = academy_complete_challenge(apc_token, message)
+        logging.info(f"{prefix}Completing operation with drone response")
+        secrets = academy_complete_challenge(token, message)
         senc = binascii.a2b_hex(secrets["SENC"])
         smac = binascii.a2b_hex(secrets["SMAC"])
+        result["secret"] = "retrieved"
 
         # Save secret in either permanent location or temp one
         if not options.get_secret:
@@ -277,17 +460,110 @@ def do_work(options):
             secret_dirpath = tmpdir.name
         save_drone_secret_files(secret_dirpath, smac, senc)
 
-    if options.add_key:
-        logging.info(f"Adding key '{options.add_key}' to the drone")
-        drone_add_key(drone_base_url, secret_dirpath, options.add_key)
+    try:
+        output = drone_key_operations(drone_base_url, secret_dirpath,
+                add_keys=options.add_key or [],
+                remove_slots=options.remove_key or [],
+                list_keys=options.list_keys,
+                single_session=options.single_session,
+                prefix=prefix)
+    finally:
+        if tmpdir:
+            tmpdir.cleanup()
+    result["added"] = options.add_key or []
+    result["removed"] = options.remove_key or []
+    if output is not None:
+        result["keys"] = output
+    return result
+
+
+def read_drone_addresses(options):
+    """
+    Get the addresses of the drones of the fleet mode (--drone and
+    --drones-file, one address per line, '#' starting a comment).
+    """
+    addresses = list(options.drones or [])
+    if options.drones_file:
+        with open(options.drones_file, "r") as fin:
+            for line in fin:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    addresses.append(line)
+    return addresses
+
+
+def process_fleet(options, addresses, apc_token):
+    """
+    Process several drones in parallel (at most options.jobs at a time).
+    Return the results of the drones, in the order of addresses.
+    """
+    def worker(address):
+        if ":" not in address:
+            address = f"{address}:{options.drone_port}"
+        drone_base_url = f"http://{address}"
+        try:
+            return process_drone(options, drone_base_url, apc_token,
+                    prefix=f"{address}: ")
+        except Exception as ex:
+            logging.error(f"{address}: {ex}")
+            return {"drone": drone_base_url, "error": str(ex)}
+
+    with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        return list(executor.map(worker, addresses))
+
+
+def print_fleet_results(results):
+    rows = [("DRONE", "SERIAL", "SECRET", "RESULT")]
+    for result in results:
+        if "error" in result:
+            status = f"error: {result['error']}"
+        else:
+            operations = []
+            if result["removed"]:
+                operations.append("removed slot " + ", ".join(result["removed"]))
+            if result["added"]:
+                operations.append("added " + ", ".join(result["added"]))
+            if "keys" in result:
+                operations.append("keys listed")
+            status = ", ".join(operations) or "ok"
+        rows.append((result["drone"], result.get("serial", "-"),
+                result.get("secret", "-"), status))
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    for row in rows:
+        print("  ".join(value.ljust(width)
+                for value, width in zip(row, widths)) + "  " + row[3])
+    for result in results:
+        if "keys" in result:
+            print(f"\n{result['drone']}:")
+            for line in result["keys"]:
+                print(f"  {line}")
+
 
-    if options.remove_key:
-        logging.info(f"Removing key from slot '{options.remove_key}'")
-        drone_remove_key(drone_base_url, secret_dirpath, options.remove_key)
+def do_work(options):
+    # Only generate APC authentication token if requested
+    if options.gen_auth_token:
+        logging.info("Creating temporary APC user and authentication token")
+        apc_token = apc_create_tmp_user()
+        print(apc_token)
+        return
+
+    apc_token = ApcToken(options.auth_token, options.token_ttl)
+    addresses = read_drone_addresses(options)
+    if addresses:
+        results = process_fleet(options, addresses, apc_token)
+        if options.json:
+            print(json.dumps(results, indent=4))
+        else:
+            print_fleet_results(results)
+        return
 
-    if options.list_keys:
-        logging.info(f"Listing keys")
-        drone_list_keys(drone_base_url, secret_dirpath)
+    drone_base_url = f"http://{options.drone_address}:{options.drone_port}"
+    result = process_drone(options, drone_base_url, apc_token)
+    if options.json:
+        print(json.dumps(result, indent=4))
+    elif "keys" in result:
+        for line in result["keys"]:
+            print(line)
 
 
 def main():
@@ -300,17 +576,28 @@ def main():
         help=f"Simply get drone secret and store it in '{_DRONE_SECRET_DIR}' for future use.")
 
     parser.add_argument("--add-key",
+        action="append",
         metavar="FILE",
-        help="Add new flight mission public key (in PEM format).")
+        help="Add new flight mission public key (in PEM format), can be repeated.")
 
     parser.add_argument("--remove-key",
+        action="append",
         metavar="SLOT",
-        help="Remove flight mission key from given slot.")
+        help="Remove flight mission key from given slot (before adding keys), can be repeated.")
 
     parser.add_argument("--list-keys",
         action="store_true",
         help="List known flight mission keys.")
 
+    parser.add_argument("--single-session",
+        action="store_true",
+        help="Run all the key operations of a drone in one passe-muraille session "
+            "(needs a passe-muraille reading its commands on its standard input).")
+
+    parser.add_argument("--json",
+        action="store_true",
+        help="Print the results (keys listed on each drone...) in JSON format.")
+
     parser.add_argument("--gen-auth-token",
         action="store_true",
         help="Simply generate an authentication token for future use.")
@@ -319,6 +606,35 @@ def main():
         metavar="TOKEN",
         help="Use specific authentication token instead of creating a temporary one.")
 
+    parser.add_argument("--token-ttl",
+        metavar="SECONDS",
+        type=int,
+        default=_APC_TOKEN_TTL,
+        help=f"Reuse the cached temporary authentication token during this time (default: {_APC_TOKEN_TTL}).")
+
+    parser.add_argument("--properties-ttl",
+        metavar="SECONDS",
+        type=int,
+        default=_DRONE_PROPERTIES_TTL,
+        help=f"Reuse the cached drone properties during this time, 0 to disable (default: {_DRONE_PROPERTIES_TTL}). "
+            "The cache is by address: only use it when each address is a distinct drone.")
+
+    parser.add_argument("--drone",
+        dest="drones",
+        action="append",
+        metavar="ADDRESS[:PORT]",
+        help="Process a fleet of drones in parallel instead of a single one, can be repeated.")
+
+    parser.add_argument("--drones-file",
+        metavar="FILE",
+        help="Process the fleet of drones listed in a file, one address per line.")
+
+    parser.add_argument("--jobs",
+        metavar="N",
+        type=int,
+        default=_FLEET_JOBS,
+        help=f"Number of drones processed in parallel (default: {_FLEET_JOBS}).")
+
     parser.add_argument("--drone-address",
         metavar="ADDRESS",
         default=_DRONE_ADDRESS,
@@ -0,0 +1,94 @@
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+# Used when product.mk cannot be parsed
+DEFAULT_PYTHON3_VERSION = "3.11"
+
+_PRODUCT_MK = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "product.mk")
+
+#===============================================================================
+#===============================================================================
+def get_target_python_version(product_mk=_PRODUCT_MK):
+    """
+    Get the target python version (PYTHON3_VERSION) set in product.mk.
+    """
+    try:
+        with open(product_mk, "r") as fd:
+            for line in fd:
+                match = re.match(r"^PYTHON3_VERSION\s*:?=\s*(\S+)", line)
+                if match:
+                    return match.group(1)
+    except OSError:
+        pass
+    return DEFAULT_PYTHON3_VERSION
+
+def find_python(version, python=None):
+    """
+    Find a host interpreter with the given version, pycs being specific to
+    an interpreter version.
+    python: interpreter to use instead of searching one.
+    Return its path, or None if not found.
+    """
+    if python:
+        return shutil.which(python)
+    if "%d.%d" % sys.version_info[:2] == version:
+        return sys.executable
+    return shutil.which("python" + version)
+
+#===============================================================================
+#===============================================================================
+def dir_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
+
+def _remove_pycs(path):
+    """
+    Remove the pycs previously compiled from the sources: the __pycache__
+    dirs and the legacy pycs next to a source. Pycs without a source may be
+    the only version of a module and are kept.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        if "__pycache__" in dirnames:
+            shutil.rmtree(os.path.join(dirpath, "__pycache__"))
+            dirnames.remove("__pycache__")
+        for name in filenames:
+            if name.endswith(".pyc") and name[:-1] in filenames:
+                os.unlink(os.path.join(dirpath, name))
+
+def _remove_sources(path):
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            if name.endswith(".py"):
+                os.unlink(os.path.join(dirpath, name))
+
+def compile_dir(path, python, strip_dir, pyc_only=False, jobs=0):
+    """
+    Byte-compile all python sources under path with the given interpreter,
+    in parallel, as hash-based pycs so the output only depends on the
+    sources. Previous pycs of the sources are removed first.
+    strip_dir: prefix removed from the source paths recorded in the pycs.
+    pyc_only: write pycs next to their sources (so they can be imported
+    without them) and remove the sources.
+    jobs: number of parallel workers (0: one per cpu).
+    """
+    _remove_pycs(path)
+    cmd = [
+        python, "-m", "compileall", "-q",
+        "-j", str(jobs),
+        "-s", strip_dir,
+        "--invalidation-mode",
+        "unchecked-hash" if pyc_only else "checked-hash",
+    ]
+    if pyc_only:
+        cmd.append("-b")
+    cmd.append(path)
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    if pyc_only:
+        _remove_sources(path)
@@ -0,0 +1,584 @@
+import email.utils
+import hashlib
+import http.client
+import json
+import logging
+import os
+import shutil
+import stat
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from . import common
+from . import elfdeps
+from . import timing
+
+DEFAULT_MAX_SIZE_MB = 8192
+
+# Name of the file identifying the archive an sdk tree was extracted from
+MARKER_NAME = ".sdk-cache.json"
+
+# File marking a tree whose files are linked to the store of dedup_tree
+_DEDUP_MARKER_NAME = ".sdk-dedup"
+
+# Suffix of the metadata index written next to an sdk tree
+INDEX_SUFFIX = ".index.json"
+
+# Bump when the content of the index changes
+_INDEX_VERSION = 1
+
+_META_NAME = "meta.json"
+_TAR_NAME = "sdk.tar.gz"
+
+# Seconds between two progress logs during a download
+_PROGRESS_PERIOD = 5
+
+# Number of times an interrupted download is resumed during a run
+_MAX_ATTEMPTS = 3
+
+# Trust the sdk archive content like tar(1) does
+_EXTRACT_KWARGS = {"filter": "fully_trusted"} \
+        if hasattr(tarfile, "fully_trusted_filter") else {}
+
+#===============================================================================
+#===============================================================================
+def get_default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME",
+            os.path.expanduser("~/.cache"))
+    return os.path.join(cache_home, "parrot", "sdk")
+
+#===============================================================================
+#===============================================================================
+def _strip_first_component(tar):
+    # Same as 'tar --strip 1'
+    for member in tar:
+        parts = member.name.split("/", 1)
+        if len(parts) < 2 or not parts[1].strip("/"):
+            continue
+        member.name = parts[1]
+        if member.islnk():
+            parts = member.linkname.split("/", 1)
+            if len(parts) == 2:
+                member.linkname = parts[1]
+        yield member
+
+def _swap_dir(new_path, dst_path):
+    old_path = None
+    if os.path.lexists(dst_path):
+        old_path = new_path + ".old"
+        os.rename(dst_path, old_path)
+    os.rename(new_path, dst_path)
+    if old_path is None:
+        pass
+    elif os.path.isdir(old_path) and not os.path.islink(old_path):
+        shutil.rmtree(old_path, ignore_errors=True)
+    else:
+        os.unlink(old_path)
+
+def extract_stream(fileobj, dst_dir, marker=None, on_complete=None):
+    """
+    Extract a (compressed) tar stream into dst_dir, stripping the first path
+    component. The content is extracted in a temporary directory swapped
+    with dst_dir once complete, so dst_dir is never left half extracted.
+    marker: metadata saved in the extracted tree (see read_marker).
+    on_complete: called after the extraction, before the swap (it can raise
+    an exception to cancel it).
+    """
+    dst_dir = str(dst_dir)
+    parent_dir = os.path.dirname(dst_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir,
+            prefix=".%s-" % os.path.basename(dst_dir))
+    try:
+        os.chmod(tmp_dir, 0o755)
+        with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+            tar.extractall(tmp_dir, members=_strip_first_component(tar),
+                    **_EXTRACT_KWARGS)
+        if on_complete is not None:
+            on_complete()
+        if marker is not None:
+            write_marker(tmp_dir, marker)
+        _swap_dir(tmp_dir, dst_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+def extract_file(tar_path, dst_dir, marker=None):
+    logging.info("Extracting %s into %s", tar_path, dst_dir)
+    with timing.phase("sdk_extract") as counters, open(tar_path, "rb") as fin:
+        extract_stream(fin, dst_dir, marker)
+        counters["bytes_in"] = os.path.getsize(tar_path)
+
+#===============================================================================
+#===============================================================================
+class _DownloadReader:
+    """
+    File-like object reading a download, possibly resumed: the bytes already
+    in part_path are read first, then the ones of the response that are also
+    appended to part_path. The size and hash of the whole content are
+    computed on the fly.
+    """
+    def __init__(self, response, part_path, offset, total):
+        self._response = response
+        self._prefix = open(part_path, "rb") if offset else None
+        self._prefix_left = offset
+        self._part = open(part_path, "ab" if offset else "wb")
+        self._total = total
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        # Time spent waiting for the network, the rest being extraction
+        self.network_time = 0.0
+        self._start = self._last_log = time.monotonic()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = common.BUFSIZE
+        if self._prefix_left:
+            data = self._prefix.read(min(size, self._prefix_left))
+            if not data:
+                raise OSError("Truncated partial download")
+            self._prefix_left -= len(data)
+        else:
+            read_start = time.monotonic()
+            data = self._response.read(size)
+            self.network_time += time.monotonic() - read_start
+            if not data and self._total is not None and \
+                    self.size < self._total:
+                raise OSError("Incomplete download: %d/%d bytes" %
+                        (self.size, self._total))
+            self._part.write(data)
+            now = time.monotonic()
+            if data and now - self._last_log >= _PROGRESS_PERIOD:
+                self._last_log = now
+                logging.info("Downloaded %.1f/%.1f MB",
+                        self.size / 1e6, (self._total or 0) / 1e6)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def drain(self):
+        while self.read(common.BUFSIZE):
+            pass
+
+    def close(self):
+        if self._prefix:
+            self._prefix.close()
+        self._part.close()
+        elapsed = time.monotonic() - self._start
+        logging.info("Downloaded %.1f MB in %.1fs (%.1f MB/s)",
+                self.size / 1e6, elapsed,
+                self.size / 1e6 / elapsed if elapsed > 0 else 0.0)
+
+def _load_part_validator(part_path):
+    try:
+        with open(part_path + ".json", "r") as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+def _remove_part(part_path):
+    for path in (part_path, part_path + ".json"):
+        if os.path.exists(path):
+            os.unlink(path)
+
+def _open_download(url, part_path, headers):
+    """
+    Open the download of url, resuming the one in part_path if possible.
+    Return the response, the offset it starts at and the expected total size
+    or None if the server answered '304 Not Modified'.
+    """
+    headers = dict(headers or {})
+    validator = _load_part_validator(part_path)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset and validator and validator.get("url") == url and \
+            (validator.get("etag") or validator.get("last_modified")):
+        headers["Range"] = "bytes=%d-" % offset
+        headers["If-Range"] = validator.get("etag") or validator["last_modified"]
+        # Only the partial content matters now
+        headers.pop("If-None-Match", None)
+        headers.pop("If-Modified-Since", None)
+    else:
+        _remove_part(part_path)
+        offset = 0
+
+    try:
+        response = urllib.request.urlopen(
+                urllib.request.Request(url, headers=headers))
+    except urllib.error.HTTPError as ex:
+        if ex.code == 304:
+            return (None, 0, None)
+        if ex.code == 416 and offset:
+            # Partial download is unusable, restart from the beginning
+            _remove_part(part_path)
+            return _open_download(url, part_path, {k: v
+                    for k, v in headers.items() if k not in ("Range", "If-Range")})
+        raise
+
+    if response.status == 206:
+        logging.info("Resuming download at %.1f MB", offset / 1e6)
+        content_range = response.headers.get("Content-Range", "")
+        total = content_range.rsplit("/", 1)[-1]
+        total = int(total) if total.isdigit() else None
+    else:
+        offset = 0
+        length = response.headers.get("Content-Length")
+        total = int(length) if length else None
+        with open(part_path + ".json", "w") as fd:
+            json.dump({
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }, fd)
+    return (response, offset, total)
+
+def download_and_extract(url, tar_path, dst_dir, headers=None, sha256=None):
+    """
+    Download the sdk archive at url into tar_path while extracting it into
+    dst_dir (see extract_stream). Interrupted downloads are resumed with
+    ranged requests, the size (and sha256 if given) of the archive is checked
+    once complete.
+    headers: extra request headers (ex: for conditional requests).
+    Return the metadata of the archive (also saved in the extracted tree), or
+    None if the server answered '304 Not Modified'.
+    """
+    tar_path = str(tar_path)
+    part_path = tar_path + ".part"
+    for attempt in range(1, _MAX_ATTEMPTS + 1):
+        response, offset, total = _open_download(url, part_path, headers)
+        if response is None:
+            return None
+
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified") or
+                    email.utils.formatdate(usegmt=True),
+        }
+        validator = _load_part_validator(part_path)
+        if validator:
+            meta["etag"] = validator.get("etag") or meta["etag"]
+            meta["last_modified"] = validator.get("last_modified") or \
+                    meta["last_modified"]
+
+        reader = _DownloadReader(response, part_path, offset, total)
+
+        def check():
+            # Trailing padding may not have been read by the extraction
+            reader.drain()
+            if total is not None and reader.size != total:
+                raise OSError("Incomplete download: %d/%d bytes" %
+                        (reader.size, total))
+            digest = reader.sha256.hexdigest()
+            if sha256 and digest != sha256.lower():
+                _remove_part(part_path)
+                raise ValueError("Checksum mismatch for %s: %s" % (url, digest))
+            meta.update(size=reader.size, sha256=digest)
+
+        start = time.monotonic()
+        try:
+            with timing.phase("sdk_download_extract") as counters:
+                extract_stream(reader, dst_dir, meta, check)
+                counters["bytes_in"] = reader.size
+        except (OSError, http.client.HTTPException) as ex:
+            if attempt == _MAX_ATTEMPTS:
+                raise
+            logging.warning("Download interrupted (%s), retrying", ex)
+            continue
+        finally:
+            reader.close()
+            response.close()
+            # Cumulated time of the reads, overlapping with the extraction
+            timing.add("sdk_network_wait", start, reader.network_time,
+                    counters={"bytes_in": reader.size - offset})
+
+        os.replace(part_path, tar_path)
+        os.unlink(part_path + ".json")
+        return meta
+
+#===============================================================================
+#===============================================================================
+def read_marker(tree_path):
+    try:
+        with open(os.path.join(tree_path, MARKER_NAME), "r") as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+def write_marker(tree_path, meta):
+    with open(os.path.join(tree_path, MARKER_NAME), "w") as fd:
+        json.dump(meta, fd, indent=4, sort_keys=True)
+
+#===============================================================================
+#===============================================================================
+def read_build_prop(path):
+    props = {}
+    with open(path, errors="ignore") as fd:
+        for line in fd:
+            # Format is <key>=<value>
+            fields = line.rstrip("\n").split("=", 1)
+            if len(fields) == 2:
+                props[fields[0]] = fields[1]
+    return props
+
+def _tree_fingerprint(tree_path):
+    # The tree is replaced as a whole by an update (new inode), build.prop and
+    # the marker identify what was extracted
+    fingerprint = []
+    for path in (tree_path, os.path.join(tree_path, "build.prop"),
+            os.path.join(tree_path, MARKER_NAME)):
+        try:
+            st = os.stat(path)
+            fingerprint.append([st.st_ino, st.st_size, st.st_mtime_ns])
+        except OSError:
+            fingerprint.append(None)
+    return fingerprint
+
+def build_index(tree_path):
+    """
+    Index the metadata of an sdk tree: build.prop keys, target arch and the
+    shared libraries of the sysroot, by file name and by soname (paths
+    relative to the tree).
+    """
+    props = read_build_prop(os.path.join(tree_path, "build.prop"))
+    libs = {}
+    sonames = {}
+    for dirpath, dirnames, filenames in os.walk(tree_path):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if ".so" not in name:
+                continue
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, tree_path)
+            libs.setdefault(name, relpath)
+            if os.path.islink(path):
+                continue
+            try:
+                info = elfdeps.read_dynamic(path)
+            except (OSError, struct.error):
+                continue
+            if info and info["soname"]:
+                sonames.setdefault(info["soname"], relpath)
+    return {
+        "version": _INDEX_VERSION,
+        "fingerprint": _tree_fingerprint(tree_path),
+        "build_prop": props,
+        "target_arch": props.get("ro.missions.sdk_target_arch"),
+        "libs": libs,
+        "sonames": sonames,
+    }
+
+def write_index(tree_path):
+    index = build_index(tree_path)
+    index_path = str(tree_path) + INDEX_SUFFIX
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as fd:
+        json.dump(index, fd, sort_keys=True)
+    os.replace(tmp_path, index_path)
+    return index
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def load_index(tree_path):
+    """
+    Get the metadata index of an sdk tree, loaded once per process and
+    rebuilt when the tree changed since it was written.
+    """
+    tree_path = str(tree_path)
+    fingerprint = _tree_fingerprint(tree_path)
+    with _indexes_lock:
+        index = _indexes.get(tree_path)
+        if index is None or index["fingerprint"] != fingerprint:
+            try:
+                with open(tree_path + INDEX_SUFFIX, "r") as fd:
+                    index = json.load(fd)
+            except (OSError, ValueError):
+                index = None
+            if not index or index.get("version") != _INDEX_VERSION or \
+                    index.get("fingerprint") != fingerprint:
+                logging.info("Indexing sdk '%s'", tree_path)
+                index = write_index(tree_path)
+            _indexes[tree_path] = index
+        return index
+
+#===============================================================================
+#===============================================================================
+def dedup_tree(tree_path, store_dir):
+    """
+    Replace the regular files of an sdk tree by hardlinks to objects of a
+    content addressed store shared by several trees, so that files identical
+    in several variants use disk space once. Files are linked only with
+    objects of the same content and mode, and trees must not be modified in
+    place afterwards. Already deduplicated trees are skipped.
+    Return the number of files linked to existing objects and their size.
+    """
+    tree_path = str(tree_path)
+    done_path = os.path.join(tree_path, _DEDUP_MARKER_NAME)
+    if os.path.exists(done_path):
+        return (0, 0)
+
+    linked = 0
+    saved = 0
+    for dirpath, _, filenames in os.walk(tree_path):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if dirpath == tree_path and name == MARKER_NAME:
+                # Rewritten in place
+                continue
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            digest = hashlib.sha256()
+            with open(path, "rb") as fin:
+                for data in iter(lambda: fin.read(common.BUFSIZE), b""):
+                    digest.update(data)
+            object_name = "%s-%o" % (digest.hexdigest(), stat.S_IMODE(st.st_mode))
+            object_path = os.path.join(store_dir, object_name[:2], object_name)
+            try:
+                object_st = os.stat(object_path)
+            except FileNotFoundError:
+                object_st = None
+
+            if object_st is None:
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                try:
+                    os.link(path, object_path)
+                except FileExistsError:
+                    # Added by a concurrent extraction
+                    object_st = os.stat(object_path)
+            if object_st is not None and object_st.st_ino != st.st_ino:
+                tmp_path = path + ".dedup"
+                os.link(object_path, tmp_path)
+                os.replace(tmp_path, path)
+                linked += 1
+                saved += st.st_size
+
+    with open(done_path, "w"):
+        pass
+    return (linked, saved)
+
+def gc_store(store_dir):
+    """
+    Remove the objects of a store not used by any tree anymore.
+    Return the number of bytes freed.
+    """
+    freed = 0
+    for dirpath, _, filenames in os.walk(store_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if st.st_nlink <= 1:
+                os.unlink(path)
+                freed += st.st_size
+    return freed
+
+#===============================================================================
+#===============================================================================
+class SdkCache:
+    """
+    Persistent cache of sdk archives indexed by product, variant and version.
+    Archives of 'latest' versions are revalidated with conditional requests,
+    least recently used entries (including partial downloads) are evicted when
+    the size of the cache exceeds max_size bytes.
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # Entries used by this instance, never evicted
+        self._used = set()
+
+    def _entry_dir(self, product, variant, version):
+        return os.path.join(self.cache_dir, product, variant, version or "latest")
+
+    def update(self, url, product, variant, version, dst_dir, sha256=None,
+            evict=True):
+        """
+        Make sure dst_dir contains the extraction of the given sdk, using the
+        cached archive when it is up to date or downloading it otherwise.
+        sha256: expected checksum of the archive, if known.
+        evict: evict old entries afterwards (see evict()).
+        Return the metadata of the archive.
+        """
+        entry_dir = self._entry_dir(product, variant, version)
+        self._used.add(entry_dir)
+        tar_path = os.path.join(entry_dir, _TAR_NAME)
+        meta_path = os.path.join(entry_dir, _META_NAME)
+        os.makedirs(entry_dir, exist_ok=True)
+        self._touch(entry_dir)
+
+        meta = None
+        if os.path.exists(tar_path):
+            try:
+                with open(meta_path, "r") as fd:
+                    meta = json.load(fd)
+            except (OSError, ValueError):
+                meta = None
+        if meta is not None and meta.get("url") != url:
+            meta = None
+
+        headers = {}
+        if meta is not None and version and version != "latest":
+            # Released versions never change
+            logging.info("Using cached sdk: %s", tar_path)
+        elif meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+            logging.info("Checking cached sdk against: %s", url)
+            new_meta = download_and_extract(url, tar_path, dst_dir, headers, sha256)
+            if new_meta is None:
+                logging.info("Cached sdk is up to date: %s", tar_path)
+            else:
+                meta = new_meta
+                self._save_meta(meta_path, meta)
+        else:
+            logging.info("Downloading file: %s", url)
+            meta = download_and_extract(url, tar_path, dst_dir, None, sha256)
+            self._save_meta(meta_path, meta)
+
+        if read_marker(dst_dir) == meta:
+            logging.info("%s is up to date", dst_dir)
+        else:
+            extract_file(tar_path, dst_dir, meta)
+
+        if evict:
+            self.evict()
+        return meta
+
+    def _save_meta(self, meta_path, meta):
+        with open(meta_path, "w") as fd:
+            json.dump(meta, fd, indent=4, sort_keys=True)
+
+    def _touch(self, entry_dir):
+        # Mark as recently used
+        os.utime(entry_dir)
+
+    def evict(self):
+        """
+        Remove the least recently used entries while the cache is bigger than
+        max_size, except the ones used by this instance.
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            if not files:
+                continue
+            size = sum(os.path.getsize(os.path.join(root, name))
+                    for name in files)
+            entries.append((os.stat(root).st_mtime, size, root))
+            dirs[:] = []
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path in self._used:
+                continue
+            logging.info("Evicting cached sdk '%s'", path)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,90 @@
+import json
+import os
+import stat
+
+# Payload directories detailed in the size manifest
+DETAILED_DIRS = ("lib", "python", "share")
+
+DEFAULT_TOP = 10
+
+#===============================================================================
+#===============================================================================
+def _top(sizes, count):
+    return [[path, size] for path, size in sorted(sizes.items(),
+            key=lambda item: (-item[1], item[0]))[:count]]
+
+def make_manifest(payload_dir, image_path, top=DEFAULT_TOP):
+    """
+    Get the sizes of a payload: total size, size of the mission archive, size
+    of each file and the biggest directories and files of DETAILED_DIRS.
+    """
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(payload_dir):
+        dirnames.sort()
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                files[os.path.relpath(path, payload_dir)] = st.st_size
+
+    details = {}
+    for detailed_dir in DETAILED_DIRS:
+        dir_files = {}
+        dir_sizes = {}
+        for relpath, size in files.items():
+            if not relpath.startswith(detailed_dir + "/"):
+                continue
+            dir_files[relpath] = size
+            parent = os.path.dirname(relpath)
+            while parent != detailed_dir:
+                dir_sizes[parent] = dir_sizes.get(parent, 0) + size
+                parent = os.path.dirname(parent)
+        details[detailed_dir] = {
+            "size": sum(dir_files.values()),
+            "top_dirs": _top(dir_sizes, top),
+            "top_files": _top(dir_files, top),
+        }
+
+    return {
+        "total_size": sum(files.values()),
+        "compressed_size": os.path.getsize(image_path),
+        "dirs": details,
+        "files": files,
+    }
+
+def load_manifest(path):
+    with open(path, "r") as fd:
+        return json.load(fd)
+
+def save_manifest(path, manifest):
+    with open(path, "w") as fd:
+        json.dump(manifest, fd, indent=4, sort_keys=True)
+
+#===============================================================================
+#===============================================================================
+def _growth(old, new):
+    return 100.0 * (new - old) / old if old else 0.0
+
+def diff_manifests(baseline, manifest, top=DEFAULT_TOP):
+    """
+    Compare a size manifest with a baseline: growth (%) of the total and
+    compressed sizes and the files whose size changed the most.
+    """
+    result = {}
+    for key in ("total_size", "compressed_size"):
+        result[key] = {
+            "baseline": baseline[key],
+            "current": manifest[key],
+            "growth": _growth(baseline[key], manifest[key]),
+        }
+
+    old_files = baseline.get("files", {})
+    new_files = manifest["files"]
+    changes = {}
+    for relpath in set(old_files) | set(new_files):
+        delta = new_files.get(relpath, 0) - old_files.get(relpath, 0)
+        if delta:
+            changes[relpath] = delta
+    result["files"] = [[relpath, delta] for relpath, delta in sorted(
+            changes.items(), key=lambda item: (-abs(item[1]), item[0]))[:top]]
+    return result
@@ -0,0 +1,179 @@
+import fnmatch
+import json
+import os
+import posixpath
+import shutil
+import stat
+
+from . import common
+
+# Maximum size of a single copy_file_range call
+_COPY_RANGE_SIZE = 1024 * 1024 * 1024
+
+#===============================================================================
+#===============================================================================
+def _is_excluded(relpath, excludes):
+    return any(fnmatch.fnmatchcase(relpath, pattern) for pattern in excludes)
+
+def _map_tree(src_path, dst_relpath, st, excludes, mapping):
+    if _is_excluded(dst_relpath, excludes):
+        return
+    previous = mapping.get(dst_relpath)
+    if previous is not None and stat.S_ISDIR(previous[1].st_mode) and \
+            not stat.S_ISDIR(st.st_mode):
+        # A directory replaced by a file drops what was mapped below it
+        prefix = dst_relpath + "/"
+        for relpath in [k for k in mapping if k.startswith(prefix)]:
+            del mapping[relpath]
+    mapping[dst_relpath] = (src_path, st)
+    if stat.S_ISDIR(st.st_mode):
+        with os.scandir(src_path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            _map_tree(entry.path, posixpath.join(dst_relpath, entry.name),
+                    entry.stat(follow_symlinks=False), excludes, mapping)
+
+def build_mapping(root_dir, dirslist, excludes=()):
+    """
+    Compute the final destination -> source mapping of a staging.
+    root_dir: directory the sources are relative to.
+    dirslist: ordered dict of source directory -> destination directory, the
+    content of each source being merged in its destination like
+    'cp -a <src>/* <dst>' would (later sources override earlier ones).
+    excludes: glob patterns of destination paths (and subtrees) to skip.
+    Return an ordered dict of destination path -> (source path, source stat),
+    parents always appearing before their children.
+    """
+    mapping = {}
+    for src_relpath, dst_relpath in dirslist.items():
+        src_root = os.path.join(root_dir, src_relpath)
+        if not os.path.isdir(src_root):
+            continue
+        with os.scandir(src_root) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        if entries:
+            mapping.setdefault(dst_relpath, (src_root, os.stat(src_root)))
+        for entry in entries:
+            # Hidden entries are not matched by 'cp <src>/*'
+            if entry.name.startswith("."):
+                continue
+            _map_tree(entry.path, posixpath.join(dst_relpath, entry.name),
+                    entry.stat(follow_symlinks=False), excludes, mapping)
+    return mapping
+
+#===============================================================================
+#===============================================================================
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+def copy_file(src_path, dst_path):
+    """
+    Copy a regular file with its mode and timestamps, letting the kernel copy
+    (or reflink, depending on the filesystem) the data when possible.
+    """
+    with open(src_path, "rb") as fin, open(dst_path, "wb") as fout:
+        try:
+            while os.copy_file_range(fin.fileno(), fout.fileno(),
+                    _COPY_RANGE_SIZE):
+                pass
+        except (AttributeError, OSError):
+            fin.seek(0)
+            fout.seek(0)
+            fout.truncate()
+            shutil.copyfileobj(fin, fout, common.BUFSIZE)
+    shutil.copystat(src_path, dst_path, follow_symlinks=False)
+
+def _stage_file(src_path, st, dst_path, hardlink, stats):
+    try:
+        dst_st = os.lstat(dst_path)
+    except FileNotFoundError:
+        dst_st = None
+
+    if dst_st is not None:
+        # A hardlink of a previous staging is copied if hardlinks are no
+        # longer wanted
+        shared = (dst_st.st_dev, dst_st.st_ino) == (st.st_dev, st.st_ino)
+        if stat.S_ISREG(dst_st.st_mode) and dst_st.st_size == st.st_size and \
+                dst_st.st_mtime_ns == st.st_mtime_ns and \
+                (hardlink or not shared):
+            stats["unchanged"] += 1
+            return
+        remove_path(dst_path)
+
+    if hardlink:
+        try:
+            os.link(src_path, dst_path)
+            stats["linked"] += 1
+            return
+        except OSError:
+            pass
+    copy_file(src_path, dst_path)
+    stats["copied"] += 1
+
+def stage(mapping, dst_root, previous=(), hardlink=False):
+    """
+    Make dst_root match a mapping computed by build_mapping.
+    Files whose size and mtime did not change are kept, others are copied
+    (reflinked when the filesystem allows) or hardlinked to their source if
+    hardlink is set and possible. Paths staged by a previous call (previous)
+    that are no longer in the mapping are removed, anything else in dst_root
+    is left untouched.
+    Hardlinked files share their inode with the source: they must never be
+    modified in place, in either tree (replace them instead, like
+    elfstrip.strip_file does), nor have their timestamps changed.
+    Return the number of files linked, copied, unchanged and removed.
+    """
+    stats = {"linked": 0, "copied": 0, "unchanged": 0, "removed": 0}
+
+    # Children before their parents
+    for relpath in sorted(set(previous) - set(mapping), reverse=True):
+        path = os.path.join(dst_root, relpath)
+        if os.path.isdir(path) and not os.path.islink(path):
+            try:
+                os.rmdir(path)
+            except OSError:
+                # Still contains files not staged here
+                continue
+        elif os.path.lexists(path):
+            os.unlink(path)
+        else:
+            continue
+        stats["removed"] += 1
+
+    os.makedirs(dst_root, exist_ok=True)
+    for relpath, (src_path, st) in mapping.items():
+        dst_path = os.path.join(dst_root, relpath)
+        if stat.S_ISDIR(st.st_mode):
+            if not os.path.isdir(dst_path) or os.path.islink(dst_path):
+                remove_path(dst_path)
+                os.mkdir(dst_path)
+            os.chmod(dst_path, stat.S_IMODE(st.st_mode))
+        elif stat.S_ISLNK(st.st_mode):
+            target = os.readlink(src_path)
+            if os.path.islink(dst_path) and os.readlink(dst_path) == target:
+                stats["unchanged"] += 1
+                continue
+            remove_path(dst_path)
+            os.symlink(target, dst_path)
+            stats["copied"] += 1
+        else:
+            _stage_file(src_path, st, dst_path, hardlink, stats)
+    return stats
+
+#===============================================================================
+#===============================================================================
+def load_state(path):
+    try:
+        with open(path, "r") as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return []
+
+def save_state(path, mapping):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fd:
+        json.dump(list(mapping), fd, indent=1)
+    os.replace(tmp_path, path)
@@ -0,0 +1,320 @@
+import http.client
+import json
+import logging
+import os
+import socket
+import time
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import common
+
+DEFAULT_API_PATH = "/api/v1"
+DEFAULT_TIMEOUT = 60
+# Timeout of uploads, the drone installing the mission before replying
+# (0: none)
+DEFAULT_UPLOAD_TIMEOUT = 600
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+
+#===============================================================================
+#===============================================================================
+class SyncError(Exception):
+    """
+    Request failed, args: message and number of attempts.
+    """
+
+# Maximum length of the response body reported in errors
+_MAX_ERROR_TEXT = 1024
+
+class _StatusError(Exception):
+    def __init__(self, status, reason, text=""):
+        super().__init__("HTTP %d %s%s" % (status, reason,
+                ": " + text if text else ""))
+        self.status = status
+
+class _ResponseTimeout(Exception):
+    """
+    No response in time to a request whose body was fully sent: the drone
+    may still be processing it, it must not be sent again.
+    """
+
+def parse_address(address):
+    """
+    Parse a drone address: 'host', 'host:port' or an url with an optional
+    api path ('http://host:port/api/v1').
+    Return (host, port, api path).
+    """
+    if "://" not in address:
+        address = "http://" + address
+    url = urllib.parse.urlsplit(address)
+    if url.scheme != "http" or not url.hostname:
+        raise ValueError("Invalid drone address: '%s'" % address)
+    return (url.hostname, url.port or 80,
+            url.path.rstrip("/") or DEFAULT_API_PATH)
+
+#===============================================================================
+#===============================================================================
+class DroneClient:
+    """
+    Client of the http api of a drone, keeping its connection alive between
+    requests and retrying failed ones with an exponential backoff.
+    """
+    def __init__(self, address, timeout=DEFAULT_TIMEOUT,
+            upload_timeout=DEFAULT_UPLOAD_TIMEOUT, retries=DEFAULT_RETRIES,
+            backoff=DEFAULT_BACKOFF):
+        self.address = address
+        self.host, self.port, self.api_path = parse_address(address)
+        self.timeout = timeout
+        self.upload_timeout = upload_timeout or None
+        self.retries = retries
+        self.backoff = backoff
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = http.client.HTTPConnection(self.host, self.port,
+                    timeout=self.timeout, blocksize=common.BUFSIZE)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def request(self, method, path, query=None, body_path=None, retry=True):
+        """
+        Send a request to the api, the body being read from body_path.
+        Return the response status, body and the number of attempts.
+        Raise SyncError when the request still fails after the retries.
+        """
+        url = self.api_path + path
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                return self._request(method, url, body_path) + (attempts,)
+            except (OSError, http.client.HTTPException, _StatusError,
+                    _ResponseTimeout) as ex:
+                # The server may have closed the kept-alive connection
+                self.close()
+                # Client errors (bad archive, downgrade refused...) are final
+                if isinstance(ex, _StatusError):
+                    retryable = ex.status >= 500
+                else:
+                    retryable = not isinstance(ex, _ResponseTimeout)
+                if not retry or not retryable or attempts > self.retries:
+                    raise SyncError("%s %s: %s" % (method, url, ex),
+                            attempts) from ex
+                delay = self.backoff * 2 ** (attempts - 1)
+                logging.warning("%s: %s %s failed (%s), retrying in %.1fs",
+                        self.address, method, url, ex, delay)
+                time.sleep(delay)
+
+    def _request(self, method, url, body_path):
+        conn = self._connection()
+        timeout = self.upload_timeout if body_path else self.timeout
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        headers = {}
+        if body_path:
+            headers["Content-Type"] = "application/octet-stream"
+            headers["Content-Length"] = str(os.path.getsize(body_path))
+            with open(body_path, "rb") as fin:
+                conn.request(method, url, body=fin, headers=headers)
+        else:
+            conn.request(method, url, headers=headers)
+        try:
+            response = conn.getresponse()
+        except socket.timeout as ex:
+            if body_path:
+                raise _ResponseTimeout("no response after %ss to the"
+                        " uploaded body: %s" % (timeout, ex)) from ex
+            raise
+        # Read the whole body to be able to reuse the connection
+        data = response.read()
+        if response.will_close:
+            self.close()
+        if response.status >= 400:
+            # Explanation of the drone (invalid signature...)
+            text = data[:_MAX_ERROR_TEXT].decode("utf-8", errors="replace")
+            raise _StatusError(response.status, response.reason,
+                    " ".join(text.split()))
+        return (response.status, data)
+
+    def upload_mission(self, tar_path, is_default=False, unsigned=False):
+        query = {"allow_downgrade": "yes"}
+        if is_default:
+            query["is_default"] = "yes"
+        if unsigned:
+            query["allow_unsigned"] = "yes"
+        return self.request("PUT", "/mission/missions/", query, tar_path)
+
+    def list_missions(self):
+        """
+        Get the missions installed on the drone, indexed by uid.
+        """
+        data = self.request("GET", "/mission/missions/")[1]
+        missions = json.loads(data.decode("utf-8"))
+        if isinstance(missions, dict):
+            missions = missions.get("missions", list(missions.values()))
+        return {mission["uid"]: mission for mission in missions
+                if isinstance(mission, dict) and "uid" in mission}
+
+    def reboot(self):
+        # Not retried, the drone may be rebooting already
+        return self.request("PUT", "/system/reboot", retry=False)
+
+#===============================================================================
+#===============================================================================
+# Fields of mission.json identifying an installed build
+_VERSION_FIELDS = ("version", "build_sdk_version")
+
+def is_installed(mission, installed, synced):
+    """
+    Check whether a mission (dict with its uid, versions and archive sha256)
+    is already installed on a drone: the drone reports the same versions and
+    the archive is the one last uploaded to it (versions are not bumped
+    between development builds).
+    installed: missions reported by the drone, by uid.
+    synced: missions last uploaded to the drone, by uid.
+    """
+    uid = mission["uid"]
+    if uid not in installed or uid not in synced:
+        return False
+    return synced[uid]["sha256"] == mission["sha256"] and \
+            all(installed[uid].get(field) == mission[field] and \
+                    synced[uid].get(field) == mission[field]
+                    for field in _VERSION_FIELDS)
+
+def sync_drone(client, missions, synced, is_default=False, unsigned=False,
+        reboot=False, force=False):
+    """
+    Upload missions (dicts with 'name', 'path' of the archive, 'uid',
+    versions and 'sha256') not already installed on a drone then reboot it.
+    synced: missions last uploaded to the drone (by uid), updated.
+    force: upload all missions.
+    Return a summary of the uploads.
+    """
+    result = {
+        "drone": client.address,
+        "missions": [],
+        "bytes": 0,
+        "duration": 0.0,
+        "failures": 0,
+        "skipped": 0,
+        "rebooted": False,
+    }
+    start = time.monotonic()
+    try:
+        installed = {}
+        if not force:
+            try:
+                installed = client.list_missions()
+            except (SyncError, ValueError, KeyError, TypeError) as ex:
+                # Upload everything
+                logging.warning("%s: failed to list installed missions: %s",
+                        client.address, ex)
+
+        for mission in missions:
+            name = mission["name"]
+            entry = {"name": name, "bytes": os.path.getsize(mission["path"]),
+                    "attempts": 0}
+            if is_installed(mission, installed, synced):
+                logging.info("%s: %s already installed", client.address, name)
+                entry["skipped"] = True
+                result["skipped"] += 1
+                result["missions"].append(entry)
+                continue
+
+            mission_start = time.monotonic()
+            try:
+                entry["attempts"] = client.upload_mission(mission["path"],
+                        is_default, unsigned)[2]
+                result["bytes"] += entry["bytes"]
+                synced[mission["uid"]] = {key: mission[key]
+                        for key in ("sha256",) + _VERSION_FIELDS}
+                logging.info("%s: %s uploaded (%.1f MB in %.1fs)",
+                        client.address, name, entry["bytes"] / 1e6,
+                        time.monotonic() - mission_start)
+            except SyncError as ex:
+                entry["error"] = ex.args[0]
+                entry["attempts"] = ex.args[1]
+                result["failures"] += 1
+                # Unknown state of the drone
+                synced.pop(mission["uid"], None)
+                logging.error("%s: %s upload failed: %s",
+                        client.address, name, ex.args[0])
+            entry["duration"] = time.monotonic() - mission_start
+            result["missions"].append(entry)
+
+        if reboot:
+            try:
+                client.reboot()
+                result["rebooted"] = True
+            except SyncError as ex:
+                result["failures"] += 1
+                result["reboot_error"] = ex.args[0]
+                logging.error("%s: reboot failed: %s",
+                        client.address, ex.args[0])
+    finally:
+        client.close()
+    result["duration"] = time.monotonic() - start
+    return result
+
+def sync_fleet(addresses, missions, state, jobs=None, is_default=False,
+        unsigned=False, reboot=False, force=False, **client_kwargs):
+    """
+    Upload missions to several drones in parallel, with at most jobs drones
+    at a time (all of them by default).
+    state: missions last uploaded to each drone (by address), updated.
+    Return the summaries of the drones, in the order of addresses.
+    """
+    clients = [DroneClient(address, **client_kwargs) for address in addresses]
+
+    def worker(client):
+        return sync_drone(client, missions, state.setdefault(client.address, {}),
+                is_default, unsigned, reboot, force)
+
+    with ThreadPoolExecutor(max_workers=jobs or len(clients) or 1) as executor:
+        return list(executor.map(worker, clients))
+
+def load_state(path):
+    try:
+        with open(path, "r") as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(path, state):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fd:
+        json.dump(state, fd, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def log_summary(results):
+    for result in results:
+        throughput = result["bytes"] / 1e6 / result["duration"] \
+                if result["duration"] > 0 else 0.0
+        retries = sum(max(entry["attempts"] - 1, 0)
+                for entry in result["missions"])
+        logging.info("%-30s %d/%d missions (%d skipped) %8.1f MB %7.1fs"
+                " %7.2f MB/s %d retries%s", result["drone"],
+                len(result["missions"]) - sum(1 for entry in result["missions"]
+                        if "error" in entry),
+                len(result["missions"]), result["skipped"],
+                result["bytes"] / 1e6,
+                result["duration"], throughput, retries,
+                ", %d failures" % result["failures"]
+                        if result["failures"] else "")
+        for entry in result["missions"]:
+            if "error" in entry:
+                logging.error("%-30s %s: %s", result["drone"], entry["name"],
+                        entry["error"])
+        if "reboot_error" in result:
+            logging.error("%-30s reboot: %s", result["drone"],
+                    result["reboot_error"])
@@ -0,0 +1,57 @@
+from .. import compress
+
+#===============================================================================
+#===============================================================================
+def test_compare_versions():
+    assert compress.compare_versions("7.4.0", "7.4.0") == 0
+    assert compress.compare_versions("7.4.1", "7.4.0") == 1
+    assert compress.compare_versions("7.3.9", "7.4.0") == -1
+    # Numeric, not lexicographic
+    assert compress.compare_versions("7.10.0", "7.9.0") == 1
+    # Missing fields are lower
+    assert compress.compare_versions("7.4", "7.4.0") == -1
+
+def test_compare_versions_suffix():
+    # Pre-release suffixes and non digits are ignored
+    assert compress.compare_versions("7.4.0-rc2", "7.4.0") == 0
+    assert compress.compare_versions("7.4.0-alpha", "7.4.0-beta") == 0
+    assert compress.compare_versions("v7.5.0", "7.4.0") == 1
+    assert compress.compare_versions("7.x.0", "7.0.0") == 0
+
+#===============================================================================
+#===============================================================================
+def test_allowed_formats_gzip_only():
+    min_firmware = {compress.FORMAT_XZ: "7.4.0"}
+    # Unknown target firmware
+    assert compress.get_allowed_formats(None, min_firmware) == \
+            [compress.FORMAT_GZIP]
+    assert compress.get_allowed_formats("", min_firmware) == \
+            [compress.FORMAT_GZIP]
+    # Older target firmware
+    assert compress.get_allowed_formats("7.3.0", min_firmware) == \
+            [compress.FORMAT_GZIP]
+    # Format not known to be supported by any firmware
+    assert compress.get_allowed_formats("9.0.0", {}) == [compress.FORMAT_GZIP]
+
+def test_allowed_formats_min_firmware():
+    min_firmware = {
+        compress.FORMAT_XZ: "7.4.0",
+        compress.FORMAT_NONE: "7.5.0",
+    }
+    assert compress.get_allowed_formats("7.4.0", min_firmware) == \
+            [compress.FORMAT_GZIP, compress.FORMAT_XZ]
+    assert compress.get_allowed_formats("7.5.0-rc1", min_firmware) == \
+            [compress.FORMAT_GZIP, compress.FORMAT_XZ, compress.FORMAT_NONE]
+
+def test_allowed_formats_unavailable(monkeypatch):
+    # Formats the host cannot produce are never allowed
+    monkeypatch.setattr(compress.shutil, "which", lambda name: None)
+    min_firmware = {
+        compress.FORMAT_ZSTD: "7.4.0",
+        compress.FORMAT_XZ: "7.4.0",
+    }
+    assert compress.get_allowed_formats("7.4.0", min_firmware) == \
+            [compress.FORMAT_GZIP, compress.FORMAT_XZ]
+    monkeypatch.setattr(compress.shutil, "which", lambda name: "/bin/" + name)
+    assert compress.get_allowed_formats("7.4.0", min_firmware) == \
+            [compress.FORMAT_GZIP, compress.FORMAT_ZSTD, compress.FORMAT_XZ]
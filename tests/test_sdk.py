@@ -0,0 +1,179 @@
+import hashlib
+import http.server
+import io
+import json
+import os
+import tarfile
+import threading
+
+import pytest
+
+from .. import sdk
+
+#===============================================================================
+#===============================================================================
+def _make_archive(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo("sdk/" + name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        data = server.data
+        offset = 0
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and (if_range is None or if_range == server.etag):
+            offset = int(range_header.split("=", 1)[1].rstrip("-"))
+        if offset:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" %
+                    (offset, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("ETag", server.etag)
+        self.send_header("Content-Length", str(len(data) - offset))
+        self.end_headers()
+        body = data[offset:]
+        if server.truncate is not None:
+            # Simulate a connection lost in the middle of the transfer
+            body, server.truncate = body[:server.truncate], None
+            self.close_connection = True
+        self.wfile.write(body)
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.requests = []
+    httpd.truncate = None
+    httpd.files = {
+        "build.prop": b"ro.missions.sdk_target_arch=aarch64\n",
+        "lib/blob": os.urandom(256 * 1024),
+    }
+    httpd.data = _make_archive(httpd.files)
+    httpd.etag = '"%s"' % hashlib.sha256(httpd.data).hexdigest()[:16]
+    httpd.url = "http://127.0.0.1:%d/sdk.tar.gz" % httpd.server_address[1]
+    thread = threading.Thread(target=httpd.serve_forever,
+            kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def _check_tree(server, dst_dir):
+    for name, data in server.files.items():
+        with open(str(dst_dir / name), "rb") as fd:
+            assert fd.read() == data
+
+def _check_archive(server, tar_path):
+    with open(str(tar_path), "rb") as fd:
+        assert fd.read() == server.data
+    assert not os.path.exists(str(tar_path) + ".part")
+    assert not os.path.exists(str(tar_path) + ".part.json")
+
+#===============================================================================
+#===============================================================================
+def test_download(server, tmp_path):
+    tar_path, dst_dir = tmp_path / "sdk.tar.gz", tmp_path / "sdk"
+    sha256 = hashlib.sha256(server.data).hexdigest()
+    meta = sdk.download_and_extract(server.url, tar_path, dst_dir,
+            sha256=sha256)
+    assert meta["size"] == len(server.data)
+    assert meta["sha256"] == sha256
+    assert meta["etag"] == server.etag
+    assert sdk.read_marker(str(dst_dir)) == meta
+    _check_tree(server, dst_dir)
+    _check_archive(server, tar_path)
+
+def test_not_modified(server, tmp_path):
+    meta = sdk.download_and_extract(server.url, tmp_path / "sdk.tar.gz",
+            tmp_path / "sdk", headers={"If-None-Match": server.etag})
+    assert meta is None
+    assert not os.path.exists(str(tmp_path / "sdk"))
+
+def test_resume(server, tmp_path):
+    tar_path, dst_dir = tmp_path / "sdk.tar.gz", tmp_path / "sdk"
+    server.truncate = len(server.data) // 2
+    meta = sdk.download_and_extract(server.url, tar_path, dst_dir,
+            sha256=hashlib.sha256(server.data).hexdigest())
+    assert meta["size"] == len(server.data)
+    # The second attempt only asks for the missing bytes
+    assert len(server.requests) == 2
+    first, second = server.requests
+    assert "Range" not in first
+    offset = int(second["Range"].split("=", 1)[1].rstrip("-"))
+    assert 0 < offset <= len(server.data) // 2
+    assert second["If-Range"] == server.etag
+    _check_tree(server, dst_dir)
+    _check_archive(server, tar_path)
+
+def test_resume_changed(server, tmp_path):
+    tar_path, dst_dir = tmp_path / "sdk.tar.gz", tmp_path / "sdk"
+    # Partial download of a previous version of the archive
+    part_path = str(tar_path) + ".part"
+    with open(part_path, "wb") as fd:
+        fd.write(os.urandom(1024))
+    with open(part_path + ".json", "w") as fd:
+        json.dump({"url": server.url, "etag": '"old"',
+                "last_modified": None}, fd)
+    meta = sdk.download_and_extract(server.url, tar_path, dst_dir)
+    # The server ignores the range, the whole archive is downloaded again
+    assert len(server.requests) == 1
+    assert server.requests[0]["Range"] == "bytes=1024-"
+    assert server.requests[0]["If-Range"] == '"old"'
+    assert meta["etag"] == server.etag
+    assert meta["sha256"] == hashlib.sha256(server.data).hexdigest()
+    _check_tree(server, dst_dir)
+    _check_archive(server, tar_path)
+
+def test_resume_other_url(server, tmp_path):
+    tar_path = tmp_path / "sdk.tar.gz"
+    part_path = str(tar_path) + ".part"
+    with open(part_path, "wb") as fd:
+        fd.write(server.data[:1024])
+    with open(part_path + ".json", "w") as fd:
+        json.dump({"url": server.url + "?old", "etag": server.etag,
+                "last_modified": None}, fd)
+    sdk.download_and_extract(server.url, tar_path, tmp_path / "sdk")
+    # Not a partial download of this url, no ranged request
+    assert "Range" not in server.requests[0]
+    _check_archive(server, tar_path)
+
+#===============================================================================
+#===============================================================================
+def test_swap(server, tmp_path):
+    dst_dir = tmp_path / "sdk"
+    os.makedirs(str(dst_dir / "lib"))
+    with open(str(dst_dir / "lib" / "stale"), "w") as fd:
+        fd.write("stale")
+    sdk.download_and_extract(server.url, tmp_path / "sdk.tar.gz", dst_dir)
+    # The previous tree is replaced as a whole
+    assert not os.path.exists(str(dst_dir / "lib" / "stale"))
+    _check_tree(server, dst_dir)
+    assert sorted(os.listdir(str(tmp_path))) == ["sdk", "sdk.tar.gz"]
+
+def test_swap_cancelled(server, tmp_path):
+    tar_path, dst_dir = tmp_path / "sdk.tar.gz", tmp_path / "sdk"
+    os.makedirs(str(dst_dir))
+    with open(str(dst_dir / "build.prop"), "w") as fd:
+        fd.write("old")
+    with pytest.raises(ValueError):
+        sdk.download_and_extract(server.url, tar_path, dst_dir,
+                sha256="0" * 64)
+    # The previous tree is kept, nothing is left behind
+    with open(str(dst_dir / "build.prop"), "r") as fd:
+        assert fd.read() == "old"
+    assert sorted(os.listdir(str(tmp_path))) == ["sdk"]
@@ -0,0 +1,89 @@
+import os
+
+from .. import staging
+
+#===============================================================================
+#===============================================================================
+def _write(path, content=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fd:
+        fd.write(content)
+
+def _mapping(root_dir, dirslist, excludes=()):
+    mapping = staging.build_mapping(str(root_dir), dirslist, excludes)
+    return {dst: os.path.relpath(src, str(root_dir))
+            for dst, (src, _) in mapping.items()}
+
+#===============================================================================
+#===============================================================================
+def test_hidden_entries(tmp_path):
+    _write(str(tmp_path / "a/.hidden"))
+    _write(str(tmp_path / "a/.git/config"))
+    _write(str(tmp_path / "a/lib/.keep"))
+    _write(str(tmp_path / "a/bin/tool"))
+    mapping = _mapping(tmp_path, {"a": "payload"})
+    # Only skipped at the top level of a source, like 'cp -a <src>/*'
+    assert mapping == {
+        "payload": "a",
+        "payload/bin": "a/bin",
+        "payload/bin/tool": "a/bin/tool",
+        "payload/lib": "a/lib",
+        "payload/lib/.keep": "a/lib/.keep",
+    }
+
+def test_missing_and_empty_sources(tmp_path):
+    os.makedirs(str(tmp_path / "empty"))
+    assert _mapping(tmp_path, {"missing": "payload", "empty": "payload"}) == {}
+
+def test_override(tmp_path):
+    _write(str(tmp_path / "a/etc/conf"), "a")
+    _write(str(tmp_path / "a/etc/only-a"), "a")
+    _write(str(tmp_path / "b/etc/conf"), "b")
+    _write(str(tmp_path / "b/etc/only-b"), "b")
+    mapping = _mapping(tmp_path, {"a": "payload", "b": "payload"})
+    # Later sources override earlier ones, directories are merged
+    assert mapping == {
+        "payload": "a",
+        "payload/etc": "b/etc",
+        "payload/etc/conf": "b/etc/conf",
+        "payload/etc/only-a": "a/etc/only-a",
+        "payload/etc/only-b": "b/etc/only-b",
+    }
+
+def test_directory_replaced_by_file(tmp_path):
+    _write(str(tmp_path / "a/share/data/file"))
+    _write(str(tmp_path / "a/share/keep"))
+    _write(str(tmp_path / "b/share/data"))
+    mapping = _mapping(tmp_path, {"a": "payload", "b": "payload"})
+    assert mapping == {
+        "payload": "a",
+        "payload/share": "b/share",
+        "payload/share/data": "b/share/data",
+        "payload/share/keep": "a/share/keep",
+    }
+
+def test_destinations(tmp_path):
+    _write(str(tmp_path / "a/file"))
+    _write(str(tmp_path / "b/file"))
+    mapping = _mapping(tmp_path, {"a": "payload", "b": "payload/sub"})
+    assert mapping == {
+        "payload": "a",
+        "payload/file": "a/file",
+        "payload/sub": "b",
+        "payload/sub/file": "b/file",
+    }
+    # Parents always appear before their children
+    keys = list(mapping)
+    assert keys.index("payload/sub") < keys.index("payload/sub/file")
+
+def test_excludes(tmp_path):
+    _write(str(tmp_path / "a/lib/libfoo.so"))
+    _write(str(tmp_path / "a/lib/libfoo.a"))
+    _write(str(tmp_path / "a/include/foo.h"))
+    mapping = _mapping(tmp_path, {"a": "payload"},
+            excludes=("*.a", "payload/include"))
+    assert mapping == {
+        "payload": "a",
+        "payload/lib": "a/lib",
+        "payload/lib/libfoo.so": "a/lib/libfoo.so",
+    }
@@ -0,0 +1,57 @@
+from .. import sync
+
+#===============================================================================
+#===============================================================================
+def _mission(**kwargs):
+    mission = {
+        "uid": "com.parrot.missions.test",
+        "version": "1.0.0",
+        "build_sdk_version": "7.4.0",
+        "sha256": "0" * 64,
+    }
+    mission.update(kwargs)
+    return mission
+
+def _entry(mission, *fields):
+    return {field: mission[field] for field in ("uid",) + fields}
+
+def test_installed():
+    mission = _mission()
+    installed = {mission["uid"]: _entry(mission, "version", "build_sdk_version")}
+    synced = {mission["uid"]: _entry(mission, "version", "build_sdk_version",
+            "sha256")}
+    assert sync.is_installed(mission, installed, synced)
+
+def test_not_reported():
+    mission = _mission()
+    synced = {mission["uid"]: _entry(mission, "version", "build_sdk_version",
+            "sha256")}
+    # Removed from the drone since the last upload
+    assert not sync.is_installed(mission, {}, synced)
+
+def test_never_synced():
+    mission = _mission()
+    installed = {mission["uid"]: _entry(mission, "version", "build_sdk_version")}
+    # Installed by other means, the archive may differ
+    assert not sync.is_installed(mission, installed, {})
+
+def test_rebuilt():
+    mission = _mission()
+    installed = {mission["uid"]: _entry(mission, "version", "build_sdk_version")}
+    synced = {mission["uid"]: _entry(mission, "version", "build_sdk_version",
+            "sha256")}
+    # Same versions but a new archive (development build)
+    assert not sync.is_installed(_mission(sha256="1" * 64), installed, synced)
+
+def test_version_changed():
+    mission = _mission()
+    old = _mission(version="0.9.0")
+    synced = {mission["uid"]: _entry(mission, "version", "build_sdk_version",
+            "sha256")}
+    # The drone still reports the previous version (failed install)
+    installed = {mission["uid"]: _entry(old, "version", "build_sdk_version")}
+    assert not sync.is_installed(mission, installed, synced)
+    # Uploaded with another sdk version
+    installed = {mission["uid"]: _entry(mission, "version", "build_sdk_version")}
+    synced[mission["uid"]]["build_sdk_version"] = "7.3.0"
+    assert not sync.is_installed(mission, installed, synced)
@@ -0,0 +1,152 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+# Counters summed in the summary when present in a phase
+_COUNTERS = ("bytes_in", "bytes_out", "bytes_saved", "files")
+
+#===============================================================================
+#===============================================================================
+class Recorder:
+    """
+    Collect the wall time and counters (bytes_in, bytes_out, bytes_saved,
+    files) of the phases of a task, per mission when given.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._events = []
+        self._tids = {}
+        self._origin = time.monotonic()
+        self._wall_origin = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name, mission=None):
+        """
+        Record the duration of the block, the yielded dict can be filled with
+        counters.
+        """
+        counters = {}
+        start = time.monotonic()
+        try:
+            yield counters
+        finally:
+            self.add(name, start, time.monotonic() - start, mission, counters)
+
+    def add(self, name, start, duration, mission=None, counters=None):
+        with self._lock:
+            tid = self._tids.setdefault(threading.get_ident(), len(self._tids))
+            self._events.append({
+                "name": name,
+                "mission": mission,
+                "start": start - self._origin,
+                "duration": duration,
+                "tid": tid,
+                "counters": dict(counters or {}),
+            })
+
+    def elapsed(self):
+        return time.monotonic() - self._origin
+
+    def summary(self):
+        phases = {}
+        missions = {}
+        for event in self._events:
+            targets = [phases]
+            if event["mission"]:
+                targets.append(missions.setdefault(event["mission"], {}))
+            for target in targets:
+                entry = target.setdefault(event["name"],
+                        {"count": 0, "duration": 0.0})
+                entry["count"] += 1
+                entry["duration"] += event["duration"]
+                for key in _COUNTERS:
+                    if key in event["counters"]:
+                        entry[key] = entry.get(key, 0) + event["counters"][key]
+        return {
+            "task": self.name,
+            "start_time": self._wall_origin,
+            "total_duration": self.elapsed(),
+            "phases": phases,
+            "missions": missions,
+        }
+
+    def chrome_trace(self):
+        """
+        Events in the Chrome trace event format (chrome://tracing, Perfetto).
+        """
+        events = []
+        for event in self._events:
+            args = dict(event["counters"])
+            if event["mission"]:
+                args["mission"] = event["mission"]
+            events.append({
+                "name": event["name"],
+                "cat": event["mission"] or self.name,
+                "ph": "X",
+                "ts": int(event["start"] * 1e6),
+                "dur": int(event["duration"] * 1e6),
+                "pid": os.getpid(),
+                "tid": event["tid"],
+                "args": args,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+        summary_path = os.path.join(out_dir, "%s-timing.json" % self.name)
+        trace_path = os.path.join(out_dir, "%s-trace.json" % self.name)
+        with open(summary_path, "w") as fd:
+            json.dump(self.summary(), fd, indent=4, sort_keys=True)
+        with open(trace_path, "w") as fd:
+            json.dump(self.chrome_trace(), fd)
+        return (summary_path, trace_path)
+
+    def log_summary(self):
+        summary = self.summary()
+        for name, entry in sorted(summary["phases"].items(),
+                key=lambda item: -item[1]["duration"]):
+            extra = "".join(", %s=%d" % (key, entry[key])
+                    for key in _COUNTERS if key in entry)
+            logging.info("  %-20s %8.2fs (x%d%s)", name, entry["duration"],
+                    entry["count"], extra)
+        logging.info("Total %s time: %.2fs", self.name, summary["total_duration"])
+
+#===============================================================================
+#===============================================================================
+_recorder = None
+
+@contextlib.contextmanager
+def recording(name, out_dir):
+    """
+    Make a new recorder the current one for the duration of the block, then
+    write its summary and trace in out_dir and log the totals.
+    """
+    global _recorder
+    recorder = Recorder(name)
+    _recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _recorder = None
+        try:
+            summary_path, trace_path = recorder.write(out_dir)
+            logging.info("Timing summary: %s, trace: %s", summary_path, trace_path)
+        except OSError as ex:
+            logging.warning("Failed to write timing data: %s", ex)
+        recorder.log_summary()
+
+def phase(name, mission=None):
+    """
+    Record a phase with the current recorder, if any.
+    """
+    if _recorder is None:
+        return contextlib.nullcontext({})
+    return _recorder.phase(name, mission)
+
+def add(name, start, duration, mission=None, counters=None):
+    if _recorder is not None:
+        _recorder.add(name, start, duration, mission, counters)
@@ -0,0 +1,224 @@
+import gzip
+import hashlib
+import json
+import lzma
+import tarfile
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import common
+from . import compress
+
+MISSION_JSON_NAME = "mission.json"
+PAYLOAD_PREFIX = "payload.tar"
+DEFAULT_SIGNATURE_NAME = "signature.ecdsa"
+
+# Fields of mission.json set by the build (see set_versions)
+REQUIRED_FIELDS = ("version", "build_sdk_version", "build_sdk_target_arch",
+        "target_min_version", "target_max_version")
+
+# Fields of mission.json reported in the results
+_REPORTED_FIELDS = ("uid", "name") + REQUIRED_FIELDS
+
+
+#===============================================================================
+#===============================================================================
+class _HashingReader:
+    """
+    Read-only file object updating a digest with what is read through it.
+    """
+    def __init__(self, fileobj, digest):
+        self._fileobj = fileobj
+        self.digest = digest
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.digest.update(data)
+        self.count += len(data)
+        return data
+
+def _drain(fileobj):
+    while fileobj.read(common.BUFSIZE):
+        pass
+
+def _entry_type(tarinfo):
+    if tarinfo.isreg():
+        return "file"
+    if tarinfo.isdir():
+        return "dir"
+    if tarinfo.issym():
+        return "symlink"
+    if tarinfo.islnk():
+        return "hardlink"
+    return "other"
+
+def payload_format(name):
+    """
+    Compression format of a payload member ('payload.tar.gz'...), None if
+    the name is not the one of a payload.
+    """
+    for format in compress.FORMATS:
+        if name == PAYLOAD_PREFIX + compress.EXTENSIONS[format]:
+            return format
+    return None
+
+#===============================================================================
+#===============================================================================
+def _read_payload(fileobj, format):
+    """
+    Stream the payload tar, decompressed on the fly, to the end so that the
+    checksums of the compressed stream are verified.
+    Return the size of its files and its entries.
+    """
+    entries = []
+    size = 0
+    with compress.open_reader(fileobj, format) as reader:
+        with tarfile.open(fileobj=reader, mode="r|",
+                bufsize=common.BUFSIZE) as tar:
+            for tarinfo in tar:
+                entry = {
+                    "name": tarinfo.name,
+                    "type": _entry_type(tarinfo),
+                    "size": tarinfo.size if tarinfo.isreg() else 0,
+                }
+                size += entry["size"]
+                entries.append(entry)
+        _drain(reader)
+    return (size, entries)
+
+def _check_mission(mission, expected, firmware, errors):
+    for field in REQUIRED_FIELDS:
+        if not mission.get(field):
+            errors.append("Missing '%s' in %s" % (field, MISSION_JSON_NAME))
+    for field, value in expected.items():
+        if value is not None and mission.get(field) != value:
+            errors.append("Unexpected %s: '%s' instead of '%s'"
+                    % (field, mission.get(field), value))
+
+    min_version = mission.get("target_min_version")
+    max_version = mission.get("target_max_version")
+    if min_version and max_version and \
+            compress.compare_versions(min_version, max_version) > 0:
+        errors.append("Target min version %s above max version %s"
+                % (min_version, max_version))
+    if firmware and min_version and max_version and \
+            not (compress.compare_versions(min_version, firmware) <= 0 and
+                    compress.compare_versions(firmware, max_version) <= 0):
+        errors.append("Firmware %s not in target versions %s - %s"
+                % (firmware, min_version, max_version))
+
+def verify_archive(path, expected=None, firmware=None,
+        signature_name=DEFAULT_SIGNATURE_NAME, require_signature=True,
+        allow_unchecked_signature=False, algorithm="sha512"):
+    """
+    Inspect and check a mission archive (<mission>.tar.gz) by streaming it
+    and its payload, without extracting them:
+    - it only contains mission.json, the payload and the signature, and
+      the compressed streams and tars are valid,
+    - mission.json has the fields set by the build (REQUIRED_FIELDS), with
+      the expected values (dict field -> value) and target versions
+      accepting the given firmware version,
+    - the signature is present (if required). Its content is written by
+      the signer (dragon_buildext_sign) in a format not known here, so it
+      cannot be checked against the digests of the signed members: this is
+      an error unless allow_unchecked_signature (then a warning), the
+      digests being reported to be checked by the signer tools.
+    Return a dict with the 'errors' and 'warnings' found, the 'members'
+    (with their digest), the 'mission' fields, the 'payload' entries and
+    sizes, the 'signature' and the 'sha256' of the archive.
+    """
+    start = time.monotonic()
+    result = {
+        "path": path,
+        "size": 0,
+        "sha256": None,
+        "members": [],
+        "mission": None,
+        "payload": None,
+        "signature": None,
+        "errors": [],
+        "warnings": [],
+    }
+    errors = result["errors"]
+    digests = {}
+    signature_data = None
+    archive_digest = hashlib.sha256()
+
+    try:
+        with open(path, "rb") as fin:
+            hashing_fin = _HashingReader(fin, archive_digest)
+            with gzip.GzipFile(fileobj=hashing_fin, mode="rb") as gzfile:
+                with tarfile.open(fileobj=gzfile, mode="r|",
+                        bufsize=common.BUFSIZE) as tar:
+                    for tarinfo in tar:
+                        name = tarinfo.name
+                        format = payload_format(name)
+                        if not tarinfo.isreg():
+                            errors.append("Unexpected member '%s'" % name)
+                            continue
+                        member = _HashingReader(tar.extractfile(tarinfo),
+                                hashlib.new(algorithm))
+                        if name == MISSION_JSON_NAME:
+                            mission = json.loads(member.read().decode("utf-8"))
+                            result["mission"] = {field: mission.get(field)
+                                    for field in _REPORTED_FIELDS}
+                            _check_mission(mission, expected or {},
+                                    firmware, errors)
+                        elif format is not None:
+                            payload_size, entries = _read_payload(member,
+                                    format)
+                            result["payload"] = {
+                                "name": name,
+                                "format": format,
+                                "compressed_size": tarinfo.size,
+                                "size": payload_size,
+                                "files": sum(1 for entry in entries
+                                        if entry["type"] == "file"),
+                                "entries": entries,
+                            }
+                        elif name == signature_name:
+                            signature_data = member.read()
+                        else:
+                            errors.append("Unexpected member '%s'" % name)
+                        _drain(member)
+                        digests[name] = member.digest.hexdigest()
+                        result["members"].append({"name": name,
+                                "size": tarinfo.size, "digest": digests[name]})
+                # Check the gzip trailer
+                _drain(gzfile)
+            _drain(hashing_fin)
+        result["size"] = hashing_fin.count
+        result["sha256"] = archive_digest.hexdigest()
+    except (OSError, EOFError, ValueError, tarfile.TarError, zlib.error,
+            lzma.LZMAError) as ex:
+        errors.append("Invalid archive: %s" % ex)
+
+    if result["mission"] is None:
+        errors.append("Missing %s" % MISSION_JSON_NAME)
+    if result["payload"] is None:
+        errors.append("Missing payload")
+    if signature_data is None:
+        if require_signature:
+            errors.append("Missing signature '%s'" % signature_name)
+    else:
+        (result["warnings"] if allow_unchecked_signature else errors).append(
+                "Signature '%s' not checked against the signed members"
+                % signature_name)
+        result["signature"] = {"name": signature_name,
+                "size": len(signature_data), "digests": "unchecked"}
+
+    result["duration"] = time.monotonic() - start
+    return result
+
+def verify_archives(paths, jobs=None, **kwargs):
+    """
+    Verify several archives in parallel (decompression and hashing release
+    the GIL), see verify_archive for kwargs.
+    Return the results, in the order of paths.
+    """
+    with ThreadPoolExecutor(max_workers=jobs or len(paths) or 1) as executor:
+        return list(executor.map(lambda path: verify_archive(path, **kwargs),
+                paths))
@@ -0,0 +1,74 @@
+import os
+import time
+
+DEFAULT_INTERVAL = 1.0
+DEFAULT_DEBOUNCE = 0.5
+
+#===============================================================================
+#===============================================================================
+def _scan(path, entries):
+    try:
+        it = os.scandir(path)
+    except OSError:
+        return
+    with it:
+        for entry in it:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            entries[entry.path] = (st.st_size, st.st_mtime_ns, st.st_ino)
+            if entry.is_dir(follow_symlinks=False):
+                _scan(entry.path, entries)
+
+def snapshot(paths):
+    """
+    Get the size, mtime and inode of all files and directories under the
+    given paths (symlinks are not followed).
+    """
+    entries = {}
+    for path in paths:
+        _scan(path, entries)
+    return entries
+
+#===============================================================================
+#===============================================================================
+class Watcher:
+    """
+    Detect changes under a set of directories by polling, which works on any
+    file system and does not need a notification api.
+    """
+    def __init__(self, paths, interval=DEFAULT_INTERVAL,
+            debounce=DEFAULT_DEBOUNCE):
+        self.paths = paths
+        self.interval = interval
+        self.debounce = debounce
+        self._entries = snapshot(paths)
+
+    def poll(self):
+        """
+        Return the paths added, modified or removed since the last call.
+        """
+        entries = snapshot(self.paths)
+        changed = set(path for path, value in entries.items()
+                if self._entries.get(path) != value)
+        changed.update(set(self._entries) - set(entries))
+        self._entries = entries
+        return changed
+
+    def wait(self):
+        """
+        Wait for changes, then until nothing changed for the debounce
+        delay (a build installing many files).
+        Return the changed paths.
+        """
+        changed = set()
+        while not changed:
+            time.sleep(self.interval)
+            changed = self.poll()
+        while True:
+            time.sleep(self.debounce)
+            more = self.poll()
+            if not more:
+                return changed
+            changed |= more